@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for the besnappy client.
+
+Runs client scenarios against an in-process fake Snappy server (see
+``besnappy.tests.fake_snappy``) and reports throughput, latency percentiles
+and peak Python memory allocation for each scenario as JSON.
+
+The fake server shares the process (and the GIL) with the client, so
+absolute numbers understate what a real deployment achieves. Use
+``--latency`` to model network round trips, and compare runs made with
+the same options on the same machine.
+
+For the concurrent scenarios, latency is the time between successive
+results rather than per-request latency.
+
+Usage::
+
+    python benchmarks/bench_client.py --output results.json
+    python benchmarks/bench_client.py --latency 0.02 --error-rate 0.01
+    python benchmarks/bench_client.py --compare old.json --output new.json
+
+Results from different releases can be compared with ``--compare``.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import besnappy
+from besnappy.tests.fake_snappy import FakeSnappyServer
+from besnappy.tickets import SnappyApiSender
+
+
+def percentile(sorted_values, fraction):
+    """
+    Return the value at ``fraction`` (between 0 and 1) of a sorted list,
+    using the nearest-rank method.
+    """
+    if not sorted_values:
+        return None
+    rank = max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarise(latencies, elapsed, errors, peak_memory):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "seconds": elapsed,
+        "requests_per_second": count / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 0.50) * 1000 if count else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if count else None,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def run_serial(call, count):
+    """
+    Call ``call(i)`` ``count`` times in a row, timing each call.
+    """
+    latencies = []
+    errors = 0
+    for i in range(count):
+        start = time.perf_counter()
+        try:
+            call(i)
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+    return latencies, errors
+
+
+def run_stream(results):
+    """
+    Consume an iterator of results from a concurrent API, timing the gap
+    between results.
+    """
+    latencies = []
+    errors = 0
+    last = time.perf_counter()
+    for result in results:
+        now = time.perf_counter()
+        latencies.append(now - last)
+        last = now
+        if isinstance(result, Exception) or (
+                isinstance(result, tuple) and
+                isinstance(result[-1], Exception)):
+            errors += 1
+    return latencies, errors
+
+
+def note_spec(i):
+    return {
+        "mailbox_id": 3642,
+        "subject": "Benchmark %s" % (i,),
+        "message": "Benchmark note %s" % (i,),
+        "from_addr": [{"name": "Bench", "address": "bench@example.com"}],
+    }
+
+
+def scenarios(snappy, args):
+    """
+    Yield ``(name, runner)`` pairs. Each runner returns latencies and an
+    error count.
+    """
+    n = args.requests
+    yield "get_accounts", lambda: run_serial(
+        lambda i: snappy.get_accounts(), n)
+    yield "get_staff", lambda: run_serial(
+        lambda i: snappy.get_staff(3249), n)
+    yield "get_ticket_notes", lambda: run_serial(
+        lambda i: snappy.get_ticket_notes("ticket%s" % (i,)), n)
+    yield "iter_ticket_notes_stream", lambda: run_serial(
+        lambda i: sum(1 for _ in snappy.iter_ticket_notes_stream(
+            "ticket%s" % (i,))), n)
+    yield "create_note", lambda: run_serial(
+        lambda i: snappy.create_note(**note_spec(i)), n)
+    yield "create_notes", lambda: run_stream(snappy.create_notes(
+        (note_spec(i) for i in range(n)), max_workers=args.concurrency))
+    yield "iter_ticket_notes", lambda: run_stream(snappy.iter_ticket_notes(
+        ("ticket%s" % (i,) for i in range(n)),
+        concurrency=args.concurrency))
+
+
+def run_benchmarks(args):
+    server = FakeSnappyServer(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        notes_per_ticket=args.notes_per_ticket, seed=args.seed)
+    results = {}
+    with server:
+        snappy = SnappyApiSender(
+            "bench_key", api_url=server.api_url,
+            pool_maxsize=max(10, args.concurrency))
+        for name, runner in scenarios(snappy, args):
+            if args.scenario and name not in args.scenario:
+                continue
+            start = time.perf_counter()
+            latencies, errors = runner()
+            elapsed = time.perf_counter() - start
+            # tracemalloc slows everything down, so memory is measured in a
+            # separate run.
+            tracemalloc.start()
+            runner()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name] = summarise(latencies, elapsed, errors, peak)
+            print("%-24s %8.1f req/s  p50 %7.2f ms  p99 %7.2f ms" % (
+                name, results[name]["requests_per_second"],
+                results[name]["p50_ms"], results[name]["p99_ms"]),
+                file=sys.stderr)
+    return {
+        "besnappy_version": besnappy.__version__,
+        "python": platform.python_version(),
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "error_rate": args.error_rate,
+            "notes_per_ticket": args.notes_per_ticket,
+        },
+        "results": results,
+    }
+
+
+def compare(old, new):
+    """
+    Print the relative change in each metric between two result sets.
+    """
+    for name, new_result in sorted(new["results"].items()):
+        old_result = old["results"].get(name)
+        if old_result is None:
+            continue
+        changes = []
+        for key in ["requests_per_second", "p50_ms", "p99_ms",
+                    "peak_memory_bytes"]:
+            if old_result.get(key) and new_result.get(key) is not None:
+                change = (new_result[key] / old_result[key] - 1) * 100
+                changes.append("%s %+.1f%%" % (key, change))
+        print("%-24s %s" % (name, ", ".join(changes)), file=sys.stderr)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--requests", type=int, default=200,
+        help="Requests per scenario (default: %(default)s).")
+    parser.add_argument(
+        "--concurrency", type=int, default=8,
+        help="Workers for the concurrent scenarios (default: %(default)s).")
+    parser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="Fake server latency in seconds (default: %(default)s).")
+    parser.add_argument(
+        "--jitter", type=float, default=0.0,
+        help="Extra random fake server latency in seconds.")
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0,
+        help="Fraction of requests the fake server fails with a 503.")
+    parser.add_argument(
+        "--notes-per-ticket", type=int, default=None,
+        help="Number of notes in each ticket notes response.")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Seed for the fake server's jitter and errors.")
+    parser.add_argument(
+        "--scenario", action="append",
+        help="Only run this scenario. May be repeated.")
+    parser.add_argument(
+        "--output", help="Write JSON results to this file.")
+    parser.add_argument(
+        "--compare", help="Compare with JSON results from an earlier run.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run_benchmarks(args)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the besnappy client's per-request overhead.
+
+Requests go to an adapter that answers immediately without touching the
+network, so the timings are the cost of building, sending and handling a
+request in the client and in requests itself.
+
+Each request type is also timed through a plain ``requests`` call set up
+the way the client used to make it (auth tuple, headers and ``verify``
+given per request), for comparison.
+
+Usage::
+
+    python benchmarks/bench_overhead.py
+    python benchmarks/bench_overhead.py --requests 20000 --output results.json
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from requests import Session
+
+from besnappy.tests.helpers import CallbackAdapter
+from besnappy.tickets import SnappyApiSender
+
+
+API_URL = "https://app.besnappy.com/api/v1"
+NOTE = {"mailbox_id": 3642, "subject": "Subject", "message": "Message"}
+
+
+def per_call_us(call, count):
+    """
+    Return the mean time of ``call()`` in microseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        call()
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def plain_requests_calls(session, api_key):
+    """
+    Return GET and POST calls made the way earlier releases made them.
+    """
+    def get():
+        return session.get(
+            API_URL + "/accounts", auth=(api_key, "x"), params=None,
+            headers={'content-type': 'application/json; charset=utf-8'},
+            verify=False)
+
+    def post():
+        return session.post(
+            API_URL + "/note", auth=(api_key, "x"), data=json.dumps(NOTE),
+            headers={'content-type': 'application/json; charset=utf-8'},
+            verify=False)
+
+    return get, post
+
+
+def run_benchmarks(args):
+    session = Session()
+    session.mount(API_URL, CallbackAdapter(lambda request: ("[]", 200, {})))
+    snappy = SnappyApiSender("bench_key", api_url=API_URL, session=session)
+    plain_get, plain_post = plain_requests_calls(session, "bench_key")
+    calls = [
+        ("get", lambda: snappy._api_request("GET", "accounts"), plain_get),
+        ("post", lambda: snappy._api_request("POST", "note", NOTE),
+         plain_post),
+    ]
+    results = {}
+    for name, client_call, plain_call in calls:
+        # Warm up before timing.
+        per_call_us(client_call, 100)
+        per_call_us(plain_call, 100)
+        client_us = per_call_us(client_call, args.requests)
+        plain_us = per_call_us(plain_call, args.requests)
+        results[name] = {
+            "client_us": client_us,
+            "per_request_setup_us": plain_us,
+            "speedup": plain_us / client_us,
+        }
+        print("%-6s client %7.1f us  per-request setup %7.1f us  (%.1fx)" % (
+            name, client_us, plain_us, plain_us / client_us), file=sys.stderr)
+    return {"requests": args.requests, "results": results}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--requests", type=int, default=5000,
+        help="Requests per measurement (default: %(default)s).")
+    parser.add_argument(
+        "--output", help="Write JSON results to this file.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    text = json.dumps(run_benchmarks(args), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,33 @@
 
 __version__ = "0.1.0a"
 
-from .tickets import SnappyApiSender
-
 __all__ = [
     'SnappyApiSender',
+    'AsyncSnappyApiSender',
+    'TicketNotesWatcher',
+    'SnappyClientPool',
 ]
+
+# The public classes are imported on first use, so that importing a
+# submodule (such as the command line tool) doesn't pull in requests and
+# aiohttp before they're needed.
+_LAZY = {
+    'SnappyApiSender': 'tickets',
+    'AsyncSnappyApiSender': 'aio',
+    'TicketNotesWatcher': 'sync',
+    'SnappyClientPool': 'clientpool',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(
+            "module %r has no attribute %r" % (__name__, name))
+    from importlib import import_module
+    value = getattr(import_module('.' + _LAZY[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
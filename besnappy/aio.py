@@ -0,0 +1,183 @@
+""" Asyncio client for the Snappy HTTP API.
+"""
+import asyncio
+
+from .jsoncodec import get_codec
+from .tickets import build_note_data
+from .transport import basic_auth_header
+
+
+DEFAULT_API_URL = "https://app.besnappy.com/api/v1"
+
+
+class AsyncSnappyApiSender(object):
+    """
+    An asyncio counterpart to :class:`besnappy.tickets.SnappyApiSender`.
+
+    All API methods are coroutines. Requests share a single pooled
+    :class:`aiohttp.ClientSession` and at most ``concurrency`` requests are
+    in flight at once; further calls wait for a free slot instead of
+    opening more connections.
+
+    The sender should be closed with :meth:`close` (or used as an
+    ``async with`` context manager) when it is no longer needed.
+
+    :param str api_key:
+        The secret authentication token found in You -> Your Setting
+        -> Security
+    :param str api_url:
+        The full URL of the HTTP API. Defaults to
+        ``https://app.besnappy.com/api/v1``.
+    :type session:
+        :class:`aiohttp.ClientSession`
+    :param session:
+        Session to use for HTTP requests. Defaults to a new session with a
+        connection pool of ``concurrency`` connections, created on first use.
+        A session provided by the caller is not closed by :meth:`close`.
+    :param int concurrency:
+        Maximum number of requests in flight at once. Defaults to 100.
+    :param codec:
+        JSON codec for request and response bodies, as accepted by
+        :func:`besnappy.jsoncodec.get_codec`. Defaults to the fastest
+        installed backend.
+    """
+
+    def __init__(self, api_key, api_url=None, session=None, concurrency=100,
+                 codec=None):
+        self.api_key = api_key
+        if api_url is None:
+            api_url = DEFAULT_API_URL
+        self.api_url = api_url
+        self.session = session
+        self._owns_session = session is None
+        self.concurrency = concurrency
+        self.codec = get_codec(codec)
+        # Created by _get_semaphore() in the running loop: before Python
+        # 3.10 a semaphore is bound to the loop current when it is built,
+        # which may not be the one the sender ends up used in.
+        self._semaphore = None
+        self._semaphore_loop = None
+        self._headers = {
+            'content-type': 'application/json; charset=utf-8',
+            'Authorization': basic_auth_header(api_key),
+        }
+
+    def _get_session(self):
+        if self.session is None:
+            # aiohttp is an optional dependency, so we only import it when we
+            # need to build our own session.
+            import aiohttp
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency, ssl=False)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    def _get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def close(self):
+        """
+        Close the underlying session if this sender created it.
+        """
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def _api_request(self, method, endpoint, py_data=None, text=False):
+        """
+        Make an API request and return the decoded response body.
+
+        JSON responses are decoded, other responses are returned as text.
+        If ``text`` is ``True``, the body is always returned as text.
+        """
+        url = "%s/%s" % (self.api_url, endpoint)
+        kw = {'headers': self._headers}
+        if py_data is not None:
+            if method == "POST":
+                kw['data'] = self.codec.dumps(py_data)
+            else:
+                kw['params'] = py_data
+        session = self._get_session()
+        async with self._get_semaphore():
+            async with session.request(method, url, **kw) as r:
+                r.raise_for_status()
+                if not text and r.content_type == "application/json":
+                    return self.codec.loads(await r.read())
+                return await r.text()
+
+    async def get_accounts(self):
+        """
+        List accounts available.
+
+        :returns:
+            List of account dicts.
+        """
+        return await self._api_request('GET', 'accounts')
+
+    async def get_mailboxes(self, account_id):
+        """
+        List mailboxes in account.
+
+        :param int account_id:
+            Account identifier.
+
+        :returns:
+            List of mailbox dicts.
+        """
+        return await self._api_request(
+            'GET', 'account/%s/mailboxes' % (account_id,))
+
+    async def get_staff(self, account_id):
+        """
+        List staff in account.
+
+        :param int account_id:
+            Account identifier.
+
+        :returns:
+            List of staff dicts.
+        """
+        return await self._api_request(
+            'GET', 'account/%s/staff' % (account_id,))
+
+    async def create_note(self, mailbox_id, subject, message, ticket_id=None,
+                          to_addr=None, from_addr=None, staff_id=None,
+                          scope=None):
+        """
+        Create a new note on a new or existing ticket.
+
+        See :meth:`besnappy.tickets.SnappyApiSender.create_note` for a
+        description of the parameters.
+
+        :returns:
+            Ticket identifier, the response body as text like the
+            synchronous client returns it.
+        """
+        data = build_note_data(
+            mailbox_id, subject, message, ticket_id=ticket_id,
+            to_addr=to_addr, from_addr=from_addr, staff_id=staff_id,
+            scope=scope)
+        return await self._api_request('POST', 'note', data, text=True)
+
+    async def get_ticket_notes(self, ticket_id):
+        """
+        Get notes attached to the specified ticket.
+
+        :param ticket_id:
+            Ticket to get notes from.
+
+        :returns:
+            List of ticket note dicts.
+        """
+        return await self._api_request(
+            'GET', 'ticket/%s/notes/' % (ticket_id,))
@@ -0,0 +1,366 @@
+""" Circuit breaking and load shedding for Snappy API calls.
+"""
+from collections import deque, namedtuple
+import threading
+import time
+
+from requests.exceptions import RequestException
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class FastFailError(RequestException):
+    """
+    Raised instead of making a request that is expected to fail or would
+    add to an overload.
+
+    :ivar endpoint:
+        The endpoint template the call was for.
+    """
+
+    def __init__(self, message, endpoint=None, retry_after=None):
+        super(FastFailError, self).__init__(message)
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(FastFailError):
+    """
+    Raised when the circuit for an endpoint is open.
+
+    :ivar retry_after:
+        Seconds until the circuit lets a trial request through.
+    """
+
+
+class LoadShedError(FastFailError):
+    """
+    Raised when too many requests to an endpoint are already in flight.
+    """
+
+
+def is_failure(status_code):
+    """
+    Whether a response status counts against the circuit: server errors and
+    rate limiting do, client errors don't.
+    """
+    return status_code >= 500 or status_code == 429
+
+
+class _Circuit(object):
+    def __init__(self):
+        self.state = CLOSED
+        self.outcomes = deque()
+        self.failures = 0
+        self.opened_at = None
+        self.probes = 0
+        self.probe_successes = 0
+        # Incremented on every state change, so outcomes of requests
+        # admitted in an earlier state can be told apart.
+        self.generation = 0
+        self.in_flight = 0
+        self.rejected = 0
+
+
+class CircuitBreaker(object):
+    """
+    A circuit breaker with a separate circuit for each API endpoint
+    template (such as ``ticket/:id/notes``).
+
+    A circuit starts closed, letting requests through. Once at least
+    ``min_calls`` requests have been made in the last ``window`` seconds
+    and ``failure_rate`` or more of them failed, it opens: calls then fail
+    at once with :class:`CircuitOpenError` instead of waiting on a
+    struggling API. After ``reset_timeout`` seconds it becomes half-open
+    and lets up to ``half_open_calls`` trial requests through. If they all
+    succeed the circuit closes again; if any fails it reopens.
+
+    A request fails if it raises (for example on a connection error or
+    timeout) or gets a 5xx or 429 response.
+
+    With ``max_concurrent``, a call to an endpoint that already has that
+    many requests in flight fails at once with :class:`LoadShedError`, so
+    a slow API can't tie up every worker thread.
+
+    Listeners added with :meth:`add_listener` are called with
+    ``(endpoint, old_state, new_state)`` on every state change.
+
+    One breaker may be shared by several senders.
+
+    :param float failure_rate:
+        Fraction of failed requests that opens a circuit.
+    :param int min_calls:
+        Requests needed in the window before a circuit can open.
+    :param float window:
+        Seconds of recent requests considered.
+    :param float reset_timeout:
+        Seconds an open circuit waits before letting trial requests
+        through.
+    :param int half_open_calls:
+        Number of trial requests in the half-open state.
+    :param int max_concurrent:
+        Maximum requests in flight per endpoint. Defaults to ``None`` (no
+        limit).
+    :param clock:
+        Callable returning the current time in seconds. Defaults to
+        :func:`time.monotonic`.
+    """
+
+    def __init__(self, failure_rate=0.5, min_calls=10, window=30.0,
+                 reset_timeout=30.0, half_open_calls=1, max_concurrent=None,
+                 clock=time.monotonic):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.max_concurrent = max_concurrent
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._circuits = {}
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """
+        Call ``listener(endpoint, old_state, new_state)`` on state changes.
+        Listeners are called without the breaker's lock held.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _circuit(self, endpoint):
+        circuit = self._circuits.get(endpoint)
+        if circuit is None:
+            circuit = self._circuits[endpoint] = _Circuit()
+        return circuit
+
+    def _set_state(self, endpoint, circuit, state, now, changes):
+        if circuit.state == state:
+            return
+        changes.append((endpoint, circuit.state, state))
+        circuit.state = state
+        circuit.generation += 1
+        circuit.probes = 0
+        circuit.probe_successes = 0
+        if state == OPEN:
+            circuit.opened_at = now
+        else:
+            circuit.outcomes.clear()
+            circuit.failures = 0
+
+    def _notify(self, changes):
+        for change in changes:
+            for listener in list(self._listeners):
+                listener(*change)
+
+    def before(self, endpoint):
+        """
+        Check that a request to ``endpoint`` may be made, and count it as
+        in flight. Every successful call must be followed by :meth:`after`
+        or :meth:`release`, passing on the ticket returned.
+
+        :returns:
+            An opaque ticket identifying the state the request was admitted
+            in.
+
+        :raises CircuitOpenError:
+            If the endpoint's circuit is open.
+        :raises LoadShedError:
+            If too many requests to the endpoint are in flight.
+        """
+        changes = []
+        error = None
+        now = self.clock()
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if (circuit.state == OPEN and
+                    now - circuit.opened_at >= self.reset_timeout):
+                self._set_state(endpoint, circuit, HALF_OPEN, now, changes)
+            if circuit.state == OPEN:
+                error = CircuitOpenError(
+                    "Circuit open for %s" % (endpoint,), endpoint,
+                    circuit.opened_at + self.reset_timeout - now)
+            elif (circuit.state == HALF_OPEN and
+                    circuit.probes >= self.half_open_calls):
+                error = CircuitOpenError(
+                    "Circuit half-open for %s" % (endpoint,), endpoint, 0)
+            elif (self.max_concurrent is not None and
+                    circuit.in_flight >= self.max_concurrent):
+                error = LoadShedError(
+                    "Too many requests in flight for %s" % (endpoint,),
+                    endpoint)
+            else:
+                circuit.in_flight += 1
+                if circuit.state == HALF_OPEN:
+                    circuit.probes += 1
+                ticket = (circuit.state, circuit.generation)
+            if error is not None:
+                circuit.rejected += 1
+        self._notify(changes)
+        if error is not None:
+            raise error
+        return ticket
+
+    def after(self, endpoint, failed, ticket=None):
+        """
+        Record the outcome of a request allowed by :meth:`before`.
+
+        Outcomes of requests admitted before the circuit last changed state
+        are ignored, so only requests admitted as trial requests count
+        towards closing a half-open circuit.
+
+        :param bool failed:
+            Whether the request failed.
+        :param ticket:
+            The ticket returned by :meth:`before`. Without it the outcome
+            is taken to belong to the current state.
+        """
+        changes = []
+        now = self.clock()
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            circuit.in_flight -= 1
+            if self._admitted_now(circuit, ticket):
+                self._outcome(endpoint, circuit, failed, now, changes)
+        self._notify(changes)
+
+    def _outcome(self, endpoint, circuit, failed, now, changes):
+        if circuit.state == HALF_OPEN:
+            if failed:
+                self._set_state(endpoint, circuit, OPEN, now, changes)
+            else:
+                circuit.probe_successes += 1
+                if circuit.probe_successes >= self.half_open_calls:
+                    self._set_state(endpoint, circuit, CLOSED, now, changes)
+        elif circuit.state == CLOSED:
+            self._record(endpoint, circuit, failed, now, changes)
+
+    def _admitted_now(self, circuit, ticket):
+        return ticket is None or ticket == (circuit.state, circuit.generation)
+
+    def release(self, endpoint, ticket=None):
+        """
+        Stop counting a request allowed by :meth:`before` as in flight
+        without recording an outcome, for example when it was interrupted.
+        A trial request released this way lets another one through.
+        """
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            circuit.in_flight -= 1
+            if (circuit.state == HALF_OPEN and ticket is not None and
+                    self._admitted_now(circuit, ticket)):
+                circuit.probes -= 1
+
+    def _record(self, endpoint, circuit, failed, now, changes):
+        outcomes = circuit.outcomes
+        outcomes.append((now, failed))
+        circuit.failures += failed
+        while outcomes and outcomes[0][0] <= now - self.window:
+            circuit.failures -= outcomes.popleft()[1]
+        if (len(outcomes) >= self.min_calls and
+                circuit.failures >= self.failure_rate * len(outcomes)):
+            self._set_state(endpoint, circuit, OPEN, now, changes)
+
+    def state(self, endpoint):
+        """
+        :returns:
+            The state of the circuit for ``endpoint``: :data:`CLOSED`,
+            :data:`OPEN` or :data:`HALF_OPEN`. An open circuit whose reset
+            timeout has passed is reported as half-open.
+        """
+        with self._lock:
+            circuit = self._circuits.get(endpoint)
+            if circuit is None:
+                return CLOSED
+            if (circuit.state == OPEN and
+                    self.clock() - circuit.opened_at >= self.reset_timeout):
+                return HALF_OPEN
+            return circuit.state
+
+    def reset(self, endpoint=None):
+        """
+        Close the circuit for ``endpoint``, or every circuit.
+        """
+        changes = []
+        now = self.clock()
+        with self._lock:
+            endpoints = (
+                list(self._circuits) if endpoint is None else [endpoint])
+            for name in endpoints:
+                self._set_state(
+                    name, self._circuit(name), CLOSED, now, changes)
+        self._notify(changes)
+
+    def stats(self):
+        """
+        :returns:
+            A dict per endpoint with its ``state``, the ``calls`` and
+            ``failures`` in the current window, requests ``in_flight`` and
+            calls ``rejected`` so far.
+        """
+        with self._lock:
+            return dict(
+                (endpoint, {
+                    "state": circuit.state,
+                    "calls": len(circuit.outcomes),
+                    "failures": circuit.failures,
+                    "in_flight": circuit.in_flight,
+                    "rejected": circuit.rejected,
+                })
+                for endpoint, circuit in self._circuits.items())
+
+
+#: A call that failed fast, passed to fallbacks. ``name`` is the sender
+#: method called and ``kwargs`` its arguments.
+FallbackCall = namedtuple("FallbackCall", ["sender", "name", "kwargs"])
+
+
+class StaleCacheFallback(object):
+    """
+    A fallback that answers account, mailbox and staff lookups from expired
+    entries in the sender's cache. Other calls, and lookups that were never
+    cached, fail as before.
+    """
+
+    ENDPOINTS = {
+        "get_accounts": ("accounts", ()),
+        "get_mailboxes": ("mailboxes", ("account_id",)),
+        "get_staff": ("staff", ("account_id",)),
+    }
+
+    def __call__(self, call, error):
+        if call.name not in self.ENDPOINTS:
+            raise error
+        endpoint, arg_names = self.ENDPOINTS[call.name]
+        key = tuple(call.kwargs[name] for name in arg_names)
+        value = call.sender.get_cached(endpoint, key, stale=True)
+        if value is None:
+            raise error
+        return value
+
+
+class OutboxFallback(object):
+    """
+    A fallback that queues notes in a :class:`besnappy.outbox.NoteOutbox`
+    to be sent later, instead of failing. ``create_note`` returns ``None``
+    for queued notes. Other calls fail as before.
+
+    The note's ``idempotency_key``, if any, is used as its outbox
+    deduplication key.
+    """
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+
+    def __call__(self, call, error):
+        if call.name != "create_note":
+            raise error
+        kwargs = dict(call.kwargs)
+        kwargs["dedup_key"] = kwargs.pop("idempotency_key", None)
+        self.outbox.enqueue(**kwargs)
+        return None
@@ -0,0 +1,284 @@
+""" Caching helpers for Snappy API responses.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class _Flight(object):
+    """
+    A fetch in progress that other callers can wait on.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        # Set if the fetch was interrupted (for example by
+        # KeyboardInterrupt) rather than failing.
+        self.abandoned = False
+
+
+class TTLCache(object):
+    """
+    A thread-safe LRU cache whose entries expire after a time-to-live.
+
+    Concurrent :meth:`get_or_fetch` calls for the same missing key share a
+    single fetch: the first caller fetches and the others wait for its
+    result.
+
+    Expired entries are not returned by :meth:`get` but are kept until they
+    are evicted or replaced, so :meth:`get_stale` can still serve them.
+
+    :param int maxsize:
+        Maximum number of entries. The least recently used entry is evicted
+        when this is exceeded.
+    :param float ttl:
+        Default time-to-live in seconds.
+    :param clock:
+        Callable returning the current time in seconds. Defaults to
+        :func:`time.monotonic`.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key):
+        """
+        Return the entry for ``key`` if it is fresh. Must be called with the
+        lock held.
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= self.clock():
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, value, ttl):
+        """
+        Store an entry. Must be called with the lock held.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        self._entries[key] = (value, self.clock() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for ``key``, or ``default`` if it is missing
+        or expired.
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def get_stale(self, key, default=None):
+        """
+        Return the cached value for ``key`` even if it has expired, or
+        ``default`` if it is missing. Hit and miss counters are not updated.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache ``value`` under ``key`` for ``ttl`` seconds (defaults to the
+        cache's TTL).
+        """
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def get_or_fetch(self, key, fetch, ttl=None):
+        """
+        Return the cached value for ``key``, calling ``fetch()`` to fill the
+        cache if it is missing or expired.
+
+        If another thread is already fetching ``key``, wait for its result
+        instead of fetching again. Exceptions raised by ``fetch`` are raised
+        in every waiting caller and nothing is cached. If the fetch is
+        interrupted instead (by a :class:`BaseException` such as
+        :class:`KeyboardInterrupt`), one of the waiting callers fetches
+        again.
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[0]
+            flight = self._inflight.get(key)
+            if flight is None:
+                self.misses += 1
+                flight = self._inflight[key] = _Flight()
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            flight.event.wait()
+            if flight.abandoned:
+                return self.get_or_fetch(key, fetch, ttl)
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fetch()
+        except Exception as e:
+            flight.error = e
+            raise
+        except BaseException:
+            flight.abandoned = True
+            raise
+        else:
+            with self._lock:
+                self._store(key, flight.value, ttl)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+        return flight.value
+
+    def invalidate(self, key):
+        """
+        Remove ``key`` from the cache if it is present.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """
+        Remove every entry whose key satisfies ``predicate(key)``.
+        """
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Remove every entry from the cache. Counters are not reset.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :returns:
+            A dict of ``hits``, ``misses``, ``coalesced`` (callers that waited
+            on another caller's fetch), ``evictions`` and current ``size``.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+
+class RevalidationEntry(object):
+    """
+    Validators and decoded body remembered for one URL.
+    """
+
+    __slots__ = ("etag", "last_modified", "digest", "value")
+
+    def __init__(self, etag, last_modified, digest, value):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.digest = digest
+        self.value = value
+
+
+class RevalidationCache(object):
+    """
+    A thread-safe LRU store of :class:`RevalidationEntry` objects keyed by
+    URL, used for conditional GET requests.
+
+    :param int maxsize:
+        Maximum number of URLs remembered.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.not_modified = 0
+        self.unchanged = 0
+        self.changed = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, url):
+        """
+        Return the entry for ``url``, or ``None``.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def set(self, url, entry):
+        """
+        Remember ``entry`` for ``url``, evicting the least recently used URL
+        if necessary.
+        """
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, url):
+        """
+        Forget ``url`` if it is present.
+        """
+        with self._lock:
+            self._entries.pop(url, None)
+
+    def record(self, outcome):
+        """
+        Count a revalidation outcome: ``"not_modified"`` (the server sent a
+        304), ``"unchanged"`` (the body hash matched) or ``"changed"``.
+        """
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self):
+        """
+        :returns:
+            A dict of ``not_modified``, ``unchanged`` and ``changed`` counts
+            and the current ``size``.
+        """
+        with self._lock:
+            return {
+                "not_modified": self.not_modified,
+                "unchanged": self.unchanged,
+                "changed": self.changed,
+                "size": len(self._entries),
+            }
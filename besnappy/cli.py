@@ -0,0 +1,349 @@
+""" The ``besnappy`` command line tool.
+
+Only the standard library is imported at start up. The client and its
+dependencies are imported by the subcommands that use them, so ``--help``
+and argument errors are fast.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+
+class Progress(object):
+    """
+    Report progress and throughput of a bulk operation on a stream.
+
+    Updates overwrite each other on one line and are written at most every
+    ``interval`` seconds.
+
+    :param stream:
+        File to write to. ``None`` disables reporting.
+    :param float interval:
+        Minimum seconds between updates.
+    :param clock:
+        Callable returning the current time in seconds. Defaults to
+        :func:`time.monotonic`.
+    """
+
+    def __init__(self, stream, interval=0.5, clock=time.monotonic):
+        self.stream = stream
+        self.interval = interval
+        self.clock = clock
+        self.done = 0
+        self.failed = 0
+        self.started = clock()
+        self._reported = None
+
+    def update(self, failed=False):
+        """
+        Record one finished item.
+        """
+        self.done += 1
+        if failed:
+            self.failed += 1
+        now = self.clock()
+        if self._reported is None or now - self._reported >= self.interval:
+            self._report(now, "\r")
+
+    def rate(self, now=None):
+        """
+        :returns:
+            Items finished per second so far.
+        """
+        if now is None:
+            now = self.clock()
+        elapsed = now - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def finish(self):
+        """
+        Write the final totals.
+        """
+        self._report(self.clock(), "\r", "\n")
+
+    def _report(self, now, prefix, suffix=""):
+        self._reported = now
+        if self.stream is None:
+            return
+        self.stream.write("%s%d done, %d failed, %.1f/s%s" % (
+            prefix, self.done, self.failed, self.rate(now), suffix))
+        self.stream.flush()
+
+
+def _write_json(value, stream):
+    stream.write(json.dumps(value, separators=(",", ":")))
+    stream.write("\n")
+
+
+def _plain(value):
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    return value
+
+
+def _read_lines(path):
+    if path == "-":
+        for line in sys.stdin:
+            if line.strip():
+                yield line.strip()
+        return
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+
+
+def _csv_address(row, prefix):
+    address = row.pop(prefix + "_address", None)
+    name = row.pop(prefix + "_name", None)
+    if not address:
+        return None
+    addr = {"address": address}
+    if name:
+        addr["name"] = name
+    return [addr]
+
+
+#: CSV columns holding numeric ids, sent to the API as integers.
+CSV_ID_COLUMNS = ("mailbox_id", "staff_id", "ticket_id")
+
+
+def read_note_specs(path, input_format=None):
+    """
+    Read keyword arguments for
+    :meth:`besnappy.tickets.SnappyApiSender.create_note` from a file.
+
+    JSONL files have one JSON object of arguments per line. CSV files have
+    a header row naming the arguments; ``to_addr`` and ``from_addr`` are
+    given as ``to_address``, ``to_name``, ``from_address`` and
+    ``from_name`` columns, and empty cells are left out. All-digit
+    ``mailbox_id``, ``staff_id`` and ``ticket_id`` values are converted to
+    integers, as they would be in JSON; others, such as email addresses
+    to be looked up in the sender's directory, are kept as strings.
+
+    :param str path:
+        File to read, or ``-`` for stdin.
+    :param str input_format:
+        ``"csv"`` or ``"jsonl"``. Defaults to guessing from the file name,
+        falling back to JSONL.
+
+    :returns:
+        Iterator over dicts of arguments.
+    """
+    if input_format is None:
+        input_format = "csv" if path.lower().endswith(".csv") else "jsonl"
+    if input_format == "jsonl":
+        for line in _read_lines(path):
+            yield json.loads(line)
+        return
+
+    import csv
+    f = sys.stdin if path == "-" else open(path, newline="")
+    try:
+        for row in csv.DictReader(f):
+            row = dict((k, v) for k, v in row.items() if v)
+            for column in CSV_ID_COLUMNS:
+                value = row.get(column)
+                if value is not None and value.isdigit():
+                    row[column] = int(value)
+            for prefix in ("to", "from"):
+                addr = _csv_address(row, prefix)
+                if addr is not None:
+                    row[prefix + "_addr"] = addr
+            yield row
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _sender(args):
+    from .tickets import SnappyApiSender
+    return SnappyApiSender(
+        args.api_key, api_url=args.api_url, pool_maxsize=args.concurrency,
+        rate_limit=args.rate, timeout=args.timeout)
+
+
+def _progress(args):
+    return Progress(None if args.quiet else sys.stderr)
+
+
+def cmd_accounts(args):
+    for account in _sender(args).get_accounts():
+        _write_json(_plain(account), sys.stdout)
+    return 0
+
+
+def _per_account(args, method_name):
+    from .concurrency import bounded_map
+    sender = _sender(args)
+    method = getattr(sender, method_name)
+    status = 0
+    for account_id, records in bounded_map(
+            method, args.account_ids, args.concurrency):
+        if isinstance(records, Exception):
+            print("Account %s: %s" % (account_id, records), file=sys.stderr)
+            status = 1
+            continue
+        for record in records:
+            _write_json(_plain(record), sys.stdout)
+    return status
+
+
+def cmd_mailboxes(args):
+    return _per_account(args, "get_mailboxes")
+
+
+def cmd_staff(args):
+    return _per_account(args, "get_staff")
+
+
+def cmd_notes(args):
+    ticket_ids = args.ticket_ids
+    if args.tickets is not None:
+        ticket_ids = itertools.chain(ticket_ids, _read_lines(args.tickets))
+    progress = _progress(args)
+    results = _sender(args).iter_ticket_notes(ticket_ids, args.concurrency)
+    for ticket_id, notes in results:
+        failed = isinstance(notes, Exception)
+        if failed:
+            _write_json(
+                {"ticket_id": ticket_id, "error": str(notes)}, sys.stdout)
+        else:
+            _write_json({
+                "ticket_id": ticket_id,
+                "notes": [_plain(note) for note in notes],
+            }, sys.stdout)
+        progress.update(failed)
+    progress.finish()
+    return 1 if progress.failed else 0
+
+
+def cmd_create_notes(args):
+    progress = _progress(args)
+    specs = read_note_specs(args.input, args.input_format)
+    results = _sender(args).create_notes(specs, args.concurrency)
+    for line, result in enumerate(results, 1):
+        failed = isinstance(result, Exception)
+        if failed:
+            _write_json({"line": line, "error": str(result)}, sys.stdout)
+        else:
+            _write_json({"line": line, "ticket_id": result}, sys.stdout)
+        progress.update(failed)
+    progress.finish()
+    return 1 if progress.failed else 0
+
+
+def cmd_export(args):
+    from .export import ExportError, export
+    ticket_ids = () if args.tickets is None else _read_lines(args.tickets)
+    progress = _progress(args)
+    try:
+        stats = export(
+            _sender(args), args.output, ticket_ids,
+            concurrency=args.concurrency,
+            checkpoint_every=args.checkpoint_every,
+            progress=lambda stats: progress.update())
+    except ExportError as e:
+        progress.finish()
+        print(str(e), file=sys.stderr)
+        return 1
+    progress.finish()
+    if not args.quiet:
+        print("%d records written to %s" % (stats["records"], args.output),
+              file=sys.stderr)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="besnappy",
+        description="Command line client for the BeSnappy HTTP API.")
+    parser.add_argument(
+        "--api-key", default=os.environ.get("BESNAPPY_API_KEY"),
+        help="API key. Defaults to $BESNAPPY_API_KEY.")
+    parser.add_argument(
+        "--api-url", default=os.environ.get("BESNAPPY_API_URL"),
+        help="API URL. Defaults to $BESNAPPY_API_URL or the public API.")
+    parser.add_argument(
+        "--concurrency", type=int, default=4,
+        help="Requests in flight at once (default: %(default)s).")
+    parser.add_argument(
+        "--rate", type=float,
+        help="Maximum requests per second. Defaults to no limit.")
+    parser.add_argument(
+        "--timeout", type=float, default=60,
+        help="Seconds to wait for the API to respond (default: %(default)s).")
+    parser.add_argument(
+        "-q", "--quiet", action="store_true",
+        help="Don't report progress on stderr.")
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    subparsers.required = True
+
+    p = subparsers.add_parser("accounts", help="List accounts.")
+    p.set_defaults(func=cmd_accounts)
+
+    for name, func in [("mailboxes", cmd_mailboxes), ("staff", cmd_staff)]:
+        p = subparsers.add_parser(name, help="List %s in accounts." % (name,))
+        p.add_argument("account_ids", nargs="+", metavar="ACCOUNT_ID")
+        p.set_defaults(func=func)
+
+    p = subparsers.add_parser(
+        "notes", help="Fetch ticket notes, one JSON line per ticket.")
+    p.add_argument("ticket_ids", nargs="*", metavar="TICKET_ID")
+    p.add_argument(
+        "--tickets", metavar="FILE",
+        help="File of ticket identifiers, one per line, or - for stdin.")
+    p.set_defaults(func=cmd_notes)
+
+    p = subparsers.add_parser(
+        "create-notes", help="Create notes from a CSV or JSONL file.")
+    p.add_argument("input", help="Input file, or - for stdin.")
+    p.add_argument(
+        "--input-format", choices=["csv", "jsonl"],
+        help="Defaults to csv for .csv files and jsonl otherwise.")
+    p.set_defaults(func=cmd_create_notes)
+
+    p = subparsers.add_parser(
+        "export",
+        help="Export accounts, mailboxes, staff and ticket notes to"
+        " newline-delimited JSON. Rerun to resume an interrupted export.")
+    p.add_argument(
+        "output", help="Output file. Compressed if it ends with .gz.")
+    p.add_argument(
+        "--tickets", metavar="FILE",
+        help="File of ticket identifiers to export notes for, one per line,"
+        " or - for stdin.")
+    p.add_argument(
+        "--checkpoint-every", type=int, default=50,
+        help="Units of work between checkpoints (default: %(default)s).")
+    p.set_defaults(func=cmd_export)
+    return parser
+
+
+def main(argv=None):
+    """
+    Run the ``besnappy`` command.
+
+    :returns:
+        The exit status.
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.api_key:
+        parser.error("an API key is required (--api-key or BESNAPPY_API_KEY)")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    try:
+        return args.func(args)
+    except KeyboardInterrupt:
+        print("Interrupted", file=sys.stderr)
+        return 130
+    finally:
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+""" Routing API calls for many accounts to the right API key.
+"""
+import threading
+import time
+
+from .cache import TTLCache
+from .models import model_id
+from .ratelimit import shared_rate_limiter
+from .tickets import SnappyApiSender
+from .transport import build_session
+
+
+#: Sender arguments the pool sets itself, which can't be given in
+#: ``sender_options``.
+POOL_SENDER_OPTIONS = frozenset([
+    "api_key", "api_url", "session", "cache", "rate_limit",
+    "pool_connections", "pool_maxsize", "pool_block", "max_retries",
+    "keep_alive"])
+
+
+class SnappyClientPool(object):
+    """
+    A set of :class:`besnappy.tickets.SnappyApiSender` instances, one per
+    API key, that routes calls by account or mailbox to the right key.
+
+    All senders share one HTTP session, so connections to the API are
+    pooled across keys. Each key has its own rate limit budget. Senders are
+    created when a key is first used and are dropped after ``idle_timeout``
+    seconds without use; since the session, rate limiters and (if enabled)
+    cache are shared, recreating a sender is cheap.
+
+    Register keys with :meth:`add_key`, giving the accounts and mailboxes
+    they serve, or call :meth:`discover` to look them up from the API.
+
+    :param str api_url:
+        The full URL of the HTTP API. Defaults to the sender's default.
+    :type session:
+        :class:`requests.Session`
+    :param session:
+        Session to share between senders. Defaults to a new pooled session.
+    :param int pool_maxsize:
+        Maximum number of connections kept open to the API, shared by all
+        keys. Ignored if a session is provided.
+    :param float rate_limit:
+        Default requests per second allowed for each key. Defaults to
+        ``None`` (no limit). A rate in requests per second uses the
+        process-wide limiter for the key from
+        :func:`besnappy.ratelimit.shared_rate_limiter`, which is shared with
+        other pools and senders using the same key; they must all ask for
+        the same rate, or :class:`ValueError` is raised. Give a key its own
+        limiter with :meth:`add_key` to avoid this.
+    :param cache:
+        ``True`` to share a new :class:`besnappy.cache.TTLCache` between
+        the senders, or an existing cache. Defaults to ``None``.
+    :param float idle_timeout:
+        Seconds after which an unused sender is dropped.
+    :param clock:
+        Callable returning the current time in seconds. Defaults to
+        :func:`time.monotonic`.
+    :param sender_options:
+        Other keyword arguments for every
+        :class:`besnappy.tickets.SnappyApiSender`. Arguments the pool sets
+        itself (see :data:`POOL_SENDER_OPTIONS`) raise :class:`TypeError`.
+    """
+
+    def __init__(self, api_url=None, session=None, pool_maxsize=10,
+                 rate_limit=None, cache=None, idle_timeout=600,
+                 clock=time.monotonic, **sender_options):
+        conflicts = POOL_SENDER_OPTIONS.intersection(sender_options)
+        if conflicts:
+            raise TypeError(
+                "Sender options set by the pool can't be overridden: %s" % (
+                    ", ".join(sorted(conflicts)),))
+        self.api_url = api_url
+        if session is None:
+            session = build_session(pool_maxsize=pool_maxsize)
+        self.session = session
+        self.rate_limit = rate_limit
+        if cache is True:
+            cache = TTLCache()
+        self.cache = cache
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.sender_options = sender_options
+        self._lock = threading.Lock()
+        self._rate_limits = {}
+        self._account_keys = {}
+        self._mailbox_keys = {}
+        self._senders = {}
+        self._last_used = {}
+        self._last_sweep = clock()
+
+    def add_key(self, api_key, account_ids=(), mailbox_ids=(),
+                rate_limit=None):
+        """
+        Register an API key and the accounts and mailboxes it serves.
+
+        Calling this again for the same key adds to its routes.
+
+        :param rate_limit:
+            Requests per second for this key, overriding the pool default,
+            or a :class:`besnappy.ratelimit.TokenBucket` to use for this key
+            instead of the process-wide limiter.
+        """
+        with self._lock:
+            self._rate_limits.setdefault(api_key, self.rate_limit)
+            if rate_limit is not None:
+                self._rate_limits[api_key] = rate_limit
+            for account_id in account_ids:
+                self._account_keys[model_id(account_id)] = api_key
+            for mailbox_id in mailbox_ids:
+                self._mailbox_keys[model_id(mailbox_id)] = api_key
+
+    def keys(self):
+        """
+        :returns:
+            List of registered API keys.
+        """
+        with self._lock:
+            return list(self._rate_limits)
+
+    def sender(self, api_key):
+        """
+        Return the sender for a registered API key, creating it if needed.
+        """
+        now = self.clock()
+        with self._lock:
+            if api_key not in self._rate_limits:
+                raise KeyError("Unknown API key")
+            sender = self._senders.get(api_key)
+            if sender is None:
+                sender = self._senders[api_key] = self._make_sender(api_key)
+            self._last_used[api_key] = now
+            sweep = now - self._last_sweep >= self.idle_timeout
+        if sweep:
+            self.evict_idle()
+        return sender
+
+    def _make_sender(self, api_key):
+        limiter = self._rate_limits[api_key]
+        if limiter is not None and not hasattr(limiter, "acquire"):
+            limiter = shared_rate_limiter(api_key, limiter)
+        return SnappyApiSender(
+            api_key, api_url=self.api_url, session=self.session,
+            cache=self.cache, rate_limit=limiter, **self.sender_options)
+
+    def for_account(self, account_id):
+        """
+        Return the sender for the key serving ``account_id``.
+
+        :raises KeyError:
+            If no key is registered for the account.
+        """
+        account_id = model_id(account_id)
+        with self._lock:
+            api_key = self._account_keys.get(account_id)
+        if api_key is None:
+            raise KeyError("No API key for account %r" % (account_id,))
+        return self.sender(api_key)
+
+    def for_mailbox(self, mailbox_id):
+        """
+        Return the sender for the key serving ``mailbox_id``.
+
+        :raises KeyError:
+            If no key is registered for the mailbox.
+        """
+        mailbox_id = model_id(mailbox_id)
+        with self._lock:
+            api_key = self._mailbox_keys.get(mailbox_id)
+        if api_key is None:
+            raise KeyError("No API key for mailbox %r" % (mailbox_id,))
+        return self.sender(api_key)
+
+    def discover(self, api_key=None):
+        """
+        Look up the accounts and mailboxes each registered key (or just
+        ``api_key``) can use, and route them to it.
+        """
+        api_keys = self.keys() if api_key is None else [api_key]
+        for key in api_keys:
+            sender = self.sender(key)
+            account_ids = [
+                account["id"] for account in sender.get_accounts()]
+            mailbox_ids = [
+                mailbox["id"] for account_id in account_ids
+                for mailbox in sender.get_mailboxes(account_id)]
+            self.add_key(key, account_ids, mailbox_ids)
+
+    def evict_idle(self):
+        """
+        Drop senders that haven't been used for ``idle_timeout`` seconds.
+
+        :returns:
+            The number of senders dropped.
+        """
+        now = self.clock()
+        with self._lock:
+            self._last_sweep = now
+            idle = [
+                api_key for api_key, last_used in self._last_used.items()
+                if now - last_used >= self.idle_timeout]
+            for api_key in idle:
+                del self._senders[api_key]
+                del self._last_used[api_key]
+        return len(idle)
+
+    def stats(self):
+        """
+        :returns:
+            A dict with the number of registered ``keys``, ``accounts`` and
+            ``mailboxes`` and of active ``senders``.
+        """
+        with self._lock:
+            return {
+                "keys": len(self._rate_limits),
+                "accounts": len(self._account_keys),
+                "mailboxes": len(self._mailbox_keys),
+                "senders": len(self._senders),
+            }
+
+    def close(self):
+        """
+        Drop all senders and close the shared session.
+        """
+        with self._lock:
+            self._senders.clear()
+            self._last_used.clear()
+        self.session.close()
+
+    def get_mailboxes(self, account_id):
+        """
+        List mailboxes in an account, using the account's key.
+        """
+        return self.for_account(account_id).get_mailboxes(model_id(account_id))
+
+    def get_staff(self, account_id):
+        """
+        List staff in an account, using the account's key.
+        """
+        return self.for_account(account_id).get_staff(model_id(account_id))
+
+    def create_note(self, mailbox_id, subject, message, **kwargs):
+        """
+        Create a note using the key serving ``mailbox_id``. Other arguments
+        are as for :meth:`besnappy.tickets.SnappyApiSender.create_note`.
+        """
+        return self.for_mailbox(mailbox_id).create_note(
+            mailbox_id, subject, message, **kwargs)
@@ -0,0 +1,217 @@
+""" Coalescing many notes to the same ticket into one API call.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import threading
+import time
+
+from .tickets import build_note_data
+
+
+class _Batch(object):
+    """
+    Notes waiting to be merged into one note.
+    """
+
+    def __init__(self, data, deadline):
+        self.data = data
+        self.deadline = deadline
+        self.messages = []
+        self.futures = []
+        self.length = 0
+
+
+def _batch_key(data):
+    # Notes are only merged if everything but the subject and message
+    # matches, so no sender, recipient or scope is lost.
+    return json.dumps(
+        dict((k, v) for k, v in data.items()
+             if k not in ("subject", "message")),
+        sort_keys=True)
+
+
+class NoteCoalescer(object):
+    """
+    Merge notes added to the same ticket in quick succession into a single
+    note, cutting the number of API calls during bursts.
+
+    Notes given to :meth:`submit` for an existing ticket are held for up to
+    ``window`` seconds. Notes for the same mailbox, ticket and scope (and
+    the same sender and recipients) that arrive in that time are joined
+    into one note, using the first note's subject and the messages joined
+    by ``separator``, and posted once. A batch is posted early when it
+    reaches ``max_notes`` notes or when adding a message would make it
+    longer than ``max_length`` characters.
+
+    Notes that create a new ticket (no ``ticket_id``) are never merged, but
+    are still posted in the background.
+
+    Each call to :meth:`submit` returns a
+    :class:`concurrent.futures.Future` that resolves to the ticket
+    identifier, or to the exception raised when posting the merged note.
+    Cancelling a future before its batch is posted leaves its message out.
+
+    Call :meth:`close` when done to post any held notes.
+
+    :type sender:
+        :class:`besnappy.tickets.SnappyApiSender`
+    :param sender:
+        Sender used to post notes.
+    :param float window:
+        Maximum seconds a note is held waiting for others.
+    :param int max_notes:
+        Maximum number of notes merged into one.
+    :param int max_length:
+        Maximum length of a merged message, in characters. A single note
+        longer than this is posted on its own. Defaults to no limit.
+    :param str separator:
+        Text placed between merged messages.
+    :param int max_workers:
+        Maximum number of notes being posted at once.
+    """
+
+    def __init__(self, sender, window=1.0, max_notes=20, max_length=None,
+                 separator="\n\n", max_workers=4):
+        self.sender = sender
+        self.window = window
+        self.max_notes = max_notes
+        self.max_length = max_length
+        self.separator = separator
+        self.submitted = 0
+        self.posted = 0
+        self._cond = threading.Condition()
+        self._batches = {}
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._thread = threading.Thread(
+            target=self._run, name="besnappy-note-coalescer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, mailbox_id, subject, message, ticket_id=None,
+               to_addr=None, from_addr=None, staff_id=None, scope=None):
+        """
+        Queue a note to be created, possibly merged with others.
+
+        The parameters are the same as those of
+        :meth:`besnappy.tickets.SnappyApiSender.create_note`.
+
+        :returns:
+            A :class:`concurrent.futures.Future` for the ticket identifier.
+        """
+        data = build_note_data(
+            mailbox_id, subject, message, ticket_id=ticket_id,
+            to_addr=to_addr, from_addr=from_addr, staff_id=staff_id,
+            scope=scope)
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Coalescer is closed")
+            self.submitted += 1
+            if ticket_id is None:
+                self._post(data, [future])
+                return future
+            key = _batch_key(data)
+            batch = self._batches.get(key)
+            if batch is not None and self._would_overflow(batch, message):
+                self._post_batch(self._batches.pop(key))
+                batch = None
+            if batch is None:
+                batch = self._batches[key] = _Batch(
+                    data, time.monotonic() + self.window)
+                self._cond.notify()
+            batch.messages.append(message)
+            batch.futures.append(future)
+            batch.length += len(message)
+            if len(batch.futures) >= self.max_notes:
+                self._post_batch(self._batches.pop(key))
+        return future
+
+    def _would_overflow(self, batch, message):
+        if self.max_length is None:
+            return False
+        length = batch.length + len(self.separator) + len(message)
+        return length > self.max_length
+
+    def _post_batch(self, batch):
+        self._post(batch.data, batch.futures, batch.messages)
+
+    def _post(self, data, futures, messages=None):
+        self.posted += 1
+        self._executor.submit(self._send, data, futures, messages)
+
+    def _send(self, data, futures, messages):
+        running = [f.set_running_or_notify_cancel() for f in futures]
+        futures = [f for f, ok in zip(futures, running) if ok]
+        if not futures:
+            return
+        if messages is not None:
+            messages = [m for m, ok in zip(messages, running) if ok]
+            data = dict(data, message=self.separator.join(messages))
+        try:
+            ticket_id = self.sender.post_note(data)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for future in futures:
+                future.set_result(ticket_id)
+
+    def flush(self):
+        """
+        Post every held batch now.
+
+        :returns:
+            The number of batches posted.
+        """
+        with self._cond:
+            batches = list(self._batches.values())
+            self._batches.clear()
+            for batch in batches:
+                self._post_batch(batch)
+        return len(batches)
+
+    def pending(self):
+        """
+        :returns:
+            The number of notes being held.
+        """
+        with self._cond:
+            return sum(len(b.futures) for b in self._batches.values())
+
+    def close(self, wait=True):
+        """
+        Post every held batch and stop accepting notes.
+
+        :param bool wait:
+            Wait for the posts to finish.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+        self._executor.shutdown(wait=wait)
+
+    def _run(self):
+        with self._cond:
+            while not self._closed:
+                now = time.monotonic()
+                due = [key for key, batch in self._batches.items()
+                       if batch.deadline <= now]
+                for key in due:
+                    self._post_batch(self._batches.pop(key))
+                if self._batches:
+                    timeout = min(
+                        b.deadline for b in self._batches.values()) - now
+                    self._cond.wait(max(timeout, 0))
+                else:
+                    self._cond.wait()
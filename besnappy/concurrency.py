@@ -0,0 +1,99 @@
+""" Helpers for running blocking API calls concurrently.
+"""
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, wait)
+
+
+def _call(func, item):
+    try:
+        return func(item)
+    except Exception as e:
+        return e
+
+
+def bounded_map(func, items, max_workers, ordered=True, backlog=None):
+    """
+    Call ``func`` on each of ``items`` in a pool of worker threads.
+
+    Items are consumed lazily and at most ``backlog`` calls are pending at
+    any time, so arbitrarily long (or infinite) iterables can be processed
+    in bounded memory. If the consumer stops iterating, no further items are
+    submitted.
+
+    Exceptions raised by ``func`` don't stop the run; the exception instance
+    is yielded in place of the result.
+
+    :param func:
+        Callable taking a single item.
+    :param items:
+        Iterable of items.
+    :param int max_workers:
+        Number of worker threads.
+    :param bool ordered:
+        If ``True`` (the default), results are yielded in input order.
+        Otherwise they are yielded as they complete.
+    :param int backlog:
+        Maximum number of submitted but unconsumed calls. Defaults to twice
+        ``max_workers``.
+
+    :returns:
+        Iterator over ``(item, result_or_exception)`` pairs.
+    """
+    if max_workers < 1:
+        raise ValueError("max_workers must be at least 1")
+    if backlog is None:
+        backlog = max_workers * 2
+    backlog = max(backlog, max_workers)
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    if ordered:
+        results = _ordered(executor, func, items, backlog)
+    else:
+        results = _unordered(executor, func, items, backlog)
+    try:
+        for pair in results:
+            yield pair
+    finally:
+        # Closing the helper cancels the calls that haven't started, so
+        # shutting down only waits for the ones already running.
+        results.close()
+        executor.shutdown(wait=True)
+
+
+def _ordered(executor, func, items, backlog):
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(_call, func, item)))
+            if len(pending) >= backlog:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    finally:
+        for _item, future in pending:
+            future.cancel()
+
+
+def _unordered(executor, func, items, backlog):
+    pending = {}
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < backlog:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(_call, func, item)] = item
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
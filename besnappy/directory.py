@@ -0,0 +1,250 @@
+""" An in-memory index of mailboxes and staff for resolving note recipients.
+"""
+import threading
+import time
+
+from .concurrency import bounded_map
+
+
+def _normalise(value):
+    return value.strip().lower()
+
+
+def _add(index, key, record):
+    if not key:
+        return
+    key = _normalise(key)
+    matches = index.get(key)
+    if matches is None:
+        index[key] = (record,)
+    elif all(m["id"] != record["id"] for m in matches):
+        index[key] = matches + (record,)
+
+
+def _name(first_name, last_name):
+    return " ".join(name for name in (first_name, last_name) if name)
+
+
+class _Table(object):
+    """
+    Records of one kind indexed by id, email address and name. Never
+    changed once built.
+    """
+
+    def __init__(self, kind, records, email_fields, name_func):
+        self.kind = kind
+        self.by_id = {}
+        self.by_email = {}
+        self.by_name = {}
+        for record in records:
+            self.by_id.setdefault(record["id"], record)
+            for field in email_fields:
+                _add(self.by_email, record.get(field), record)
+            _add(self.by_name, name_func(record), record)
+
+    def lookup(self, key):
+        if key in self.by_id:
+            return self.by_id[key]
+        if not isinstance(key, str):
+            raise KeyError("No %s with id %r" % (self.kind, key))
+        if "@" in key:
+            index, what = self.by_email, "address"
+        else:
+            index, what = self.by_name, "name"
+        matches = index.get(_normalise(key))
+        if not matches:
+            raise KeyError("No %s with %s %r" % (self.kind, what, key))
+        if len(matches) > 1:
+            raise KeyError("%d %ss with %s %r" % (
+                len(matches), self.kind, what, key))
+        return matches[0]
+
+
+class _Snapshot(object):
+    def __init__(self, mailboxes, staff, built_at):
+        self.mailboxes = _Table(
+            "mailbox", mailboxes, ("address", "custom_address"),
+            lambda m: m.get("display"))
+        self.staff = _Table(
+            "staff member", staff, ("email", "address"),
+            lambda s: _name(s.get("first_name"), s.get("last_name")))
+        self.built_at = built_at
+
+
+class DirectoryIndex(object):
+    """
+    Mailboxes and staff indexed by id, email address and name, for turning
+    an address or name into a ``mailbox_id`` or ``staff_id`` without
+    scanning the lists from the API.
+
+    Lookups take a model id, an email address (anything containing ``@``,
+    matched case-insensitively) or a name (a mailbox's ``display`` name or
+    a staff member's first and last name, also case-insensitive). A name or
+    address shared by several records is ambiguous and raises
+    :class:`KeyError`, as does one that isn't found.
+
+    The index is built by the first lookup, or by calling :meth:`refresh`.
+    After that, lookups never wait for the API: once the index is older
+    than ``max_age`` seconds, a lookup starts a refresh in a background
+    thread and carries on with the current index, which the new one
+    replaces when it is ready. If a background refresh fails, the old index
+    stays in use and the error is kept in :attr:`last_error`.
+
+    :type sender:
+        :class:`besnappy.tickets.SnappyApiSender`
+    :param sender:
+        Sender used to list mailboxes and staff.
+    :param list account_ids:
+        Accounts to index. Defaults to every account from
+        :meth:`besnappy.tickets.SnappyApiSender.get_accounts`.
+    :param float max_age:
+        Seconds before the index is refreshed. ``None`` to only refresh
+        when :meth:`refresh` is called.
+    :param int concurrency:
+        Maximum number of accounts fetched at once.
+    :param clock:
+        Callable returning the current time in seconds. Defaults to
+        :func:`time.monotonic`.
+    """
+
+    def __init__(self, sender, account_ids=None, max_age=300.0,
+                 concurrency=4, clock=time.monotonic):
+        self.sender = sender
+        self.account_ids = account_ids
+        self.max_age = max_age
+        self.concurrency = concurrency
+        self.clock = clock
+        #: The exception raised by the last background refresh, if it
+        #: failed.
+        self.last_error = None
+        self.refreshes = 0
+        self._snapshot = None
+        self._refresh_due = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = None
+
+    def refresh(self):
+        """
+        Fetch mailboxes and staff and replace the index. Lookups in other
+        threads use the old index until this returns.
+
+        :returns:
+            A dict with the number of ``mailboxes`` and ``staff`` indexed.
+        """
+        with self._refresh_lock:
+            snapshot = self._build()
+        return {
+            "mailboxes": len(snapshot.mailboxes.by_id),
+            "staff": len(snapshot.staff.by_id),
+        }
+
+    def _build(self):
+        """
+        Fetch a new index and swap it in. Must be called with the refresh
+        lock held.
+        """
+        account_ids = self.account_ids
+        if account_ids is None:
+            account_ids = [
+                account["id"] for account in self.sender.get_accounts()]
+        mailboxes = []
+        staff = []
+        fetched = bounded_map(
+            lambda account_id: (
+                self.sender.get_mailboxes(account_id),
+                self.sender.get_staff(account_id)),
+            account_ids, self.concurrency)
+        for _account_id, result in fetched:
+            if isinstance(result, Exception):
+                raise result
+            mailboxes.extend(result[0])
+            staff.extend(result[1])
+        snapshot = _Snapshot(mailboxes, staff, self.clock())
+        # Readers pick up the new index on their next lookup; one already
+        # under way finishes with the old one.
+        self._snapshot = snapshot
+        if self.max_age is not None:
+            self._refresh_due = snapshot.built_at + self.max_age
+        self.refreshes += 1
+        return snapshot
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            self.last_error = e
+        else:
+            self.last_error = None
+        finally:
+            with self._lock:
+                self._refreshing = None
+
+    def _current(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._refresh_lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    snapshot = self._build()
+            return snapshot
+        if self._refresh_due is not None and self.clock() >= self._refresh_due:
+            with self._lock:
+                if self._refreshing is None:
+                    # A failed refresh is retried after another max_age.
+                    self._refresh_due = self.clock() + self.max_age
+                    self._refreshing = threading.Thread(
+                        target=self._background_refresh,
+                        name="besnappy-directory-refresh")
+                    self._refreshing.daemon = True
+                    self._refreshing.start()
+        return snapshot
+
+    def wait(self, timeout=None):
+        """
+        Wait for a background refresh, if one is running, to finish.
+        """
+        with self._lock:
+            thread = self._refreshing
+        if thread is not None:
+            thread.join(timeout)
+
+    def mailbox(self, key):
+        """
+        Look up a mailbox by id, address or display name.
+
+        :returns:
+            The mailbox record.
+
+        :raises KeyError:
+            If there is no such mailbox, or the name or address is
+            ambiguous.
+        """
+        return self._current().mailboxes.lookup(key)
+
+    def staff(self, key):
+        """
+        Look up a staff member by id, email address or full name.
+
+        :returns:
+            The staff record.
+
+        :raises KeyError:
+            If there is no such staff member, or the name or address is
+            ambiguous.
+        """
+        return self._current().staff.lookup(key)
+
+    def mailbox_id(self, key):
+        """
+        :returns:
+            The id of the mailbox found by :meth:`mailbox`.
+        """
+        return self.mailbox(key)["id"]
+
+    def staff_id(self, key):
+        """
+        :returns:
+            The id of the staff member found by :meth:`staff`.
+        """
+        return self.staff(key)["id"]
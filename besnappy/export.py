@@ -0,0 +1,289 @@
+""" Resumable export of Snappy data to newline-delimited JSON.
+"""
+import gzip
+import json
+import os
+import sys
+
+from .concurrency import bounded_map
+from .fileutil import write_json_atomic
+from .models import Model
+
+
+class ExportError(Exception):
+    """
+    Raised when an export stops because a request failed. The export can be
+    resumed by running it again.
+    """
+
+
+def _plain(value):
+    if isinstance(value, Model):
+        return value.to_dict()
+    return value
+
+
+class Exporter(object):
+    """
+    Export accounts, mailboxes, staff and ticket notes to a file of
+    newline-delimited JSON records.
+
+    Each line is an object with a ``type`` (``"account"``, ``"mailbox"``,
+    ``"staff"`` or ``"note"``), the ``account_id`` or ``ticket_id`` it
+    belongs to where there is one, and the API record as ``data``.
+
+    The work is split into units: the account list, the mailboxes and the
+    staff of each account, and the notes of each ticket. Units are fetched
+    concurrently but written in order, and only a bounded number are held
+    in memory at once. Progress is checkpointed every ``checkpoint_every``
+    units, recording how many units are done and how much of the output is
+    complete. Running an interrupted export again truncates the output to
+    the last checkpoint and carries on from there.
+
+    The Snappy API can't list the tickets in a mailbox, so the tickets to
+    export are given by the caller. A resumed export must be given the same
+    ticket identifiers in the same order.
+
+    :param sender:
+        The :class:`besnappy.tickets.SnappyApiSender` to fetch with.
+    :param str path:
+        Output file.
+    :param bool compress:
+        Write gzip-compressed output. Defaults to ``True`` if ``path`` ends
+        with ``.gz``. Each checkpoint starts a new gzip member, so the file
+        can be truncated at any checkpoint and remains a valid gzip file.
+    :param int concurrency:
+        Maximum number of units being fetched at once.
+    :param int checkpoint_every:
+        Number of units between checkpoints.
+    :param str checkpoint_path:
+        Checkpoint file. Defaults to ``path`` with ``.checkpoint`` appended.
+    :param progress:
+        Optional callable called with :meth:`stats` after each unit.
+    """
+
+    CHECKPOINT_VERSION = 1
+
+    def __init__(self, sender, path, compress=None, concurrency=4,
+                 checkpoint_every=50, checkpoint_path=None, progress=None):
+        self.sender = sender
+        self.path = path
+        if compress is None:
+            compress = path.endswith(".gz")
+        self.compress = compress
+        self.concurrency = concurrency
+        self.checkpoint_every = checkpoint_every
+        if checkpoint_path is None:
+            checkpoint_path = path + ".checkpoint"
+        self.checkpoint_path = checkpoint_path
+        self.progress = progress
+        self.units = 0
+        self.records = 0
+        self.resumed_from = 0
+        self._account_ids = None
+        self._raw = None
+        self._out = None
+        # The output offset, units and records after the last fully written
+        # unit that the output can be truncated back to, and whether a unit
+        # is being written.
+        self._safe = None
+        self._partial = False
+
+    def stats(self):
+        """
+        :returns:
+            A dict with the number of ``units`` and ``records`` written so
+            far (including those from before a resume) and the unit the
+            export ``resumed_from``.
+        """
+        return {
+            "units": self.units,
+            "records": self.records,
+            "resumed_from": self.resumed_from,
+        }
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return None
+        if checkpoint.get("version") != self.CHECKPOINT_VERSION:
+            raise ValueError(
+                "Unsupported checkpoint version: %r" % (
+                    checkpoint.get("version"),))
+        if checkpoint["compress"] != self.compress:
+            raise ValueError(
+                "Checkpoint is for %s output" % (
+                    "compressed" if checkpoint["compress"] else "plain",))
+        return checkpoint
+
+    def _open(self, checkpoint):
+        if checkpoint is None:
+            self._raw = open(self.path, "wb")
+        else:
+            self._raw = open(self.path, "r+b")
+            self._raw.truncate(checkpoint["offset"])
+            self._raw.seek(checkpoint["offset"])
+        self._safe = (self._raw.tell(), self.units, self.records)
+        self._start_member()
+
+    def _rollback(self):
+        """
+        Drop a partly written unit by truncating the output to the last
+        safe point. For compressed output that is the last checkpoint,
+        because a gzip member can't be cut short.
+        """
+        offset, self.units, self.records = self._safe
+        if self.compress:
+            # Detach the unfinished member so closing it doesn't write its
+            # trailer over the truncated output.
+            self._out.fileobj = None
+        self._raw.seek(offset)
+        self._raw.truncate()
+        self._start_member()
+
+    def _start_member(self):
+        if self.compress:
+            self._out = gzip.GzipFile(
+                fileobj=self._raw, mode="wb", compresslevel=6, mtime=0)
+        else:
+            self._out = self._raw
+
+    def _checkpoint(self, complete=False):
+        if self.compress:
+            # Closing the GzipFile finishes the member but leaves the
+            # underlying file open.
+            self._out.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        write_json_atomic(self.checkpoint_path, {
+            "version": self.CHECKPOINT_VERSION,
+            "compress": self.compress,
+            "units": self.units,
+            "records": self.records,
+            "offset": self._raw.tell(),
+            # The account list is only known once its unit is written.
+            "account_ids": self._account_ids if self.units else None,
+            "complete": complete,
+        })
+        self._safe = (self._raw.tell(), self.units, self.records)
+
+    def _write(self, records):
+        data = b"".join(
+            self.sender.codec.dumps(record) + b"\n" for record in records)
+        self._partial = True
+        self._out.write(data)
+        self.records += len(records)
+        self.units += 1
+        self._partial = False
+        if not self.compress:
+            self._safe = (self._raw.tell(), self.units, self.records)
+        if self.progress is not None:
+            self.progress(self.stats())
+
+    def _fetch_accounts(self):
+        accounts = [_plain(account) for account in self.sender.get_accounts()]
+        self._account_ids = [account["id"] for account in accounts]
+        return [{"type": "account", "data": account} for account in accounts]
+
+    def _fetch_unit(self, unit):
+        kind, key = unit
+        if kind == "mailboxes":
+            records = self.sender.get_mailboxes(key)
+            record_type, key_name = "mailbox", "account_id"
+        elif kind == "staff":
+            records = self.sender.get_staff(key)
+            record_type, key_name = "staff", "account_id"
+        else:
+            records = self.sender.get_ticket_notes(key)
+            record_type, key_name = "note", "ticket_id"
+        return [
+            {"type": record_type, key_name: key, "data": _plain(record)}
+            for record in records]
+
+    def _units(self, ticket_ids):
+        for account_id in self._account_ids:
+            yield ("mailboxes", account_id)
+            yield ("staff", account_id)
+        for ticket_id in ticket_ids:
+            yield ("notes", ticket_id)
+
+    def run(self, ticket_ids=()):
+        """
+        Run or resume the export.
+
+        :param ticket_ids:
+            Iterable of identifiers of tickets whose notes to export.
+
+        :returns:
+            The final :meth:`stats`.
+
+        :raises ExportError:
+            If fetching a unit fails. Progress up to the failed unit is
+            checkpointed first.
+        """
+        checkpoint = self._load_checkpoint()
+        if checkpoint is not None:
+            self.units = self.resumed_from = checkpoint["units"]
+            self.records = checkpoint["records"]
+            self._account_ids = checkpoint["account_ids"]
+            if checkpoint["complete"]:
+                return self.stats()
+        self._open(checkpoint)
+        try:
+            if self.units == 0:
+                self._write(self._fetch_accounts())
+            # Skip units written before the checkpoint, counting the
+            # account list as the first unit.
+            units = self._units(ticket_ids)
+            for _ in range(self.units - 1):
+                next(units)
+            results = bounded_map(self._fetch_unit, units, self.concurrency)
+            for unit, records in results:
+                if isinstance(records, Exception):
+                    raise ExportError(
+                        "Failed to fetch %s for %r: %r" % (
+                            unit[0], unit[1], records))
+                self._write(records)
+                if self.units % self.checkpoint_every == 0:
+                    self._checkpoint()
+                    self._start_member()
+        except BaseException:
+            # An interruption (such as KeyboardInterrupt) may arrive part
+            # way through writing a unit.
+            if self._partial:
+                self._rollback()
+            self._checkpoint()
+            raise
+        else:
+            self._checkpoint(complete=True)
+        finally:
+            self._raw.close()
+        return self.stats()
+
+
+def export(sender, path, ticket_ids=(), **kwargs):
+    """
+    Run or resume an export with an :class:`Exporter`. Keyword arguments
+    are passed to the exporter.
+
+    :returns:
+        The exporter's final :meth:`Exporter.stats`.
+    """
+    return Exporter(sender, path, **kwargs).run(ticket_ids)
+
+
+def main(argv=None):
+    """
+    Command line entry point: ``python -m besnappy.export`` is the same as
+    ``besnappy export``.
+    """
+    from .cli import main as cli_main
+    if argv is None:
+        argv = sys.argv[1:]
+    return cli_main(["export"] + list(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
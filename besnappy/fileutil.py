@@ -0,0 +1,23 @@
+""" File helpers shared by the besnappy modules that persist state.
+"""
+import json
+import os
+import tempfile
+
+
+def write_json_atomic(path, value):
+    """
+    Write ``value`` to ``path`` as JSON.
+
+    The file is replaced atomically, so a crash while writing leaves the
+    previous contents intact.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".besnappy-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
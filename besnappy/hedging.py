@@ -0,0 +1,209 @@
+""" Timeouts, deadlines and hedged requests for tail-latency control.
+"""
+from collections import deque
+import math
+import threading
+import time
+
+from requests.exceptions import Timeout
+
+
+class DeadlineExceeded(Timeout):
+    """
+    Raised when a call's deadline passes before it could make another
+    request. A subclass of :class:`requests.exceptions.Timeout`.
+    """
+
+
+def attempt_timeout(timeout, expires, clock=time.monotonic):
+    """
+    Work out the timeout for one request of a call.
+
+    :param timeout:
+        The configured timeout: ``None``, seconds, or a
+        ``(connect, read)`` tuple as accepted by :mod:`requests`.
+    :param float expires:
+        When the call's deadline passes, by ``clock``, or ``None``.
+
+    :returns:
+        ``timeout`` with each part capped at the time left before the
+        deadline.
+
+    :raises DeadlineExceeded:
+        If the deadline has passed.
+    """
+    if expires is None:
+        return timeout
+    remaining = expires - clock()
+    if remaining <= 0:
+        raise DeadlineExceeded("Deadline exceeded")
+    if isinstance(timeout, tuple):
+        return tuple(
+            remaining if part is None else min(part, remaining)
+            for part in timeout)
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+
+class LatencyTracker(object):
+    """
+    Track recent latencies and report percentiles.
+
+    Keeps the last ``window`` samples. Percentiles are recomputed after
+    every ``refresh`` new samples rather than on every query.
+
+    :param int window:
+        Number of recent samples kept.
+    :param int refresh:
+        New samples between recomputing percentiles.
+    """
+
+    def __init__(self, window=1000, refresh=32):
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+        self._sorted = []
+        self._stale = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._samples)
+
+    def observe(self, value):
+        with self._lock:
+            self._samples.append(value)
+            self._stale += 1
+
+    def percentile(self, percentile):
+        """
+        :param float percentile:
+            Percentile to report, between 0 and 100.
+
+        :returns:
+            The nearest-rank percentile of recent samples, or ``None`` if
+            there are none.
+        """
+        with self._lock:
+            if self._stale >= self.refresh or (
+                    self._stale and len(self._sorted) < self.refresh):
+                self._sorted = sorted(self._samples)
+                self._stale = 0
+            if not self._sorted:
+                return None
+            rank = int(math.ceil(percentile / 100.0 * len(self._sorted)))
+            return self._sorted[max(rank, 1) - 1]
+
+
+class HedgePolicy(object):
+    """
+    When to send a second, hedged copy of a slow idempotent request.
+
+    Latencies are tracked per endpoint. Once an endpoint has at least
+    ``min_samples`` of them, a request to it that hasn't answered within
+    the ``percentile`` latency is sent again, and whichever response
+    arrives first is used. The delay is kept between ``min_delay`` and
+    ``max_delay``.
+
+    To keep hedging from adding much load when the API is slow across the
+    board, no more than ``max_ratio`` of requests are hedged.
+
+    :param float percentile:
+        Latency percentile after which to hedge.
+    :param int min_samples:
+        Samples needed for an endpoint before its requests are hedged.
+    :param float min_delay:
+        Minimum seconds to wait before hedging.
+    :param float max_delay:
+        Maximum seconds to wait before hedging, or ``None``.
+    :param float max_ratio:
+        Maximum fraction of requests that may be hedged.
+    :param int max_workers:
+        Requests that may be waiting for a hedge at once, and hedges that
+        may be in flight at once, across all calls through one sender. Each
+        has a thread from a pool shared by the sender. Requests beyond the
+        limit are sent from the calling thread and not hedged.
+    :param int window:
+        Number of recent latencies kept per endpoint.
+    """
+
+    def __init__(self, percentile=95, min_samples=20, min_delay=0.01,
+                 max_delay=None, max_ratio=0.1, max_workers=32,
+                 window=1000):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_ratio = max_ratio
+        self.max_workers = max_workers
+        self.window = window
+        self._lock = threading.Lock()
+        self._trackers = {}
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def _tracker(self, endpoint):
+        with self._lock:
+            tracker = self._trackers.get(endpoint)
+            if tracker is None:
+                tracker = self._trackers[endpoint] = LatencyTracker(
+                    self.window)
+            return tracker
+
+    def observe(self, endpoint, elapsed):
+        """
+        Record the latency of a response from ``endpoint``.
+        """
+        self._tracker(endpoint).observe(elapsed)
+
+    def delay(self, endpoint):
+        """
+        Count a request to ``endpoint`` and decide whether it may be hedged.
+
+        :returns:
+            Seconds to wait before hedging, or ``None`` not to hedge.
+        """
+        tracker = self._tracker(endpoint)
+        with self._lock:
+            self.requests += 1
+            if self.hedged >= self.max_ratio * self.requests:
+                return None
+        if len(tracker) < self.min_samples:
+            return None
+        delay = max(tracker.percentile(self.percentile), self.min_delay)
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        return delay
+
+    def record(self, hedge_won):
+        """
+        Record that a request was hedged and which copy answered first.
+        """
+        with self._lock:
+            self.hedged += 1
+            if hedge_won:
+                self.hedge_wins += 1
+
+    def latency(self, endpoint):
+        """
+        :returns:
+            The current hedging percentile latency for ``endpoint``, or
+            ``None`` if there are no samples.
+        """
+        return self._tracker(endpoint).percentile(self.percentile)
+
+    def stats(self):
+        """
+        :returns:
+            A dict with the number of ``requests`` considered, how many were
+            ``hedged``, and how many of those the ``hedge_wins`` or
+            ``primary_wins``.
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "primary_wins": self.hedged - self.hedge_wins,
+            }
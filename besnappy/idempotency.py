@@ -0,0 +1,151 @@
+""" Suppression of duplicate note submissions.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from .cache import TTLCache
+
+
+def note_fingerprint(data):
+    """
+    Return a key identifying a note request body built by
+    :func:`besnappy.tickets.build_note_data`.
+
+    The key covers every field of the body (mailbox, subject, message,
+    addresses, ticket, staff and scope), so two submissions get the same
+    key only if they would create the same note.
+    """
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency (
+    key TEXT PRIMARY KEY,
+    ticket_id TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+class IdempotencyCache(object):
+    """
+    Remembers which ticket each recent note submission created.
+
+    A submission whose key was seen within ``window`` seconds returns the
+    original ticket identifier without another API call. Identical
+    submissions made at the same time share a single call. Failed
+    submissions aren't remembered, so they can be retried; note that a
+    submission that failed after the server processed it (a timeout, say)
+    can still create a duplicate when retried.
+
+    :param int maxsize:
+        Maximum number of submissions remembered in memory. The least
+        recently used are forgotten first.
+    :param float window:
+        Seconds a submission is remembered for.
+    :param str path:
+        Optional SQLite database file to persist outcomes in, so that they
+        are remembered across restarts. Outcomes still within the window
+        are loaded when the cache is created.
+    :param clock:
+        Callable returning the current time in seconds since the epoch.
+        Defaults to :func:`time.time`.
+    """
+
+    def __init__(self, maxsize=10000, window=600, path=None,
+                 clock=time.time):
+        self.window = window
+        self.path = path
+        self.clock = clock
+        self._cache = TTLCache(maxsize=maxsize, ttl=window, clock=clock)
+        self._conn = None
+        self._lock = threading.Lock()
+        self._writes = 0
+        if path is not None:
+            self._conn = sqlite3.connect(
+                path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+            self._load()
+
+    def _load(self):
+        now = self.clock()
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM idempotency WHERE expires_at <= ?", (now,))
+            rows = self._conn.execute(
+                "SELECT key, ticket_id, expires_at FROM idempotency"
+                " ORDER BY expires_at DESC LIMIT ?",
+                (self._cache.maxsize,)).fetchall()
+        for key, ticket_id, expires_at in reversed(rows):
+            self._cache.set(key, ticket_id, expires_at - now)
+
+    def _persist(self, key, ticket_id):
+        now = self.clock()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO idempotency"
+                " (key, ticket_id, expires_at) VALUES (?, ?, ?)",
+                (key, ticket_id, now + self.window))
+            # Expired rows are only read past, so clear them out now and
+            # then rather than on every write.
+            self._writes += 1
+            if self._writes % self._cache.maxsize == 0:
+                self._conn.execute(
+                    "DELETE FROM idempotency WHERE expires_at <= ?", (now,))
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+
+    def create(self, key, create):
+        """
+        Return the ticket identifier remembered for ``key``, or call
+        ``create()`` to create the note and remember its result.
+        """
+        def fetch():
+            ticket_id = create()
+            if self._conn is not None:
+                self._persist(key, ticket_id)
+            return ticket_id
+
+        return self._cache.get_or_fetch(key, fetch)
+
+    def get(self, key):
+        """
+        :returns:
+            The ticket identifier remembered for ``key``, or ``None``.
+        """
+        return self._cache.get(key)
+
+    def forget(self, key):
+        """
+        Forget the outcome for ``key`` so the next submission is sent.
+        """
+        self._cache.invalidate(key)
+        if self._conn is not None:
+            with self._lock:
+                self._conn.execute(
+                    "DELETE FROM idempotency WHERE key = ?", (key,))
+
+    def stats(self):
+        """
+        :returns:
+            A dict of ``duplicates`` (submissions answered from memory),
+            ``coalesced`` (submissions that waited for an identical one in
+            progress), ``sent`` (submissions passed on to the API) and
+            current ``size``.
+        """
+        stats = self._cache.stats()
+        return {
+            "duplicates": stats["hits"],
+            "coalesced": stats["coalesced"],
+            "sent": stats["misses"],
+            "size": stats["size"],
+        }
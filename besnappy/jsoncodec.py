@@ -0,0 +1,105 @@
+""" Pluggable JSON encoding and decoding.
+
+The clients encode request bodies and decode response bodies through a
+codec object with two methods:
+
+``dumps(value)``
+    Encode a value as UTF-8 JSON bytes.
+``loads(data)``
+    Decode JSON from bytes (or a string).
+
+:func:`get_codec` picks the fastest installed backend: `orjson`_, then
+`ujson`_, then the standard library's :mod:`json`.
+
+.. _orjson: https://pypi.org/project/orjson/
+.. _ujson: https://pypi.org/project/ujson/
+"""
+import json
+
+
+class StdlibCodec(object):
+    """
+    A codec using the standard library's :mod:`json` module.
+    """
+
+    name = "json"
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(object):
+    """
+    A codec using :mod:`orjson`, which encodes straight to bytes.
+    """
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.dumps = orjson.dumps
+        self.loads = orjson.loads
+
+
+class UjsonCodec(object):
+    """
+    A codec using :mod:`ujson`.
+    """
+
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+        self.loads = ujson.loads
+
+    def dumps(self, value):
+        return self._ujson.dumps(value, ensure_ascii=False).encode("utf-8")
+
+
+#: Codec classes by name, fastest first.
+CODECS = [
+    ("orjson", OrjsonCodec),
+    ("ujson", UjsonCodec),
+    ("json", StdlibCodec),
+]
+
+_default = None
+
+
+def get_codec(codec=None):
+    """
+    Return a codec.
+
+    :param codec:
+        ``None`` or ``"auto"`` for the fastest installed backend, the name
+        of a backend (``"orjson"``, ``"ujson"`` or ``"json"``), or a codec
+        object, which is returned unchanged.
+
+    :raises ValueError:
+        If the name is unknown.
+    :raises ImportError:
+        If the named backend isn't installed.
+    """
+    global _default
+    if codec is None or codec == "auto":
+        if _default is None:
+            _default = _detect()
+        return _default
+    if not isinstance(codec, str):
+        return codec
+    for name, cls in CODECS:
+        if name == codec:
+            return cls()
+    raise ValueError("Unknown JSON codec: %r" % (codec,))
+
+
+def _detect():
+    for _name, cls in CODECS:
+        try:
+            return cls()
+        except ImportError:
+            pass
@@ -0,0 +1,135 @@
+""" Incremental decoding of JSON arrays from a stream of chunks.
+"""
+import codecs
+import json
+
+
+_WHITESPACE = " \t\n\r"
+_DELIMITERS = _WHITESPACE + ",]"
+
+# Drop consumed text from the front of the buffer once this much has built
+# up, so we don't copy the buffer after every element.
+_TRIM_THRESHOLD = 64 * 1024
+
+
+class _Buffer(object):
+    """
+    Text decoded from a byte stream, consumed from the front.
+    """
+
+    def __init__(self, chunks, encoding):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Read another chunk. Returns ``False`` at the end of the stream.
+        """
+        if self.eof:
+            return False
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                self._append(text)
+                return True
+        self._append(self._decoder.decode(b"", final=True))
+        self.eof = True
+        return False
+
+    def _append(self, text):
+        if self.pos >= _TRIM_THRESHOLD:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        self.text += text
+
+    def skip_whitespace(self):
+        """
+        Advance past whitespace and return the next character, or ``""`` at
+        the end of the stream.
+        """
+        while True:
+            text, pos = self.text, self.pos
+            while pos < len(text) and text[pos] in _WHITESPACE:
+                pos += 1
+            self.pos = pos
+            if pos < len(text):
+                return text[pos]
+            if not self.fill():
+                return ""
+
+
+def iter_json_array(chunks, encoding="utf-8", decoder=None):
+    """
+    Decode the elements of a JSON array one at a time from an iterable of
+    byte chunks.
+
+    Only one element (plus one chunk) is held in memory at a time, so memory
+    use depends on the size of the largest element rather than the size of
+    the whole array.
+
+    :param chunks:
+        Iterable of :class:`bytes` making up a JSON document whose top-level
+        value is an array.
+    :param str encoding:
+        Character encoding of the document.
+    :param decoder:
+        A :class:`json.JSONDecoder` to decode elements with.
+
+    :returns:
+        Iterator over the decoded array elements.
+
+    :raises ValueError:
+        If the document isn't a well-formed JSON array.
+    """
+    if decoder is None:
+        decoder = json.JSONDecoder()
+    buf = _Buffer(chunks, encoding)
+    if buf.skip_whitespace() != "[":
+        raise ValueError("Expected a JSON array")
+    buf.pos += 1
+    if buf.skip_whitespace() == "]":
+        buf.pos += 1
+    else:
+        while True:
+            yield _decode_element(buf, decoder)
+            char = buf.skip_whitespace()
+            if char == "]":
+                buf.pos += 1
+                break
+            if char != ",":
+                raise ValueError(
+                    "Expected ',' or ']' in JSON array, got %r" % (char,))
+            buf.pos += 1
+    if buf.skip_whitespace() != "":
+        raise ValueError("Unexpected data after JSON array")
+
+
+def _decode_element(buf, decoder):
+    """
+    Decode the value starting at the buffer position, reading more chunks
+    as needed.
+    """
+    if buf.skip_whitespace() == "":
+        raise ValueError("Unexpected end of JSON array")
+    while True:
+        try:
+            value, end = decoder.raw_decode(buf.text, buf.pos)
+        except ValueError:
+            if buf.eof:
+                raise
+        else:
+            # A number may continue in the next chunk (and "1." or "1e" at
+            # the end of a chunk decode as 1), so only accept a value once we
+            # can see the delimiter that follows it.
+            if buf.eof or (
+                    end < len(buf.text) and buf.text[end] in _DELIMITERS):
+                buf.pos = end
+                return value
+        # Wait until the pending text has at least doubled before trying
+        # again, so a large element isn't re-parsed for every chunk.
+        pending = len(buf.text) - buf.pos
+        while len(buf.text) - buf.pos < 2 * pending and buf.fill():
+            pass
@@ -0,0 +1,265 @@
+""" Request instrumentation for the Snappy API client.
+"""
+import threading
+
+
+#: Default histogram bucket upper bounds, in seconds.
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_ID_PARENTS = frozenset(["account", "mailbox", "ticket"])
+
+
+def endpoint_template(endpoint):
+    """
+    Replace identifiers in an API endpoint with ``:id`` so that metrics are
+    grouped per endpoint rather than per resource.
+
+    For example, ``ticket/abc123/notes/`` becomes ``ticket/:id/notes``.
+    """
+    parts = [part for part in endpoint.split("/") if part]
+    for i in range(1, len(parts)):
+        if parts[i - 1] in _ID_PARENTS:
+            parts[i] = ":id"
+    return "/".join(parts)
+
+
+class Metrics(object):
+    """
+    Instrumentation hooks called by
+    :class:`besnappy.tickets.SnappyApiSender`.
+
+    Every hook does nothing; subclass this and override the hooks you need.
+    Hooks may be called from several threads at once. ``endpoint`` is
+    always an :func:`endpoint_template`.
+    """
+
+    def request_finished(self, endpoint, method, status, elapsed,
+                         headers_elapsed, bytes_sent, bytes_received):
+        """
+        Called after each HTTP response, including ones that are retried.
+
+        :param int status:
+            HTTP status code.
+        :param float elapsed:
+            Seconds from sending the request until the body was read.
+        :param float headers_elapsed:
+            Seconds from sending the request until the response headers
+            were parsed. This includes connection setup.
+        :param int bytes_sent:
+            Size of the request body.
+        :param int bytes_received:
+            Size of the response body, or ``None`` for streamed responses.
+        """
+
+    def request_failed(self, endpoint, method, error, elapsed):
+        """
+        Called when a request fails without an HTTP response, for example
+        because the connection failed.
+        """
+
+    def request_retried(self, endpoint, method, status, delay):
+        """
+        Called before a request is retried after a response with
+        ``status``, ``delay`` seconds from now.
+        """
+
+    def response_decoded(self, endpoint, elapsed):
+        """
+        Called after a response body has been decoded, with the time taken.
+        """
+
+    def request_hedged(self, endpoint, method, winner):
+        """
+        Called when a slow request was sent a second time, with the copy
+        that answered first: ``"primary"`` or ``"hedge"``.
+        """
+
+
+class Histogram(object):
+    """
+    A cumulative histogram in the style of Prometheus.
+
+    Not thread-safe; callers must synchronise updates.
+
+    :param buckets:
+        Sorted bucket upper bounds. An implicit ``+Inf`` bucket is added.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        :returns:
+            List of ``(upper_bound, cumulative_count)`` pairs, ending with
+            ``("+Inf", count)``.
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        result.append(("+Inf", self.count))
+        return result
+
+
+class InMemoryMetrics(Metrics):
+    """
+    A :class:`Metrics` implementation that keeps counters and histograms in
+    memory, keyed by ``(endpoint, method)``.
+
+    :param buckets:
+        Histogram bucket upper bounds, in seconds.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.headers_latency = {}
+        self.decode_time = {}
+        self.statuses = {}
+        self.bytes_sent = {}
+        self.bytes_received = {}
+        self.retries = {}
+        self.errors = {}
+        self.hedges = {}
+
+    def _histogram(self, histograms, key):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(self.buckets)
+        return histogram
+
+    @staticmethod
+    def _inc(counters, key, amount=1):
+        counters[key] = counters.get(key, 0) + amount
+
+    def request_finished(self, endpoint, method, status, elapsed,
+                         headers_elapsed, bytes_sent, bytes_received):
+        key = (endpoint, method)
+        with self._lock:
+            self._histogram(self.latency, key).observe(elapsed)
+            self._histogram(self.headers_latency, key).observe(
+                headers_elapsed)
+            self._inc(self.statuses, key + (status,))
+            self._inc(self.bytes_sent, key, bytes_sent)
+            if bytes_received is not None:
+                self._inc(self.bytes_received, key, bytes_received)
+
+    def request_failed(self, endpoint, method, error, elapsed):
+        with self._lock:
+            self._inc(self.errors, (endpoint, method, type(error).__name__))
+
+    def request_retried(self, endpoint, method, status, delay):
+        with self._lock:
+            self._inc(self.retries, (endpoint, method, status))
+
+    def response_decoded(self, endpoint, elapsed):
+        with self._lock:
+            self._histogram(self.decode_time, (endpoint,)).observe(elapsed)
+
+    def request_hedged(self, endpoint, method, winner):
+        with self._lock:
+            self._inc(self.hedges, (endpoint, method, winner))
+
+    def request_count(self, endpoint=None, method=None):
+        """
+        :returns:
+            Number of responses received, optionally filtered by endpoint
+            template and method.
+        """
+        with self._lock:
+            return sum(
+                count for (e, m, _), count in self.statuses.items()
+                if (endpoint is None or e == endpoint) and
+                (method is None or m == method))
+
+
+def _escape(value):
+    return (
+        str(value).replace("\\", "\\\\").replace("\n", "\\n")
+        .replace('"', '\\"'))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    return "{%s}" % (",".join(
+        '%s="%s"' % (name, _escape(value)) for name, value in pairs),)
+
+
+def prometheus_text(metrics, prefix="besnappy"):
+    """
+    Render an :class:`InMemoryMetrics` in the Prometheus text exposition
+    format.
+
+    :returns:
+        The exposition text, ending with a newline.
+    """
+    lines = []
+
+    def histogram(name, help_text, histograms, label_names):
+        lines.append("# HELP %s_%s %s" % (prefix, name, help_text))
+        lines.append("# TYPE %s_%s histogram" % (prefix, name))
+        for key, hist in sorted(histograms.items()):
+            for bound, count in hist.cumulative():
+                lines.append("%s_%s_bucket%s %d" % (
+                    prefix, name, _labels(label_names, key, [("le", bound)]),
+                    count))
+            labels = _labels(label_names, key)
+            lines.append("%s_%s_sum%s %r" % (prefix, name, labels, hist.sum))
+            lines.append("%s_%s_count%s %d" % (
+                prefix, name, labels, hist.count))
+
+    def counter(name, help_text, counters, label_names):
+        lines.append("# HELP %s_%s %s" % (prefix, name, help_text))
+        lines.append("# TYPE %s_%s counter" % (prefix, name))
+        for key, value in sorted(counters.items()):
+            lines.append("%s_%s%s %d" % (
+                prefix, name, _labels(label_names, key), value))
+
+    with metrics._lock:
+        histogram(
+            "request_duration_seconds",
+            "Time from sending a request until its body was read.",
+            metrics.latency, ("endpoint", "method"))
+        histogram(
+            "response_headers_duration_seconds",
+            "Time from sending a request until its response headers arrived.",
+            metrics.headers_latency, ("endpoint", "method"))
+        histogram(
+            "decode_duration_seconds",
+            "Time spent decoding response bodies.",
+            metrics.decode_time, ("endpoint",))
+        counter(
+            "responses_total", "HTTP responses received.",
+            metrics.statuses, ("endpoint", "method", "status"))
+        counter(
+            "request_bytes_total", "Request body bytes sent.",
+            metrics.bytes_sent, ("endpoint", "method"))
+        counter(
+            "response_bytes_total", "Response body bytes received.",
+            metrics.bytes_received, ("endpoint", "method"))
+        counter(
+            "retries_total", "Requests retried, by response status.",
+            metrics.retries, ("endpoint", "method", "status"))
+        counter(
+            "request_errors_total", "Requests that failed without a response.",
+            metrics.errors, ("endpoint", "method", "error"))
+        counter(
+            "hedged_requests_total",
+            "Slow requests sent a second time, by which copy answered first.",
+            metrics.hedges, ("endpoint", "method", "winner"))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,453 @@
+""" A local SQLite mirror of Snappy accounts, staff and ticket notes.
+"""
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from .concurrency import bounded_map
+from .models import Model, parse_timestamp
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER PRIMARY KEY,
+    organization TEXT,
+    domain TEXT,
+    data TEXT NOT NULL,
+    synced_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mailboxes (
+    id INTEGER PRIMARY KEY,
+    account_id INTEGER,
+    address TEXT,
+    display TEXT,
+    data TEXT NOT NULL,
+    synced_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mailboxes_account ON mailboxes (account_id);
+CREATE TABLE IF NOT EXISTS staff (
+    account_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    email TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    data TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (account_id, id)
+);
+CREATE INDEX IF NOT EXISTS staff_id ON staff (id);
+CREATE INDEX IF NOT EXISTS staff_email ON staff (email);
+CREATE TABLE IF NOT EXISTS tickets (
+    id TEXT PRIMARY KEY,
+    mailbox_id INTEGER,
+    account_id INTEGER,
+    note_count INTEGER NOT NULL DEFAULT 0,
+    digest TEXT,
+    synced_at REAL
+);
+CREATE INDEX IF NOT EXISTS tickets_mailbox ON tickets (mailbox_id);
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    ticket_id TEXT NOT NULL,
+    account_id INTEGER,
+    scope TEXT,
+    staff_id INTEGER,
+    contact_id INTEGER,
+    system INTEGER,
+    created_at REAL,
+    updated_at REAL,
+    content TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notes_ticket ON notes (ticket_id, created_at);
+CREATE INDEX IF NOT EXISTS notes_staff ON notes (staff_id, created_at);
+CREATE INDEX IF NOT EXISTS notes_created ON notes (created_at);
+"""
+
+# An external content FTS5 table over notes.content, kept up to date by
+# triggers.
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+    content, content='notes', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+    INSERT INTO notes_fts (rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+END;
+CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE ON notes BEGIN
+    INSERT INTO notes_fts (notes_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    INSERT INTO notes_fts (rowid, content) VALUES (new.id, new.content);
+END;
+"""
+
+_FTS_REBUILD = """
+INSERT INTO notes_fts (notes_fts) VALUES ('rebuild');
+"""
+
+
+def _plain(value):
+    if isinstance(value, Model):
+        return value.to_dict()
+    return value
+
+
+def _epoch(value):
+    """
+    Convert an API timestamp, datetime or number to seconds since the
+    epoch.
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if not isinstance(value, datetime.datetime):
+        value = parse_timestamp(value)
+        if value is None:
+            return None
+    elif value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+
+class NoteMirror(object):
+    """
+    A local copy of accounts, mailboxes, staff and ticket notes in an SQLite
+    database, for queries that would otherwise fetch every ticket from the
+    API.
+
+    Call :meth:`sync_directory` to copy accounts, mailboxes and staff, and
+    :meth:`sync_tickets` to copy the notes of tickets. The Snappy API can't
+    list tickets, so tickets are added by identifier, optionally with the
+    mailbox they belong to (notes don't record their mailbox). Once added,
+    :meth:`sync` refreshes every known ticket.
+
+    Notes are indexed by ticket, staff member and creation time, and tickets
+    by mailbox, so :meth:`notes` queries run locally in milliseconds. With
+    ``full_text=True``, note content is also indexed with SQLite's FTS5 for
+    :meth:`notes` ``search`` queries. Other questions can be answered with
+    SQL through :meth:`query`.
+
+    Timestamps are stored as seconds since the epoch (UTC). The full API
+    record of each row is kept as JSON in its ``data`` column.
+
+    :type sender:
+        :class:`besnappy.tickets.SnappyApiSender`
+    :param sender:
+        Sender used to fetch records. Enable revalidation on it so that
+        unchanged tickets aren't decoded again on every sync. Tickets whose
+        notes match those stored aren't rewritten either way.
+    :param str path:
+        Path of the database file. It is created if it doesn't exist.
+    :param bool full_text:
+        Maintain a full-text index of note content. Requires an SQLite
+        build with FTS5.
+    :param int concurrency:
+        Maximum number of requests in flight while syncing.
+    :param clock:
+        Callable returning the current time in seconds since the epoch.
+        Defaults to :func:`time.time`.
+    """
+
+    def __init__(self, sender, path, full_text=False, concurrency=4,
+                 clock=time.time):
+        self.sender = sender
+        self.path = path
+        self.full_text = full_text
+        self.concurrency = concurrency
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        if full_text:
+            script = _FTS_SCHEMA
+            if not self.query(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'notes_fts'"):
+                # Index the notes stored before full text was enabled, or
+                # the triggers would later delete entries that never
+                # existed and corrupt the index.
+                script += _FTS_REBUILD
+            self._conn.executescript(
+                "BEGIN IMMEDIATE;\n%sCOMMIT;" % (script,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _write(self, statements):
+        """
+        Run ``(sql, params)`` statements in one transaction.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    if isinstance(params, list):
+                        self._conn.executemany(sql, params)
+                    else:
+                        self._conn.execute(sql, params)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def sync_directory(self):
+        """
+        Copy all accounts and their mailboxes and staff, replacing what was
+        stored before.
+
+        :returns:
+            A dict with the number of ``accounts``, ``mailboxes`` and
+            ``staff`` stored.
+        """
+        now = self.clock()
+        accounts = [_plain(a) for a in self.sender.get_accounts()]
+        account_ids = [account["id"] for account in accounts]
+        mailboxes = []
+        staff = []
+        fetched = bounded_map(
+            lambda account_id: (
+                self.sender.get_mailboxes(account_id),
+                self.sender.get_staff(account_id)),
+            account_ids, self.concurrency)
+        for account_id, result in fetched:
+            if isinstance(result, Exception):
+                raise result
+            mailboxes.extend(_plain(m) for m in result[0])
+            staff.extend((account_id, _plain(s)) for s in result[1])
+        self._write([
+            ("DELETE FROM accounts", ()),
+            ("DELETE FROM mailboxes", ()),
+            ("DELETE FROM staff", ()),
+            ("INSERT INTO accounts VALUES (?, ?, ?, ?, ?)", [
+                (a["id"], a.get("organization"), a.get("domain"),
+                 json.dumps(a), now) for a in accounts]),
+            ("INSERT INTO mailboxes VALUES (?, ?, ?, ?, ?, ?)", [
+                (m["id"], m.get("account_id"), m.get("address"),
+                 m.get("display"), json.dumps(m), now) for m in mailboxes]),
+            ("INSERT OR REPLACE INTO staff VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                (account_id, s["id"], s.get("email"), s.get("first_name"),
+                 s.get("last_name"), json.dumps(s), now)
+                for account_id, s in staff]),
+        ])
+        return {
+            "accounts": len(accounts),
+            "mailboxes": len(mailboxes),
+            "staff": len(staff),
+        }
+
+    def add_tickets(self, ticket_ids, mailbox_id=None):
+        """
+        Add tickets to the mirror without fetching them.
+
+        :param ticket_ids:
+            Iterable of ticket identifiers.
+        :param int mailbox_id:
+            Mailbox the tickets belong to, if known. Replaces the mailbox
+            stored for tickets that are already known.
+        """
+        self._write([(
+            "INSERT INTO tickets (id, mailbox_id) VALUES (?, ?)"
+            " ON CONFLICT (id) DO UPDATE SET"
+            " mailbox_id = coalesce(excluded.mailbox_id, mailbox_id)",
+            [(ticket_id, mailbox_id) for ticket_id in ticket_ids])])
+
+    def _fetch_notes(self, ticket_id):
+        # Changes are judged against the digest stored with the ticket, not
+        # the sender's revalidation state, which other callers share.
+        notes = [_plain(note) for note in
+                 self.sender.get_ticket_notes(ticket_id)]
+        digest = hashlib.sha1(
+            json.dumps(notes, sort_keys=True).encode("utf-8")).hexdigest()
+        return notes, digest
+
+    def _stored_digest(self, ticket_id):
+        rows = self.query(
+            "SELECT digest FROM tickets WHERE id = ?", (ticket_id,))
+        return rows[0][0] if rows else None
+
+    def _store_notes(self, ticket_id, notes, digest):
+        rows = []
+        account_id = None
+        for note in notes:
+            account_id = note.get("account_id", account_id)
+            rows.append((
+                note["id"], ticket_id, note.get("account_id"),
+                note.get("scope"), note.get("created_by_staff_id"),
+                note.get("created_by_contact_id"), note.get("system"),
+                _epoch(note.get("created_at")),
+                _epoch(note.get("updated_at")), note.get("content"),
+                json.dumps(note)))
+        self._write([
+            ("DELETE FROM notes WHERE ticket_id = ?", (ticket_id,)),
+            ("INSERT OR IGNORE INTO notes VALUES"
+             " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows),
+            ("UPDATE tickets SET account_id = coalesce(?, account_id),"
+             " note_count = ?, digest = ?, synced_at = ? WHERE id = ?",
+             (account_id, len(rows), digest, self.clock(), ticket_id)),
+        ])
+
+    def sync_tickets(self, ticket_ids, mailbox_id=None):
+        """
+        Fetch the notes of tickets and store them, replacing the notes
+        stored for those tickets before. Tickets are added to the mirror if
+        they aren't already known.
+
+        Tickets are fetched concurrently. A failure to fetch or store one
+        ticket doesn't affect the others; its stored notes are left as they
+        were.
+
+        :param ticket_ids:
+            Iterable of ticket identifiers.
+        :param int mailbox_id:
+            Mailbox the tickets belong to, if known.
+
+        :returns:
+            A dict with the number of tickets ``updated``, ``unchanged``
+            (whose notes match those stored) and ``failed``, and the
+            ``errors`` raised by failed tickets keyed by ticket.
+        """
+        ticket_ids = list(ticket_ids)
+        self.add_tickets(ticket_ids, mailbox_id)
+        stats = {"updated": 0, "unchanged": 0, "failed": 0, "errors": {}}
+        results = bounded_map(
+            self._fetch_notes, ticket_ids, self.concurrency, ordered=False)
+        for ticket_id, result in results:
+            if isinstance(result, Exception):
+                stats["failed"] += 1
+                stats["errors"][ticket_id] = result
+                continue
+            notes, digest = result
+            if digest == self._stored_digest(ticket_id):
+                stats["unchanged"] += 1
+                continue
+            try:
+                self._store_notes(ticket_id, notes, digest)
+            except Exception as e:
+                stats["failed"] += 1
+                stats["errors"][ticket_id] = e
+            else:
+                stats["updated"] += 1
+        return stats
+
+    def ticket_ids(self, mailbox_id=None):
+        """
+        :returns:
+            List of known ticket identifiers, optionally only those in a
+            mailbox.
+        """
+        if mailbox_id is None:
+            rows = self.query("SELECT id FROM tickets ORDER BY id")
+        else:
+            rows = self.query(
+                "SELECT id FROM tickets WHERE mailbox_id = ? ORDER BY id",
+                (mailbox_id,))
+        return [row[0] for row in rows]
+
+    def sync(self, mailbox_id=None):
+        """
+        Refresh the notes of every known ticket, or of those in a mailbox.
+
+        :returns:
+            As for :meth:`sync_tickets`.
+        """
+        return self.sync_tickets(self.ticket_ids(mailbox_id))
+
+    def query(self, sql, params=()):
+        """
+        Run a read-only SQL query against the mirror.
+
+        :returns:
+            List of result rows as tuples.
+        """
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def notes(self, ticket_id=None, mailbox_id=None, staff_id=None,
+              account_id=None, scope=None, since=None, until=None,
+              search=None, limit=None):
+        """
+        Find stored notes. Every given condition must match.
+
+        :param ticket_id:
+            Ticket the notes are on.
+        :param int mailbox_id:
+            Mailbox of the notes' tickets.
+        :param int staff_id:
+            Staff member who wrote the notes.
+        :param int account_id:
+            Account of the notes.
+        :param str scope:
+            Note scope, such as ``"public"`` or ``"private"``.
+        :param since:
+            Earliest creation time (inclusive), as a
+            :class:`datetime.datetime` (naive ones are taken to be UTC) or
+            seconds since the epoch.
+        :param until:
+            Latest creation time (exclusive), as for ``since``.
+        :param str search:
+            FTS5 query to match against note content. Requires
+            ``full_text``.
+        :param int limit:
+            Maximum number of notes to return.
+
+        :returns:
+            List of note dicts, oldest first.
+        """
+        joins = []
+        where = []
+        params = []
+        if mailbox_id is not None:
+            joins.append("JOIN tickets ON tickets.id = notes.ticket_id")
+            where.append("tickets.mailbox_id = ?")
+            params.append(mailbox_id)
+        if search is not None:
+            if not self.full_text:
+                raise ValueError("Full-text search requires full_text=True")
+            joins.append("JOIN notes_fts ON notes_fts.rowid = notes.id")
+            where.append("notes_fts MATCH ?")
+            params.append(search)
+        for column, value in [("ticket_id", ticket_id),
+                              ("staff_id", staff_id),
+                              ("account_id", account_id),
+                              ("scope", scope)]:
+            if value is not None:
+                where.append("notes.%s = ?" % (column,))
+                params.append(value)
+        if since is not None:
+            where.append("notes.created_at >= ?")
+            params.append(_epoch(since))
+        if until is not None:
+            where.append("notes.created_at < ?")
+            params.append(_epoch(until))
+        sql = "SELECT notes.data FROM notes %s" % (" ".join(joins),)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY notes.created_at, notes.id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [json.loads(row[0]) for row in self.query(sql, params)]
+
+    def stats(self):
+        """
+        :returns:
+            A dict with the number of stored ``accounts``, ``mailboxes``,
+            ``staff``, ``tickets`` and ``notes``.
+        """
+        return dict(
+            (table, self.query("SELECT count(*) FROM %s" % (table,))[0][0])
+            for table in ("accounts", "mailboxes", "staff", "tickets",
+                          "notes"))
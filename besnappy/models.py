@@ -0,0 +1,312 @@
+""" Compact models for Snappy API records.
+
+The getters on :class:`besnappy.tickets.SnappyApiSender` return lists of
+dicts by default. When many records are held in memory, the models here are
+several times smaller: each model stores a fixed set of fields in
+``__slots__`` and drops the rest of the payload unless asked to keep it.
+
+Timestamps are stored as received and only parsed into
+:class:`datetime.datetime` objects when the attribute is read. Models also
+support ``record["field"]`` and ``record.get("field")``, which return the
+stored value as received, so code written against the dicts keeps working.
+"""
+import datetime
+import sys
+
+
+_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_timestamp(value):
+    """
+    Parse a timestamp from the API.
+
+    The API returns some timestamps as ``"YYYY-MM-DD HH:MM:SS"`` strings
+    and some as seconds since the epoch. Both are taken to be UTC.
+
+    :returns:
+        An aware :class:`datetime.datetime`, or ``None`` if ``value`` is
+        ``None`` or empty.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    return datetime.datetime.strptime(value, _TIMESTAMP_FORMAT).replace(
+        tzinfo=datetime.timezone.utc)
+
+
+class _Timestamp(object):
+    """
+    Descriptor that parses a timestamp stored in a slot when it is read.
+    """
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        return parse_timestamp(getattr(obj, self.slot))
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+
+class _ModelMeta(type):
+    """
+    Build ``__slots__`` and timestamp descriptors from a model's ``fields``
+    and ``timestamps``.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        fields = tuple(namespace.get("fields", ()))
+        timestamps = frozenset(namespace.get("timestamps", ()))
+        slots = tuple(
+            "_" + field if field in timestamps else field
+            for field in fields)
+        namespace["__slots__"] = tuple(namespace.get("__slots__", ())) + slots
+        for field in timestamps:
+            namespace[field] = _Timestamp("_" + field)
+        cls = type.__new__(mcs, name, bases, namespace)
+        cls._field_slots = tuple(zip(fields, slots))
+        cls._slot_for = dict(cls._field_slots)
+        return cls
+
+
+class Model(object, metaclass=_ModelMeta):
+    """
+    Base class for API records.
+
+    Subclasses list the payload keys they store in ``fields``. Keys listed
+    in ``timestamps`` are parsed on access, keys in ``nested`` are lists of
+    records decoded into tuples of the given model, and string values of
+    keys in ``interned`` are interned because they repeat across records.
+
+    Models can also be created directly with keyword arguments for their
+    fields. Fields that aren't given are ``None``.
+    """
+
+    __slots__ = ("_extra",)
+
+    fields = ()
+    timestamps = ()
+    nested = {}
+    interned = ()
+
+    def __init__(self, **kwargs):
+        for field, slot in self._field_slots:
+            setattr(self, slot, kwargs.pop(field, None))
+        if kwargs:
+            raise TypeError("%s has no fields %s" % (
+                type(self).__name__, ", ".join(sorted(kwargs))))
+        self._extra = None
+
+    @classmethod
+    def from_dict(cls, data, keep_extra=False):
+        """
+        Create a model from an API payload dict.
+
+        :param dict data:
+            The payload. Missing fields are set to ``None``.
+        :param bool keep_extra:
+            If ``True``, keys that aren't fields are kept and included in
+            :meth:`to_dict`. They are dropped by default to save memory.
+        """
+        self = cls.__new__(cls)
+        nested = cls.nested
+        interned = cls.interned
+        for field, slot in cls._field_slots:
+            value = data.get(field)
+            if value is not None:
+                if field in nested:
+                    model = nested[field]
+                    value = tuple(
+                        model.from_dict(item, keep_extra) for item in value)
+                elif field in interned and isinstance(value, str):
+                    value = sys.intern(value)
+            setattr(self, slot, value)
+        if keep_extra:
+            self._extra = dict(
+                (key, value) for key, value in data.items()
+                if key not in cls._slot_for) or None
+        else:
+            self._extra = None
+        return self
+
+    @classmethod
+    def from_list(cls, items, keep_extra=False):
+        """
+        Create a list of models from a list of API payload dicts.
+        """
+        return [cls.from_dict(item, keep_extra) for item in items]
+
+    def to_dict(self):
+        """
+        Convert the model back into an API payload dict, with timestamps as
+        received.
+        """
+        data = {}
+        for field, slot in self._field_slots:
+            value = getattr(self, slot)
+            if value is not None and field in self.nested:
+                value = [item.to_dict() for item in value]
+            data[field] = value
+        if self._extra:
+            data.update(self._extra)
+        return data
+
+    def __getitem__(self, key):
+        slot = self._slot_for.get(key)
+        if slot is not None:
+            return getattr(self, slot)
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        """
+        Return the stored value of ``key``, or ``default`` if the model
+        doesn't have it.
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(id=%r)" % (type(self).__name__, getattr(self, "id", None))
+
+
+def _full_name(first_name, last_name):
+    return " ".join(name for name in (first_name, last_name) if name)
+
+
+class Account(Model):
+    """
+    An account, as returned by
+    :meth:`besnappy.tickets.SnappyApiSender.get_accounts`.
+    """
+
+    fields = (
+        "id", "organization", "domain", "custom_domain", "plan_id",
+        "active", "is_paid", "is_trial", "created_at", "updated_at",
+        "trial_ends_at", "last_paid_at", "cancelled_at")
+    timestamps = (
+        "created_at", "updated_at", "trial_ends_at", "last_paid_at",
+        "cancelled_at")
+
+
+class Mailbox(Model):
+    """
+    A mailbox, as returned by
+    :meth:`besnappy.tickets.SnappyApiSender.get_mailboxes`.
+    """
+
+    fields = (
+        "id", "account_id", "type", "address", "local_part",
+        "custom_address", "display", "active", "language", "theme",
+        "created_at", "updated_at")
+    timestamps = ("created_at", "updated_at")
+    interned = ("type", "language", "theme")
+
+
+class Staff(Model):
+    """
+    A staff member, as returned by
+    :meth:`besnappy.tickets.SnappyApiSender.get_staff`.
+    """
+
+    fields = (
+        "id", "username", "email", "address", "first_name", "last_name",
+        "sms_number", "culture", "timezone", "verified", "created_at",
+        "updated_at")
+    timestamps = ("created_at", "updated_at")
+    interned = ("culture", "timezone")
+
+    @property
+    def name(self):
+        return _full_name(self.first_name, self.last_name)
+
+    def as_address(self):
+        """
+        :returns:
+            A ``{"name": ..., "address": ...}`` dict for the ``to_addr`` and
+            ``from_addr`` arguments of
+            :meth:`besnappy.tickets.SnappyApiSender.create_note`.
+        """
+        return {"name": self.name, "address": self.address or self.email}
+
+
+class Contact(Model):
+    """
+    A contact attached to a :class:`Note`.
+    """
+
+    fields = (
+        "id", "account_id", "type", "first_name", "last_name", "address",
+        "value", "provider", "created_at", "updated_at")
+    timestamps = ("created_at", "updated_at")
+    interned = ("type", "provider")
+
+    @property
+    def name(self):
+        return _full_name(self.first_name, self.last_name)
+
+    def as_address(self):
+        """
+        :returns:
+            A ``{"name": ..., "address": ...}`` dict for the ``to_addr`` and
+            ``from_addr`` arguments of
+            :meth:`besnappy.tickets.SnappyApiSender.create_note`.
+        """
+        return {"name": self.name, "address": self.address or self.value}
+
+
+class Note(Model):
+    """
+    A ticket note, as returned by
+    :meth:`besnappy.tickets.SnappyApiSender.get_ticket_notes`.
+
+    The creator records that duplicate an entry in ``contacts`` are not
+    stored unless extra keys are kept.
+    """
+
+    fields = (
+        "id", "account_id", "ticket_id", "scope", "content", "system",
+        "using_html", "created_by_staff_id", "created_by_contact_id",
+        "created_at", "updated_at", "contacts", "attachments")
+    timestamps = ("created_at", "updated_at")
+    nested = {"contacts": Contact}
+    interned = ("scope",)
+
+
+def model_id(value):
+    """
+    Return the ``id`` of a model, or ``value`` unchanged if it isn't one.
+    """
+    if isinstance(value, Model):
+        return value.id
+    return value
+
+
+def address_list(addresses):
+    """
+    Convert any models with an ``as_address()`` method in a list of
+    addresses into address dicts. A single model is converted on its own,
+    and anything else that isn't a list or tuple is returned unchanged.
+    """
+    if hasattr(addresses, "as_address"):
+        return addresses.as_address()
+    if not isinstance(addresses, (list, tuple)):
+        return addresses
+    return [
+        address.as_address() if hasattr(address, "as_address") else address
+        for address in addresses]
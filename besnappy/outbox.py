@@ -0,0 +1,420 @@
+""" A durable local queue for notes waiting to be sent to Snappy.
+"""
+from collections import namedtuple
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+from requests import HTTPError
+
+from .concurrency import bounded_map
+from .ratelimit import Backoff
+from .tickets import build_note_data
+
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dedup_key TEXT NOT NULL UNIQUE,
+    data TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    enqueued_at REAL NOT NULL,
+    finished_at REAL,
+    ticket_id TEXT,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_attempt_at);
+CREATE INDEX IF NOT EXISTS outbox_finished ON outbox (state, finished_at);
+"""
+
+#: A note claimed for sending. ``data`` is the request body built by
+#: :func:`besnappy.tickets.build_note_data` and ``attempts`` is the number
+#: of earlier failed attempts.
+OutboxItem = namedtuple("OutboxItem", ["id", "dedup_key", "data", "attempts"])
+
+
+class NoteOutbox(object):
+    """
+    A queue of notes to create, stored in an SQLite database.
+
+    Enqueuing only writes a row locally, so it is fast and doesn't depend on
+    the API being available. An :class:`OutboxFlusher` sends the queued
+    notes in the background.
+
+    Every note has a deduplication key. Enqueuing a note with a key that is
+    already in the outbox does nothing, so a caller that retries after a
+    crash doesn't queue the same note twice. Sent notes are kept, with the
+    ticket identifier returned by the API, until they are purged.
+
+    Delivery is at least once: if the process stops after a note was posted
+    but before it was marked as sent, it will be posted again.
+
+    The database uses write-ahead logging and may be shared by several
+    processes.
+
+    :param str path:
+        Path of the database file. It is created if it doesn't exist.
+    :param str synchronous:
+        SQLite ``synchronous`` setting. The default, ``"NORMAL"``, keeps
+        enqueued notes safe if the process crashes but may lose the most
+        recent ones if the machine loses power. Use ``"FULL"`` to protect
+        against that too, at the cost of slower enqueues.
+    :param clock:
+        Callable returning the current time in seconds since the epoch.
+        Defaults to :func:`time.time`.
+    """
+
+    def __init__(self, path, synchronous="NORMAL", clock=time.time):
+        self.path = path
+        self.clock = clock
+        #: Set whenever a note is enqueued, so flushers can wake up early.
+        self.enqueued = threading.Event()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=%s" % (synchronous,))
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def enqueue(self, mailbox_id, subject, message, ticket_id=None,
+                to_addr=None, from_addr=None, staff_id=None, scope=None,
+                dedup_key=None):
+        """
+        Queue a note to be created.
+
+        The note parameters are the same as those of
+        :meth:`besnappy.tickets.SnappyApiSender.create_note`.
+
+        :param str dedup_key:
+            Deduplication key for the note. Defaults to a new random key.
+
+        :returns:
+            The deduplication key.
+        """
+        data = build_note_data(
+            mailbox_id, subject, message, ticket_id=ticket_id,
+            to_addr=to_addr, from_addr=from_addr, staff_id=staff_id,
+            scope=scope)
+        return self.enqueue_data(data, dedup_key)
+
+    def enqueue_data(self, data, dedup_key=None):
+        """
+        Queue a note request body built by
+        :func:`besnappy.tickets.build_note_data`.
+
+        :returns:
+            The deduplication key.
+        """
+        if dedup_key is None:
+            dedup_key = uuid.uuid4().hex
+        now = self.clock()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO outbox"
+                " (dedup_key, data, state, next_attempt_at, enqueued_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (dedup_key, json.dumps(data), PENDING, now, now))
+        self.enqueued.set()
+        return dedup_key
+
+    def claim(self, limit, lease=60.0):
+        """
+        Claim up to ``limit`` notes that are due to be sent.
+
+        Claimed notes aren't returned by other claims for ``lease`` seconds.
+        If they haven't been marked as sent or failed by then, for example
+        because the process stopped, they are sent again.
+
+        :returns:
+            List of :data:`OutboxItem`, oldest first.
+        """
+        now = self.clock()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, dedup_key, data, attempts FROM outbox"
+                    " WHERE state = ? AND next_attempt_at <= ?"
+                    " ORDER BY next_attempt_at, id LIMIT ?",
+                    (PENDING, now, limit)).fetchall()
+                self._conn.executemany(
+                    "UPDATE outbox SET next_attempt_at = ? WHERE id = ?",
+                    [(now + lease, row[0]) for row in rows])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [
+            OutboxItem(item_id, dedup_key, json.loads(data), attempts)
+            for item_id, dedup_key, data, attempts in rows]
+
+    def mark_sent(self, item_id, ticket_id):
+        """
+        Record that a claimed note was created on ``ticket_id``.
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET state = ?, attempts = attempts + 1,"
+                " finished_at = ?, ticket_id = ?, last_error = NULL"
+                " WHERE id = ?",
+                (SENT, self.clock(), ticket_id, item_id))
+
+    def mark_failed(self, item_id, error, retry_at=None):
+        """
+        Record a failed attempt to send a claimed note.
+
+        :param str error:
+            Description of the failure.
+        :param float retry_at:
+            Time to try again at. If ``None``, the note is not retried.
+        """
+        with self._lock:
+            if retry_at is None:
+                self._conn.execute(
+                    "UPDATE outbox SET state = ?, attempts = attempts + 1,"
+                    " finished_at = ?, last_error = ? WHERE id = ?",
+                    (FAILED, self.clock(), error, item_id))
+            else:
+                self._conn.execute(
+                    "UPDATE outbox SET attempts = attempts + 1,"
+                    " next_attempt_at = ?, last_error = ? WHERE id = ?",
+                    (retry_at, error, item_id))
+
+    def get(self, dedup_key):
+        """
+        Look up a note by its deduplication key.
+
+        :returns:
+            A dict with the note's ``state``, ``attempts``, ``ticket_id``,
+            ``last_error``, ``enqueued_at`` and ``finished_at``, or ``None``
+            if there is no such note.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state, attempts, ticket_id, last_error, enqueued_at,"
+                " finished_at FROM outbox WHERE dedup_key = ?",
+                (dedup_key,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(
+            ["state", "attempts", "ticket_id", "last_error", "enqueued_at",
+             "finished_at"], row))
+
+    def counts(self):
+        """
+        :returns:
+            A dict with the number of ``pending``, ``sent`` and ``failed``
+            notes.
+        """
+        counts = {PENDING: 0, SENT: 0, FAILED: 0}
+        with self._lock:
+            counts.update(self._conn.execute(
+                "SELECT state, COUNT(*) FROM outbox GROUP BY state"))
+        return counts
+
+    def retry_failed(self):
+        """
+        Queue notes that failed permanently to be sent again.
+
+        :returns:
+            The number of notes queued.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE outbox SET state = ?, attempts = 0,"
+                " next_attempt_at = ?, finished_at = NULL WHERE state = ?",
+                (PENDING, self.clock(), FAILED))
+        self.enqueued.set()
+        return cursor.rowcount
+
+    def purge(self, before):
+        """
+        Delete sent notes that finished before ``before``. Their
+        deduplication keys can be reused afterwards.
+
+        :returns:
+            The number of notes deleted.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM outbox WHERE state = ? AND finished_at < ?",
+                (SENT, before))
+        return cursor.rowcount
+
+
+def _is_permanent(error):
+    """
+    Return ``True`` for errors that retrying won't fix: client errors other
+    than timeouts and rate limiting.
+    """
+    if not isinstance(error, HTTPError) or error.response is None:
+        return False
+    status = error.response.status_code
+    return 400 <= status < 500 and status not in (408, 429)
+
+
+class OutboxFlusher(object):
+    """
+    Sends notes queued in a :class:`NoteOutbox`.
+
+    Notes are claimed in batches and sent concurrently through ``sender``.
+    Failures are retried with jittered exponential backoff, except for
+    client errors (other than 408 and 429), which fail permanently.
+
+    Call :meth:`start` to flush in a background thread, or call
+    :meth:`flush` or :meth:`drain` directly.
+
+    :param outbox:
+        The :class:`NoteOutbox` to send from.
+    :param sender:
+        The :class:`besnappy.tickets.SnappyApiSender` to send with. Its rate
+        limiter, if any, applies.
+    :param int concurrency:
+        Maximum number of notes being sent at once.
+    :param int batch_size:
+        Maximum number of notes claimed at a time.
+    :param int max_attempts:
+        Number of attempts after which a note fails permanently.
+    :param backoff:
+        A :class:`besnappy.ratelimit.Backoff` used to compute retry delays.
+        Defaults to one starting at 1 second and capped at 5 minutes.
+    :param float lease:
+        Seconds before a claimed note that wasn't sent or failed is sent
+        again.
+    :param float poll_interval:
+        Seconds the background thread waits for new notes between flushes.
+    :param float retain_sent:
+        Seconds to keep sent notes (and so their deduplication keys) for
+        before the background thread purges them. ``None`` keeps them.
+    :param float purge_interval:
+        Seconds between purges by the background thread.
+    """
+
+    def __init__(self, outbox, sender, concurrency=4, batch_size=100,
+                 max_attempts=10, backoff=None, lease=60.0,
+                 poll_interval=1.0, retain_sent=7 * 24 * 3600,
+                 purge_interval=300.0):
+        self.outbox = outbox
+        self.sender = sender
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        if backoff is None:
+            backoff = Backoff(base=1.0, cap=300.0)
+        self.backoff = backoff
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.retain_sent = retain_sent
+        self.purge_interval = purge_interval
+        self._purged_at = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        #: The last exception raised by a background flush, if any.
+        self.last_error = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _send(self, item):
+        # The dedup key doubles as the idempotency key if the sender has an
+        # idempotency cache.
+        return self.sender.post_note(item.data, item.dedup_key)
+
+    def flush(self):
+        """
+        Claim one batch of due notes and send them.
+
+        :returns:
+            The number of notes claimed.
+        """
+        items = self.outbox.claim(self.batch_size, self.lease)
+        if not items:
+            return 0
+        for item, result in bounded_map(
+                self._send, items, self.concurrency, ordered=False):
+            if not isinstance(result, Exception):
+                self.outbox.mark_sent(item.id, result)
+                self.sent += 1
+            elif (_is_permanent(result) or
+                    item.attempts + 1 >= self.max_attempts):
+                self.outbox.mark_failed(item.id, repr(result))
+                self.failed += 1
+            else:
+                retry_at = (
+                    self.outbox.clock() + self.backoff.delay(item.attempts))
+                self.outbox.mark_failed(item.id, repr(result), retry_at)
+                self.retried += 1
+        return len(items)
+
+    def drain(self):
+        """
+        Flush until no notes are due.
+        """
+        while self.flush():
+            pass
+
+    def start(self):
+        """
+        Start flushing in a background daemon thread.
+        """
+        if self._thread is not None:
+            raise RuntimeError("Flusher already started")
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="besnappy-outbox-flusher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the background thread after its current batch, waiting up to
+        ``timeout`` seconds for it to finish.
+        """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self.outbox.enqueued.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _purge_if_due(self):
+        if self.retain_sent is None:
+            return
+        now = self.outbox.clock()
+        if (self._purged_at is not None and
+                now - self._purged_at < self.purge_interval):
+            return
+        self.outbox.purge(now - self.retain_sent)
+        self._purged_at = now
+
+    def _run(self):
+        while not self._stopping.is_set():
+            # Clear before flushing so that notes enqueued during the flush
+            # wake us straight away.
+            self.outbox.enqueued.clear()
+            try:
+                claimed = self.flush()
+                self._purge_if_due()
+            except Exception as e:
+                self.last_error = e
+                claimed = 0
+            if claimed < self.batch_size:
+                self.outbox.enqueued.wait(self.poll_interval)
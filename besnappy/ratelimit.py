@@ -0,0 +1,247 @@
+""" Client-side rate limiting and retry backoff.
+"""
+from email.utils import parsedate_to_datetime
+import datetime
+import random
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket rate limiter.
+
+    Tokens are added at ``rate`` per second up to ``burst``. Each request
+    takes one token and waits if none are available.
+
+    The bucket can also be paused, for example when the server asks clients
+    to back off, in which case every user of the bucket waits until the
+    pause is over.
+
+    :param float rate:
+        Sustained requests per second.
+    :param float burst:
+        Maximum number of tokens that can accumulate. Defaults to ``rate``
+        (at least 1).
+    :param clock:
+        Callable returning the current time in seconds. Defaults to
+        :func:`time.monotonic`.
+    :param sleep:
+        Callable used to wait. Defaults to :func:`time.sleep`.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if burst is None:
+            burst = max(rate, 1)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    def _refill(self, now):
+        # Tokens don't accumulate while the bucket is paused.
+        elapsed = max(0.0, now - max(self._updated, self._paused_until))
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """
+        Take a token without waiting.
+
+        :returns:
+            ``0`` if a token was taken, otherwise the number of seconds until
+            one is expected to be available.
+        """
+        with self._lock:
+            now = self.clock()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            # Allow for float rounding, otherwise we can end up waiting for
+            # vanishingly small fractions of a token forever.
+            if self._tokens >= 1 - 1e-9:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available.
+
+        :returns:
+            The total time spent waiting, in seconds.
+        """
+        waited = 0.0
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return waited
+            self.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        """
+        Stop handing out tokens for ``seconds``. Overlapping pauses extend
+        to the latest end time.
+        """
+        with self._lock:
+            now = self.clock()
+            self._paused_until = max(self._paused_until, now + seconds)
+            # Don't let a burst of saved-up tokens out as soon as the pause
+            # ends.
+            self._refill(now)
+            self._tokens = min(self._tokens, 1.0)
+
+
+_shared_limiters = {}
+_shared_limiters_lock = threading.Lock()
+
+
+def shared_rate_limiter(key, rate, burst=None):
+    """
+    Return the process-wide :class:`TokenBucket` for ``key``, creating it if
+    necessary.
+
+    Senders using the same API key should share a limiter because the server
+    enforces its limits per key.
+
+    :raises ValueError:
+        If the limiter already exists with a different rate, or a different
+        burst when ``burst`` is given. Senders sharing a key must agree on
+        its limits.
+    """
+    with _shared_limiters_lock:
+        limiter = _shared_limiters.get(key)
+        if limiter is None:
+            limiter = _shared_limiters[key] = TokenBucket(rate, burst)
+        elif limiter.rate != rate or (
+                burst is not None and limiter.burst != burst):
+            raise ValueError(
+                "Shared rate limiter already exists with rate %r and burst"
+                " %r" % (limiter.rate, limiter.burst))
+        return limiter
+
+
+def parse_retry_after(value, now=None):
+    """
+    Parse a ``Retry-After`` header value.
+
+    :param str value:
+        Either a number of seconds or an HTTP date.
+    :param now:
+        Current time as an aware :class:`datetime.datetime`, for HTTP dates.
+        Defaults to the current UTC time.
+
+    :returns:
+        Seconds to wait (never negative), or ``None`` if the value can't be
+        parsed.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (when - now).total_seconds())
+
+
+class Backoff(object):
+    """
+    Retry policy with jittered exponential backoff.
+
+    Responses with status 429 (Too Many Requests) are always retried since
+    the server didn't process them. Server errors (5xx) are only retried for
+    idempotent methods so that a note is never posted twice.
+
+    :param int max_retries:
+        Maximum number of retries per request.
+    :param float base:
+        Delay before the first retry, in seconds. The delay doubles with
+        each retry.
+    :param float cap:
+        Maximum backoff delay in seconds. Delays asked for with
+        ``Retry-After`` aren't limited by it.
+    :param float max_retry_after:
+        Longest ``Retry-After`` delay, in seconds, worth waiting for. A
+        response asking for a longer wait isn't retried. Defaults to
+        ``None`` (no limit other than the caller's deadline).
+    :param retry_statuses:
+        Status codes that can be retried.
+    :param idempotent_methods:
+        Methods that are safe to retry after a server error.
+    :param random:
+        Callable returning a float in ``[0, 1)``, used for jitter.
+    :param sleep:
+        Callable used to wait. Defaults to :func:`time.sleep`.
+    """
+
+    def __init__(self, max_retries=3, base=0.5, cap=30.0,
+                 retry_statuses=(429, 500, 502, 503, 504),
+                 idempotent_methods=("GET",), random=random.random,
+                 sleep=time.sleep, max_retry_after=None):
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+        self.max_retry_after = max_retry_after
+        self.retry_statuses = frozenset(retry_statuses)
+        self.idempotent_methods = frozenset(idempotent_methods)
+        self.random = random
+        self.sleep = sleep
+
+    def should_retry(self, method, status_code, attempt):
+        """
+        :param int attempt:
+            Number of retries already made.
+
+        :returns:
+            ``True`` if a response with ``status_code`` should be retried.
+        """
+        if attempt >= self.max_retries:
+            return False
+        if status_code not in self.retry_statuses:
+            return False
+        return status_code == 429 or method in self.idempotent_methods
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Compute the delay before the next retry.
+
+        Uses "full jitter": a random delay between zero and the exponential
+        backoff for this attempt. A ``Retry-After`` value from the server is
+        used as a lower bound.
+
+        :param int attempt:
+            Number of retries already made.
+        :param str retry_after:
+            The response's ``Retry-After`` header, if any.
+
+        :returns:
+            The delay in seconds, or ``None`` if ``Retry-After`` asks for a
+            longer wait than ``max_retry_after`` and the request shouldn't
+            be retried.
+        """
+        backoff = min(self.cap, self.base * (2 ** attempt))
+        delay = backoff * self.random()
+        server_delay = parse_retry_after(retry_after)
+        if server_delay is not None:
+            if (self.max_retry_after is not None and
+                    server_delay > self.max_retry_after):
+                return None
+            delay = max(delay, server_delay)
+        return delay
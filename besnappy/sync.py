@@ -0,0 +1,146 @@
+""" Incremental synchronisation of ticket notes.
+"""
+import json
+import threading
+
+from .fileutil import write_json_atomic
+
+
+class TicketNotesWatcher(object):
+    """
+    Track which notes have been seen on each ticket and return only new
+    ones.
+
+    For each ticket the watcher keeps a high-water mark: the identifier of
+    the newest note seen. Note identifiers are assumed to increase over
+    time, as observed in the Snappy API.
+
+    The Snappy API always returns every note on a ticket, so each sync still
+    makes one request per ticket. Enable revalidation on the sender (see
+    :class:`besnappy.tickets.SnappyApiSender`) so that unchanged tickets are
+    answered from the revalidation cache without decoding the notes again.
+    New notes are always found by comparing with the high-water mark, not
+    by whether the sender saw a change, because other calls on the same
+    sender may have fetched the ticket since the last sync.
+
+    :type sender:
+        :class:`besnappy.tickets.SnappyApiSender`
+    :param sender:
+        Sender used to fetch notes.
+    :param dict state:
+        Initial high-water marks, as returned by :meth:`get_state`.
+    """
+
+    STATE_VERSION = 2
+
+    def __init__(self, sender, state=None):
+        self.sender = sender
+        self._lock = threading.Lock()
+        self._marks = {}
+        if state is not None:
+            self.set_state(state)
+
+    def high_water_mark(self, ticket_id):
+        """
+        :returns:
+            The identifier of the newest note seen on the ticket, or
+            ``None`` if the ticket has not been synced.
+        """
+        with self._lock:
+            return self._marks.get(ticket_id)
+
+    def sync(self, ticket_id):
+        """
+        Fetch the ticket's notes and return those added since the last sync.
+
+        The first sync of a ticket returns all of its notes.
+
+        :param ticket_id:
+            Ticket to sync.
+
+        :returns:
+            List of new note dicts, oldest first.
+        """
+        last_id = self.high_water_mark(ticket_id)
+        notes = self.sender.get_ticket_notes(ticket_id)
+        new_notes = [
+            note for note in notes if last_id is None or note["id"] > last_id]
+        if not new_notes:
+            return []
+        new_notes.sort(key=lambda note: note["id"])
+        newest = new_notes[-1]
+        with self._lock:
+            current = self._marks.get(ticket_id)
+            # Another thread may have synced the same ticket concurrently.
+            if current is None or newest["id"] > current:
+                self._marks[ticket_id] = newest["id"]
+        return new_notes
+
+    def sync_many(self, ticket_ids):
+        """
+        Sync several tickets in turn.
+
+        :returns:
+            Iterator over ``(ticket_id, new_notes)`` pairs for tickets with
+            new notes.
+        """
+        for ticket_id in ticket_ids:
+            new_notes = self.sync(ticket_id)
+            if new_notes:
+                yield ticket_id, new_notes
+
+    def forget(self, ticket_id):
+        """
+        Drop the high-water mark for a ticket, for example once it is closed.
+        """
+        with self._lock:
+            self._marks.pop(ticket_id, None)
+
+    def get_state(self):
+        """
+        :returns:
+            A JSON-serialisable dict of the watcher's high-water marks.
+            Marks are kept as a list of ``[ticket_id, note_id]`` pairs so
+            that integer ticket identifiers survive a round trip through
+            JSON.
+        """
+        with self._lock:
+            tickets = [
+                [ticket_id, note_id]
+                for ticket_id, note_id in self._marks.items()]
+        return {"version": self.STATE_VERSION, "tickets": tickets}
+
+    def set_state(self, state):
+        """
+        Replace the watcher's high-water marks with those from
+        :meth:`get_state`.
+        """
+        if state.get("version") != self.STATE_VERSION:
+            raise ValueError(
+                "Unsupported watcher state version: %r" % (
+                    state.get("version"),))
+        marks = dict(
+            (ticket_id, note_id) for ticket_id, note_id in state["tickets"])
+        with self._lock:
+            self._marks = marks
+
+    def save(self, path):
+        """
+        Write the watcher's state to ``path`` as JSON.
+
+        The file is replaced atomically, so a crash while saving leaves the
+        previous state intact.
+        """
+        write_json_atomic(path, self.get_state())
+
+    def load(self, path):
+        """
+        Replace the watcher's state with that saved in ``path``. A missing
+        file is treated as empty state.
+        """
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {"version": self.STATE_VERSION, "tickets": []}
+        self.set_state(state)
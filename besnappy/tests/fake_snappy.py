@@ -0,0 +1,138 @@
+"""
+An in-process fake Snappy API server that replays recorded cassette
+responses over real HTTP.
+
+This is used by tests that need real connections and by the benchmarks in
+the ``benchmarks`` directory.
+"""
+
+import copy
+import glob
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+from besnappy.tests.helpers import LocalHTTPServer
+
+
+CASSETTE_LIBRARY_DIR = os.path.join(os.path.dirname(__file__), "cassettes")
+API_PATH = "/api/v1"
+
+
+def load_cassette_routes(cassette_dir=CASSETTE_LIBRARY_DIR):
+    """
+    Load recorded responses from every cassette in ``cassette_dir``.
+
+    :returns:
+        A dict mapping ``(method, path)`` to ``(status, content_type,
+        body)``, where ``path`` is relative to the API root.
+    """
+    routes = {}
+    for filename in sorted(glob.glob(os.path.join(cassette_dir, "*.json"))):
+        with open(filename) as f:
+            cassette = json.load(f)
+        for interaction in cassette["http_interactions"]:
+            request = interaction["request"]
+            response = interaction["response"]
+            path = request["uri"].split(API_PATH, 1)[-1]
+            routes[(request["method"], path)] = (
+                response["status"]["code"],
+                response["headers"].get("content-type", "text/plain"),
+                response["body"]["string"])
+    return routes
+
+
+class FakeSnappyServer(object):
+    """
+    A fake Snappy API on localhost.
+
+    Recorded GET responses are served for the accounts, mailboxes and staff
+    endpoints. Notes for any ticket are served from a recorded notes
+    response, and posted notes get a new random ticket identifier.
+
+    Use as a context manager; ``.api_url`` is the API root to pass to
+    :class:`besnappy.tickets.SnappyApiSender`.
+
+    :param float latency:
+        Seconds to wait before answering each request.
+    :param float jitter:
+        Extra random delay of up to this many seconds per request.
+    :param float error_rate:
+        Fraction of requests answered with ``503 Service Unavailable``.
+    :param int notes_per_ticket:
+        If set, ticket notes responses contain this many notes, generated
+        from the recorded note. Otherwise the recorded response is served.
+    :param int seed:
+        Seed for the random number generator used for jitter and errors.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 notes_per_ticket=None, seed=None,
+                 cassette_dir=CASSETTE_LIBRARY_DIR):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.routes = load_cassette_routes(cassette_dir)
+        self.notes_body = self._build_notes_body(notes_per_ticket)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+        self._server = LocalHTTPServer(self.handle)
+        self.api_url = self._server.url + API_PATH
+
+    def _build_notes_body(self, notes_per_ticket):
+        [recorded] = [
+            body for (method, path), (_, _, body) in sorted(
+                self.routes.items())
+            if method == "GET" and path.startswith("/ticket/")][:1]
+        # The body is kept as bytes so that serving it doesn't allocate (and
+        # show up in the client's memory benchmarks).
+        if notes_per_ticket is None:
+            return recorded.encode("utf-8")
+        template = json.loads(recorded)[-1]
+        notes = []
+        for i in range(notes_per_ticket):
+            note = copy.deepcopy(template)
+            note["id"] = template["id"] + notes_per_ticket - i
+            notes.append(note)
+        return json.dumps(notes, separators=(",", ":")).encode("utf-8")
+
+    def __enter__(self):
+        self._server.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._server.__exit__(exc_type, exc, tb)
+
+    def _delay_and_maybe_fail(self):
+        with self._lock:
+            self.request_count += 1
+            delay = self.latency + self.jitter * self._random.random()
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.error_count += 1
+        if delay:
+            time.sleep(delay)
+        return fail
+
+    def handle(self, request, body):
+        if self._delay_and_maybe_fail():
+            return 503, {"Content-Type": "text/plain"}, "Service Unavailable"
+        path = request.path
+        if not path.startswith(API_PATH):
+            return 404, {"Content-Type": "text/plain"}, "Not Found"
+        path = path[len(API_PATH):]
+        if request.command == "POST" and path == "/note":
+            ticket_id = uuid.uuid4().hex[:16]
+            return 200, {"Content-Type": "text/html; charset=UTF-8"}, ticket_id
+        if request.command == "GET" and path.startswith("/ticket/"):
+            return 200, {"Content-Type": "application/json"}, self.notes_body
+        route = self.routes.get((request.command, path))
+        if route is None:
+            return 404, {"Content-Type": "text/plain"}, "Not Found"
+        status, content_type, content = route
+        return status, {"Content-Type": content_type}, content
@@ -0,0 +1,111 @@
+"""
+Helpers shared by the besnappy tests.
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from requests_testadapter import Resp, TestAdapter
+
+
+class CallbackAdapter(TestAdapter):
+    """
+    A test adapter that builds each response by calling ``handler`` with the
+    outgoing request.
+
+    ``handler`` returns a ``(body, status, headers)`` tuple. The body may be
+    text or bytes. Requests are recorded in ``.requests`` and their
+    timeouts in ``.timeouts``.
+    """
+
+    def __init__(self, handler):
+        super(CallbackAdapter, self).__init__(b"")
+        self.handler = handler
+        self.requests = []
+        self.timeouts = []
+        self._lock = threading.Lock()
+
+    def send(self, request, stream=False, timeout=None,
+             verify=True, cert=None, proxies=None):
+        with self._lock:
+            self.requests.append(request)
+            self.timeouts.append(timeout)
+        body, status, headers = self.handler(request)
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        r = self.build_response(request, Resp(body, status, headers))
+        if not stream:
+            r.content
+        return r
+
+
+class FakeClock(object):
+    """
+    A clock that only moves when something sleeps on it.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class _LocalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, so without this Nagle's
+    # algorithm and delayed ACKs add ~40ms to every keep-alive response.
+    disable_nagle_algorithm = True
+
+    def _respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        status, headers, content = self.server.handler(self, body)
+        if not isinstance(content, bytes):
+            content = content.encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalHTTPServer(object):
+    """
+    A real HTTP server on localhost for tests that need actual connections.
+
+    ``handler`` is called with the request handler and the request body and
+    returns a ``(status, headers, content)`` tuple. Use as a context manager;
+    ``.url`` is the server's base URL.
+    """
+
+    def __init__(self, handler):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _LocalHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.handler = handler
+        self.url = "http://127.0.0.1:%s" % (self.httpd.server_address[1],)
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, kwargs={"poll_interval": 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
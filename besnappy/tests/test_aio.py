@@ -0,0 +1,214 @@
+"""
+Tests for besnappy.aio.
+"""
+
+import asyncio
+import json
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from besnappy.aio import AsyncSnappyApiSender, basic_auth_header
+
+
+class FakeResponse(object):
+    def __init__(self, body, content_type="application/json", status=200):
+        self.body = body
+        self.content_type = content_type
+        self.status = status
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise RuntimeError("HTTP %s" % (self.status,))
+
+    async def json(self):
+        return json.loads(self.body)
+
+    async def read(self):
+        return self.body.encode("utf-8")
+
+    async def text(self):
+        return self.body
+
+
+class FakeSession(object):
+    """
+    A stand-in for :class:`aiohttp.ClientSession` that records requests and
+    returns canned responses.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.requests = []
+        self.responses = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def add_response(self, method, url, response):
+        self.responses[(method, url)] = response
+
+    def request(self, method, url, **kw):
+        self.requests.append((method, url, kw))
+        return self._respond(method, url)
+
+    def _respond(self, method, url):
+        session = self
+
+        class _Ctx(object):
+            async def __aenter__(self):
+                session.in_flight += 1
+                session.max_in_flight = max(
+                    session.max_in_flight, session.in_flight)
+                try:
+                    await asyncio.sleep(session.delay)
+                finally:
+                    session.in_flight -= 1
+                return session.responses[(method, url)]
+
+            async def __aexit__(self, exc_type, exc, tb):
+                pass
+
+        return _Ctx()
+
+
+class TestBasicAuthHeader(TestCase):
+    def test_basic_auth_header(self):
+        """
+        The API key is used as the username with a dummy password.
+        """
+        self.assertEqual(basic_auth_header("key"), "Basic a2V5Ong=")
+
+
+class TestAsyncSnappyApiSenderOutsideLoop(TestCase):
+    api_url = "http://snappyapi.example.com/v1"
+
+    def test_built_outside_loop(self):
+        """
+        A sender built before the event loop is running limits concurrency
+        in the loop it is used in, and can be used by more than one loop.
+        """
+        session = FakeSession(delay=0.01)
+        for i in range(10):
+            session.add_response(
+                "GET", "%s/ticket/t%s/notes/" % (self.api_url, i),
+                FakeResponse('[]'))
+        snappy = AsyncSnappyApiSender(
+            "dummy_key", api_url=self.api_url, session=session,
+            concurrency=2)
+
+        async def fetch_all():
+            return await asyncio.gather(*[
+                snappy.get_ticket_notes("t%s" % (i,)) for i in range(10)])
+
+        for _ in range(2):
+            self.assertEqual(asyncio.run(fetch_all()), [[]] * 10)
+        self.assertEqual(session.max_in_flight, 2)
+
+
+class TestAsyncSnappyApiSender(IsolatedAsyncioTestCase):
+    api_url = "http://snappyapi.example.com/v1"
+
+    def get_snappy(self, session, **kw):
+        return AsyncSnappyApiSender(
+            "dummy_key", api_url=self.api_url, session=session, **kw)
+
+    async def test_get_accounts(self):
+        """
+        ``.get_accounts()`` returns the decoded account list.
+        """
+        session = FakeSession()
+        session.add_response(
+            "GET", "%s/accounts" % (self.api_url,),
+            FakeResponse('[{"id": 1}]'))
+        snappy = self.get_snappy(session)
+        self.assertEqual(await snappy.get_accounts(), [{"id": 1}])
+        [(_, _, kw)] = session.requests
+        self.assertEqual(
+            kw["headers"]["Authorization"], basic_auth_header("dummy_key"))
+
+    async def test_get_mailboxes_and_staff(self):
+        """
+        ``.get_mailboxes()`` and ``.get_staff()`` request the account's
+        resources.
+        """
+        session = FakeSession()
+        session.add_response(
+            "GET", "%s/account/7/mailboxes" % (self.api_url,),
+            FakeResponse('[{"id": 2}]'))
+        session.add_response(
+            "GET", "%s/account/7/staff" % (self.api_url,),
+            FakeResponse('[{"id": 3}]'))
+        snappy = self.get_snappy(session)
+        self.assertEqual(await snappy.get_mailboxes(7), [{"id": 2}])
+        self.assertEqual(await snappy.get_staff(7), [{"id": 3}])
+
+    async def test_create_note(self):
+        """
+        ``.create_note()`` posts a JSON note and returns the ticket id.
+        """
+        session = FakeSession()
+        session.add_response(
+            "POST", "%s/note" % (self.api_url,),
+            FakeResponse("abc123", content_type="text/html"))
+        snappy = self.get_snappy(session)
+        ticket_id = await snappy.create_note(
+            3642, "subject", "message", staff_id=58, scope="private")
+        self.assertEqual(ticket_id, "abc123")
+        [(_, _, kw)] = session.requests
+        self.assertEqual(json.loads(kw["data"]), {
+            "mailbox_id": 3642, "subject": "subject", "message": "message",
+            "staff_id": 58, "scope": "private"})
+
+    async def test_create_note_json_response(self):
+        """
+        ``.create_note()`` returns the response body as text even when it is
+        served as JSON, like the synchronous client.
+        """
+        session = FakeSession()
+        session.add_response(
+            "POST", "%s/note" % (self.api_url,), FakeResponse('"abc123"'))
+        snappy = self.get_snappy(session)
+        self.assertEqual(
+            await snappy.create_note(3642, "subject", "message", staff_id=58),
+            '"abc123"')
+
+    async def test_get_ticket_notes(self):
+        """
+        ``.get_ticket_notes()`` returns the decoded note list.
+        """
+        session = FakeSession()
+        session.add_response(
+            "GET", "%s/ticket/abc123/notes/" % (self.api_url,),
+            FakeResponse('[{"id": 4, "content": "hi"}]'))
+        snappy = self.get_snappy(session)
+        self.assertEqual(
+            await snappy.get_ticket_notes("abc123"),
+            [{"id": 4, "content": "hi"}])
+
+    async def test_concurrency_limit(self):
+        """
+        No more than ``concurrency`` requests are in flight at once.
+        """
+        session = FakeSession(delay=0.01)
+        for i in range(20):
+            session.add_response(
+                "GET", "%s/ticket/t%s/notes/" % (self.api_url, i),
+                FakeResponse('[]'))
+        snappy = self.get_snappy(session, concurrency=3)
+        results = await asyncio.gather(*[
+            snappy.get_ticket_notes("t%s" % (i,)) for i in range(20)])
+        self.assertEqual(results, [[]] * 20)
+        self.assertEqual(session.max_in_flight, 3)
+
+    async def test_close_leaves_provided_session(self):
+        """
+        ``.close()`` doesn't touch a session provided by the caller.
+        """
+        session = FakeSession()
+        async with self.get_snappy(session) as snappy:
+            pass
+        self.assertIs(snappy.session, session)
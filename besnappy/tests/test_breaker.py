@@ -0,0 +1,307 @@
+"""
+Tests for besnappy.breaker.
+"""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from requests import HTTPError
+from requests.exceptions import ConnectionError, ReadTimeout
+from requests_testadapter import TestSession
+
+from besnappy.breaker import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError,
+    LoadShedError, OutboxFallback, StaleCacheFallback)
+from besnappy.cache import TTLCache
+from besnappy.outbox import NoteOutbox
+from besnappy.tests.helpers import CallbackAdapter, FakeClock
+from besnappy.tickets import SnappyApiSender
+
+
+API_URL = "http://snappyapi.example.com/v1"
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.changes = []
+        self.breaker = CircuitBreaker(
+            failure_rate=0.5, min_calls=4, window=10, reset_timeout=5,
+            clock=self.clock)
+        self.breaker.add_listener(
+            lambda *change: self.changes.append(change))
+
+    def call(self, failed, endpoint="accounts"):
+        self.breaker.before(endpoint)
+        self.breaker.after(endpoint, failed)
+
+    def test_opens_on_failure_rate(self):
+        """
+        A circuit opens once enough calls in the window have failed, and
+        then rejects calls without counting them as in flight.
+        """
+        self.call(True)
+        self.call(True)
+        self.call(False)
+        self.assertEqual(self.breaker.state("accounts"), CLOSED)
+        self.call(True)
+        self.assertEqual(self.breaker.state("accounts"), OPEN)
+        self.assertEqual(self.changes, [("accounts", CLOSED, OPEN)])
+
+        with self.assertRaises(CircuitOpenError) as cm:
+            self.breaker.before("accounts")
+        self.assertEqual(cm.exception.endpoint, "accounts")
+        self.assertEqual(cm.exception.retry_after, 5)
+        self.breaker.before("staff")
+        stats = self.breaker.stats()
+        self.assertEqual(stats["accounts"]["rejected"], 1)
+        self.assertEqual(stats["accounts"]["in_flight"], 0)
+        self.assertEqual(stats["staff"]["in_flight"], 1)
+
+    def test_old_outcomes_expire(self):
+        """
+        Only calls within the window count towards the failure rate.
+        """
+        self.call(True)
+        self.call(True)
+        self.clock.sleep(11)
+        self.call(False)
+        self.call(True)
+        self.assertEqual(self.breaker.state("accounts"), CLOSED)
+        self.assertEqual(self.breaker.stats()["accounts"]["calls"], 2)
+
+    def test_half_open_probe(self):
+        """
+        After the reset timeout, one trial call is let through. Failing it
+        reopens the circuit; passing it closes the circuit.
+        """
+        for _ in range(4):
+            self.call(True)
+        self.clock.sleep(5)
+        self.assertEqual(self.breaker.state("accounts"), HALF_OPEN)
+        self.breaker.before("accounts")
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before("accounts")
+        self.breaker.after("accounts", True)
+        self.assertEqual(self.breaker.state("accounts"), OPEN)
+
+        self.clock.sleep(5)
+        self.call(False)
+        self.assertEqual(self.breaker.state("accounts"), CLOSED)
+        self.assertEqual(self.changes, [
+            ("accounts", CLOSED, OPEN),
+            ("accounts", OPEN, HALF_OPEN),
+            ("accounts", HALF_OPEN, OPEN),
+            ("accounts", OPEN, HALF_OPEN),
+            ("accounts", HALF_OPEN, CLOSED),
+        ])
+
+    def test_only_probes_close_circuit(self):
+        """
+        A request admitted before the circuit opened doesn't count as a
+        trial request when it finishes during the half-open state.
+        """
+        slow = self.breaker.before("accounts")
+        for _ in range(4):
+            self.call(True)
+        self.clock.sleep(5)
+        probe = self.breaker.before("accounts")
+        self.breaker.after("accounts", False, slow)
+        self.assertEqual(self.breaker.state("accounts"), HALF_OPEN)
+        self.breaker.after("accounts", False, probe)
+        self.assertEqual(self.breaker.state("accounts"), CLOSED)
+        self.assertEqual(self.breaker.stats()["accounts"]["in_flight"], 0)
+
+    def test_release(self):
+        """
+        Releasing a trial request records no outcome and lets another trial
+        request through.
+        """
+        for _ in range(4):
+            self.call(True)
+        self.clock.sleep(5)
+        probe = self.breaker.before("accounts")
+        self.breaker.release("accounts", probe)
+        self.assertEqual(self.breaker.state("accounts"), HALF_OPEN)
+        probe = self.breaker.before("accounts")
+        self.assertRaises(CircuitOpenError, self.breaker.before, "accounts")
+        self.breaker.after("accounts", False, probe)
+        self.assertEqual(self.breaker.state("accounts"), CLOSED)
+
+    def test_reset(self):
+        """
+        Resetting closes open circuits.
+        """
+        for _ in range(4):
+            self.call(True)
+        self.breaker.reset()
+        self.assertEqual(self.breaker.state("accounts"), CLOSED)
+        self.call(False)
+
+    def test_load_shedding(self):
+        """
+        Calls beyond ``max_concurrent`` in flight to an endpoint are shed.
+        """
+        breaker = CircuitBreaker(max_concurrent=2)
+        breaker.before("note")
+        breaker.before("note")
+        with self.assertRaises(LoadShedError):
+            breaker.before("note")
+        breaker.before("accounts")
+        breaker.after("note", False)
+        breaker.before("note")
+        self.assertEqual(breaker.stats()["note"]["rejected"], 1)
+
+
+class TestSenderCircuitBreaker(TestCase):
+    def setUp(self):
+        self.session = TestSession()
+        self.status = 503
+        self.adapter = CallbackAdapter(
+            lambda request: ('[{"id": 1}]', self.status, {}))
+        self.session.mount(API_URL, self.adapter)
+        self.breaker = CircuitBreaker(min_calls=2, reset_timeout=60)
+
+    def test_fails_fast_when_open(self):
+        """
+        Server errors open an endpoint's circuit, after which calls to it
+        fail without a request. Client errors don't count.
+        """
+        snappy = SnappyApiSender(
+            "key", api_url=API_URL, session=self.session,
+            breaker=self.breaker)
+        self.status = 404
+        for _ in range(3):
+            self.assertRaises(HTTPError, snappy.get_staff, 1)
+        self.assertEqual(self.breaker.state("account/:id/staff"), CLOSED)
+
+        self.status = 503
+        for _ in range(2):
+            self.assertRaises(HTTPError, snappy.get_accounts)
+        self.assertEqual(self.breaker.state("accounts"), OPEN)
+        self.assertRaises(CircuitOpenError, snappy.get_accounts)
+        self.assertEqual(len(self.adapter.requests), 5)
+        self.assertEqual(
+            self.breaker.stats()["accounts"]["in_flight"], 0)
+
+    def test_connection_errors_count(self):
+        """
+        Requests that raise count as failures.
+        """
+        def handler(request):
+            raise ConnectionError("refused")
+        self.session.mount(API_URL, CallbackAdapter(handler))
+        snappy = SnappyApiSender(
+            "key", api_url=API_URL, session=self.session,
+            breaker=self.breaker)
+        for _ in range(2):
+            self.assertRaises(ConnectionError, snappy.get_accounts)
+        self.assertRaises(CircuitOpenError, snappy.get_accounts)
+
+    def test_deadline_timeouts(self):
+        """
+        A request that times out because its timeout was cut short to fit
+        the call's deadline isn't counted. One that times out within its
+        own timeout is.
+        """
+        def handler(request):
+            raise ReadTimeout("timed out")
+        adapter = CallbackAdapter(handler)
+        self.session.mount(API_URL, adapter)
+        snappy = SnappyApiSender(
+            "key", api_url=API_URL, session=self.session, timeout=30,
+            deadline=5, breaker=self.breaker)
+        for _ in range(3):
+            self.assertRaises(ReadTimeout, snappy.get_accounts)
+        self.assertTrue(all(timeout <= 5 for timeout in adapter.timeouts))
+        self.assertEqual(self.breaker.state("accounts"), CLOSED)
+        stats = self.breaker.stats()["accounts"]
+        self.assertEqual(stats["calls"], 0)
+        self.assertEqual(stats["in_flight"], 0)
+
+        with snappy.timeouts(timeout=1):
+            for _ in range(2):
+                self.assertRaises(ReadTimeout, snappy.get_accounts)
+        self.assertEqual(self.breaker.state("accounts"), OPEN)
+
+    def test_interrupted_probe(self):
+        """
+        A trial request interrupted by something other than a request error
+        doesn't close the circuit.
+        """
+        clock = FakeClock()
+        breaker = CircuitBreaker(min_calls=2, reset_timeout=60, clock=clock)
+
+        def handler(request):
+            if self.status is None:
+                raise KeyboardInterrupt()
+            return "[]", self.status, {}
+        self.session.mount(API_URL, CallbackAdapter(handler))
+        snappy = SnappyApiSender(
+            "key", api_url=API_URL, session=self.session, breaker=breaker)
+        for _ in range(2):
+            self.assertRaises(HTTPError, snappy.get_accounts)
+        clock.sleep(60)
+        self.status = None
+        self.assertRaises(KeyboardInterrupt, snappy.get_accounts)
+        self.assertEqual(breaker.state("accounts"), HALF_OPEN)
+        self.assertEqual(breaker.stats()["accounts"]["in_flight"], 0)
+        self.status = 200
+        self.assertEqual(snappy.get_accounts(), [])
+        self.assertEqual(breaker.state("accounts"), CLOSED)
+
+    def test_stale_cache_fallback(self):
+        """
+        With a stale cache fallback, lookups are answered from expired
+        cache entries while the circuit is open.
+        """
+        clock = FakeClock()
+        snappy = SnappyApiSender(
+            "key", api_url=API_URL, session=self.session,
+            cache=TTLCache(clock=clock), breaker=self.breaker,
+            fallback=StaleCacheFallback())
+        self.status = 200
+        self.assertEqual(snappy.get_accounts(), [{"id": 1}])
+        clock.sleep(3600)
+        self.assertEqual(snappy.get_cached("accounts"), None)
+        self.assertEqual(
+            snappy.get_cached("accounts", stale=True), [{"id": 1}])
+
+        self.status = 503
+        self.assertRaises(HTTPError, snappy.get_accounts)
+        self.assertEqual(self.breaker.state("accounts"), OPEN)
+        self.assertEqual(snappy.get_accounts(), [{"id": 1}])
+        self.assertEqual(len(self.adapter.requests), 2)
+
+        # Lookups that were never cached still fail.
+        for _ in range(2):
+            self.assertRaises(HTTPError, snappy.get_mailboxes, 1)
+        self.assertRaises(CircuitOpenError, snappy.get_mailboxes, 1)
+
+    def test_outbox_fallback(self):
+        """
+        With an outbox fallback, notes are queued while the circuit is
+        open, keyed by their idempotency key.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        outbox = NoteOutbox(os.path.join(tmpdir, "outbox.db"))
+        self.addCleanup(outbox.close)
+        snappy = SnappyApiSender(
+            "key", api_url=API_URL, session=self.session,
+            breaker=self.breaker, fallback=OutboxFallback(outbox))
+        for _ in range(2):
+            self.assertRaises(
+                HTTPError, snappy.create_note, 1, "Subject", "Message",
+                from_addr=[{"name": "a", "address": "a@example.com"}])
+        self.assertEqual(
+            snappy.create_note(
+                1, "Subject", "Message", ticket_id="t1",
+                from_addr=[{"name": "a", "address": "a@example.com"}],
+                idempotency_key="k1"),
+            None)
+        self.assertEqual(outbox.get("k1")["state"], "pending")
+        self.assertEqual(outbox.counts()["pending"], 1)
+        self.assertEqual(len(self.adapter.requests), 2)
@@ -0,0 +1,208 @@
+"""
+Tests for besnappy.cache.
+"""
+
+import threading
+from unittest import TestCase
+
+from besnappy.cache import (
+    RevalidationCache, RevalidationEntry, TTLCache)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_get_and_set(self):
+        """
+        Values can be stored and retrieved, and lookups are counted.
+        """
+        cache = TTLCache(clock=self.clock)
+        self.assertEqual(cache.get("a"), None)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_expiry(self):
+        """
+        Entries expire after their TTL but remain available as stale data.
+        """
+        cache = TTLCache(ttl=10, clock=self.clock)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=20)
+        self.clock.now = 15
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("b"), 2)
+        self.assertEqual(cache.get_stale("a"), 1)
+
+    def test_lru_eviction(self):
+        """
+        The least recently used entry is evicted when the cache is full.
+        """
+        cache = TTLCache(maxsize=2, clock=self.clock)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_invalidation(self):
+        """
+        Entries can be dropped individually, by predicate or all at once.
+        """
+        cache = TTLCache(clock=self.clock)
+        for key in [("x", 1), ("x", 2), ("y", 1)]:
+            cache.set(key, key)
+        cache.invalidate(("x", 1))
+        self.assertEqual(len(cache), 2)
+        cache.invalidate_where(lambda key: key[0] == "y")
+        self.assertEqual(cache.get(("x", 2)), ("x", 2))
+        self.assertEqual(len(cache), 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_get_or_fetch(self):
+        """
+        ``.get_or_fetch()`` only calls ``fetch`` on a miss.
+        """
+        cache = TTLCache(ttl=10, clock=self.clock)
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(cache.get_or_fetch("a", fetch), 1)
+        self.assertEqual(cache.get_or_fetch("a", fetch), 1)
+        self.clock.now = 11
+        self.assertEqual(cache.get_or_fetch("a", fetch), 2)
+
+    def test_get_or_fetch_error_not_cached(self):
+        """
+        A failed fetch raises and leaves nothing in the cache.
+        """
+        cache = TTLCache(clock=self.clock)
+
+        def fail():
+            raise ValueError("nope")
+
+        self.assertRaises(ValueError, cache.get_or_fetch, "a", fail)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get_or_fetch("a", lambda: 5), 5)
+
+    def test_single_flight(self):
+        """
+        Concurrent fetches of the same key share one call to ``fetch``.
+        """
+        cache = TTLCache()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "value"
+
+        results = []
+
+        def worker():
+            results.append(cache.get_or_fetch("a", fetch))
+
+        leader = threading.Thread(target=worker)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=worker) for _ in range(5)]
+        for t in followers:
+            t.start()
+        while cache.stats()["coalesced"] < 5:
+            threading.Event().wait(0.001)
+        release.set()
+        for t in [leader] + followers:
+            t.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ["value"] * 6)
+
+    def test_single_flight_interrupted(self):
+        """
+        If the shared fetch is interrupted, the waiting callers fetch again
+        rather than getting ``None``.
+        """
+        class Interrupted(BaseException):
+            pass
+
+        cache = TTLCache()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            if len(calls) == 1:
+                started.set()
+                release.wait()
+                raise Interrupted()
+            return "value"
+
+        results = []
+
+        def worker():
+            try:
+                results.append(cache.get_or_fetch("a", fetch))
+            except Interrupted:
+                results.append("interrupted")
+
+        leader = threading.Thread(target=worker)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=worker) for _ in range(3)]
+        for t in followers:
+            t.start()
+        while cache.stats()["coalesced"] < 3:
+            threading.Event().wait(0.001)
+        release.set()
+        for t in [leader] + followers:
+            t.join()
+        self.assertEqual(sorted(results), ["interrupted"] + ["value"] * 3)
+        self.assertEqual(len(calls), 2)
+
+
+class TestRevalidationCache(TestCase):
+    def test_lru_eviction(self):
+        """
+        The least recently used URL is forgotten when the store is full.
+        """
+        store = RevalidationCache(maxsize=2)
+        for url in ["a", "b"]:
+            store.set(url, RevalidationEntry(None, None, url, url))
+        store.get("a")
+        store.set("c", RevalidationEntry(None, None, "c", "c"))
+        self.assertEqual(store.get("b"), None)
+        self.assertEqual(store.get("a").value, "a")
+        self.assertEqual(len(store), 2)
+        store.invalidate("a")
+        self.assertEqual(store.get("a"), None)
+
+    def test_record(self):
+        """
+        Revalidation outcomes are counted.
+        """
+        store = RevalidationCache()
+        store.record("not_modified")
+        store.record("changed")
+        store.record("changed")
+        self.assertEqual(store.stats(), {
+            "not_modified": 1, "unchanged": 0, "changed": 2, "size": 0})
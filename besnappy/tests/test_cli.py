@@ -0,0 +1,176 @@
+"""
+Tests for besnappy.cli.
+"""
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from besnappy.cli import Progress, main, read_note_specs
+from besnappy.tests.fake_snappy import FakeSnappyServer
+from besnappy.tests.helpers import FakeClock
+
+
+class TestProgress(TestCase):
+    def test_progress(self):
+        """
+        Progress is written at most once per interval, with the final
+        totals and throughput at the end.
+        """
+        clock = FakeClock()
+        stream = io.StringIO()
+        progress = Progress(stream, interval=1, clock=clock)
+        progress.update()
+        clock.now = 0.5
+        progress.update(failed=True)
+        clock.now = 2
+        progress.update()
+        progress.finish()
+        self.assertEqual(stream.getvalue(), (
+            "\r1 done, 0 failed, 0.0/s"
+            "\r3 done, 1 failed, 1.5/s"
+            "\r3 done, 1 failed, 1.5/s\n"))
+
+
+class TestReadNoteSpecs(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_csv(self):
+        """
+        CSV rows become create_note arguments, with addresses built from
+        their columns, empty cells left out and numeric ids converted to
+        integers.
+        """
+        path = self.write("notes.csv", (
+            "mailbox_id,subject,message,ticket_id,staff_id,from_address,"
+            "from_name\n"
+            "1,Hi,Hello,,12,a@example.com,Alice\n"
+            "1,Re,Again,t1,,b@example.com,\n"
+            "help@example.com,Re,Again,42,ann@example.com,,\n"))
+        self.assertEqual(list(read_note_specs(path)), [
+            {"mailbox_id": 1, "subject": "Hi", "message": "Hello",
+             "staff_id": 12,
+             "from_addr": [{"address": "a@example.com", "name": "Alice"}]},
+            {"mailbox_id": 1, "subject": "Re", "message": "Again",
+             "ticket_id": "t1", "from_addr": [{"address": "b@example.com"}]},
+            {"mailbox_id": "help@example.com", "subject": "Re",
+             "message": "Again", "ticket_id": 42,
+             "staff_id": "ann@example.com"},
+        ])
+
+    def test_jsonl(self):
+        """
+        JSONL files have an object of arguments per line.
+        """
+        path = self.write("notes.txt", '{"mailbox_id": 1}\n\n{"subject": 2}\n')
+        self.assertEqual(list(read_note_specs(path)), [
+            {"mailbox_id": 1}, {"subject": 2}])
+
+
+class TestMain(TestCase):
+    def setUp(self):
+        self.server = FakeSnappyServer()
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def run_cli(self, *argv):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with patch("sys.stdout", stdout), patch("sys.stderr", stderr):
+            status = main([
+                "--api-key", "dummy_key", "--api-url", self.server.api_url,
+            ] + list(argv))
+        lines = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        return status, lines, stderr.getvalue()
+
+    def test_listing(self):
+        """
+        Accounts, mailboxes and staff are listed one JSON object per line.
+        """
+        status, [account], _ = self.run_cli("--timeout", "5", "accounts")
+        self.assertEqual(status, 0)
+        status, mailboxes, _ = self.run_cli("mailboxes", str(account["id"]))
+        self.assertEqual(status, 0)
+        self.assertEqual(mailboxes[0]["account_id"], account["id"])
+        status, staff, _ = self.run_cli("staff", str(account["id"]))
+        self.assertEqual((status, len(staff) >= 1), (0, True))
+
+    def test_notes(self):
+        """
+        Notes are fetched for tickets from the command line and a file, with
+        progress on stderr.
+        """
+        path = os.path.join(self.tmpdir, "tickets.txt")
+        with open(path, "w") as f:
+            f.write("t2\nt3\n")
+        status, results, stderr = self.run_cli(
+            "--concurrency", "2", "notes", "t1", "--tickets", path)
+        self.assertEqual(status, 0)
+        self.assertEqual(
+            sorted(r["ticket_id"] for r in results), ["t1", "t2", "t3"])
+        self.assertTrue(all(r["notes"] for r in results))
+        self.assertIn("\r3 done, 0 failed, ", stderr)
+
+    def test_create_notes(self):
+        """
+        Notes are created from a file, reporting a ticket or an error for
+        each line and failing if any note failed.
+        """
+        path = os.path.join(self.tmpdir, "notes.jsonl")
+        with open(path, "w") as f:
+            f.write('{"mailbox_id": 1, "subject": "s", "message": "m",'
+                    ' "staff_id": 2}\n')
+            f.write('{"mailbox_id": 1}\n')
+        status, results, _ = self.run_cli(
+            "--quiet", "--rate", "100", "create-notes", path)
+        self.assertEqual(status, 1)
+        self.assertEqual([r["line"] for r in results], [1, 2])
+        self.assertEqual(len(results[0]["ticket_id"]), 16)
+        self.assertIn("error", results[1])
+
+    def test_export(self):
+        """
+        The export command writes an NDJSON export.
+        """
+        path = os.path.join(self.tmpdir, "export.ndjson")
+        status, _, stderr = self.run_cli("export", path)
+        self.assertEqual(status, 0)
+        with open(path) as f:
+            types = set(json.loads(line)["type"] for line in f)
+        self.assertEqual(types, set(["account", "mailbox", "staff"]))
+        self.assertIn("records written to", stderr)
+
+    def test_missing_api_key(self):
+        """
+        An API key is required.
+        """
+        with patch.dict(os.environ, {"BESNAPPY_API_KEY": ""}), \
+                patch("sys.stderr", io.StringIO()):
+            self.assertRaises(SystemExit, main, ["accounts"])
+
+
+class TestStartup(TestCase):
+    def test_deferred_imports(self):
+        """
+        Importing the command line tool doesn't import the HTTP clients.
+        """
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys, besnappy.cli;"
+            " print(sorted(set(['requests', 'aiohttp']) & set(sys.modules)))"])
+        self.assertEqual(output.strip(), b"[]")
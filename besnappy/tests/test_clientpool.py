@@ -0,0 +1,149 @@
+"""
+Tests for besnappy.clientpool.
+"""
+
+import base64
+import json
+from unittest import TestCase
+
+from requests_testadapter import TestSession
+
+from besnappy.clientpool import SnappyClientPool
+from besnappy.ratelimit import TokenBucket
+from besnappy.tests.helpers import CallbackAdapter, FakeClock
+
+
+API_URL = "http://snappyapi.example.com/v1"
+
+# Accounts and mailboxes visible to each API key.
+ACCOUNTS = {
+    "key-a": {1: [11, 12]},
+    "key-b": {2: [21]},
+}
+
+
+def request_key(request):
+    auth = request.headers["Authorization"].split(" ", 1)[1]
+    return base64.b64decode(auth).decode("ascii").split(":")[0]
+
+
+def handler(request):
+    accounts = ACCOUNTS[request_key(request)]
+    path = request.url[len(API_URL) + 1:]
+    if request.method == "POST":
+        data = json.loads(request.body)
+        return "ticket-%s" % (data["mailbox_id"],), 200, {}
+    if path == "accounts":
+        return json.dumps([{"id": i} for i in accounts]), 200, {}
+    account_id = int(path.split("/")[1])
+    return json.dumps([{"id": i} for i in accounts[account_id]]), 200, {}
+
+
+class TestSnappyClientPool(TestCase):
+    def setUp(self):
+        self.session = TestSession()
+        self.adapter = CallbackAdapter(handler)
+        self.session.mount(API_URL, self.adapter)
+        self.clock = FakeClock()
+
+    def make_pool(self, **kw):
+        return SnappyClientPool(
+            api_url=API_URL, session=self.session, clock=self.clock, **kw)
+
+    def test_routing(self):
+        """
+        Calls are made with the key registered for the account or mailbox,
+        through one shared session.
+        """
+        pool = self.make_pool()
+        pool.add_key("key-a", account_ids=[1], mailbox_ids=[11, 12])
+        pool.add_key("key-b", account_ids=[2], mailbox_ids=[21])
+
+        self.assertEqual(pool.create_note(21, "Subject", "Message"),
+                         "ticket-21")
+        self.assertEqual(pool.get_mailboxes(1), [{"id": 11}, {"id": 12}])
+        self.assertEqual(
+            [request_key(r) for r in self.adapter.requests],
+            ["key-b", "key-a"])
+        self.assertIs(pool.for_mailbox(11), pool.for_account(1))
+        self.assertIs(pool.for_account(2).session, pool.for_account(1).session)
+        self.assertRaises(KeyError, pool.for_mailbox, 99)
+        self.assertRaises(KeyError, pool.sender, "key-c")
+
+    def test_discover(self):
+        """
+        Routes can be discovered from the accounts each key can see.
+        """
+        pool = self.make_pool()
+        pool.add_key("key-a")
+        pool.add_key("key-b")
+        pool.discover()
+        self.assertEqual(pool.stats(), {
+            "keys": 2, "accounts": 2, "mailboxes": 3, "senders": 2})
+        self.assertEqual(pool.for_mailbox(12).api_key, "key-a")
+        self.assertEqual(pool.for_mailbox(21).api_key, "key-b")
+
+    def test_rate_limits_per_key(self):
+        """
+        Each key gets its own rate limiter, with optional overrides.
+        """
+        pool = self.make_pool(rate_limit=5)
+        pool.add_key("pool-key-a", account_ids=[1])
+        pool.add_key("pool-key-b", account_ids=[2], rate_limit=1)
+        limiter_a = pool.for_account(1).rate_limiter
+        limiter_b = pool.for_account(2).rate_limiter
+        self.assertIsNot(limiter_a, limiter_b)
+        self.assertEqual((limiter_a.rate, limiter_b.rate), (5, 1))
+
+    def test_own_rate_limiter(self):
+        """
+        A key can be given its own limiter, so pools using the same key
+        with different rates don't clash over the process-wide limiter.
+        """
+        pool_a = self.make_pool(rate_limit=5)
+        pool_a.add_key("pool-key-own", account_ids=[1])
+        pool_a.for_account(1)
+        pool_b = self.make_pool(rate_limit=2)
+        pool_b.add_key("pool-key-own", account_ids=[1])
+        self.assertRaises(ValueError, pool_b.for_account, 1)
+
+        limiter = TokenBucket(2)
+        pool_b.add_key("pool-key-own", rate_limit=limiter)
+        self.assertIs(pool_b.for_account(1).rate_limiter, limiter)
+        self.assertEqual(pool_a.for_account(1).rate_limiter.rate, 5)
+
+    def test_conflicting_sender_options(self):
+        """
+        Sender options that the pool sets itself are rejected.
+        """
+        with self.assertRaises(TypeError) as cm:
+            self.make_pool(api_key="key", keep_alive=False)
+        self.assertIn("api_key, keep_alive", str(cm.exception))
+        pool = self.make_pool(timeout=5)
+        pool.add_key("key-a", account_ids=[1])
+        self.assertEqual(pool.for_account(1).timeout, 5)
+
+    def test_evict_idle(self):
+        """
+        Idle senders are dropped and recreated on next use, keeping the
+        shared cache.
+        """
+        pool = self.make_pool(idle_timeout=60, cache=True)
+        pool.add_key("key-a", account_ids=[1])
+        pool.add_key("key-b", account_ids=[2])
+        sender_a = pool.for_account(1)
+        pool.get_mailboxes(1)
+        self.clock.now = 30
+        pool.for_account(2)
+        self.clock.now = 70
+        self.assertEqual(pool.evict_idle(), 1)
+        self.assertEqual(pool.stats()["senders"], 1)
+
+        self.assertIsNot(pool.for_account(1), sender_a)
+        pool.get_mailboxes(1)
+        self.assertEqual(len(self.adapter.requests), 1)
+
+        # Senders are also swept on use once the idle timeout has passed.
+        self.clock.now = 200
+        pool.for_account(1)
+        self.assertEqual(pool.stats()["senders"], 1)
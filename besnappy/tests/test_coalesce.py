@@ -0,0 +1,129 @@
+"""
+Tests for besnappy.coalesce.
+"""
+
+import json
+import threading
+from unittest import TestCase
+
+from requests import HTTPError
+from requests_testadapter import TestSession
+
+from besnappy.coalesce import NoteCoalescer
+from besnappy.tests.helpers import CallbackAdapter
+from besnappy.tickets import SnappyApiSender
+
+
+API_URL = "http://snappyapi.example.com/v1"
+
+
+class TestNoteCoalescer(TestCase):
+    def setUp(self):
+        self.posted = []
+        self.lock = threading.Lock()
+        self.fail = False
+        session = TestSession()
+        session.mount(API_URL, CallbackAdapter(self.handler))
+        self.sender = SnappyApiSender(
+            "test_key", api_url=API_URL, session=session)
+
+    def handler(self, request):
+        data = json.loads(request.body)
+        with self.lock:
+            self.posted.append(data)
+            count = len(self.posted)
+        if self.fail:
+            return "oops", 500, {}
+        return data.get("id", "new-%d" % (count,)), 200, {}
+
+    def make_coalescer(self, **kw):
+        coalescer = NoteCoalescer(self.sender, **kw)
+        self.addCleanup(coalescer.close)
+        return coalescer
+
+    def test_merge(self):
+        """
+        Notes for the same ticket and scope are merged into one post, and
+        every future resolves to the ticket.
+        """
+        coalescer = self.make_coalescer(window=60)
+        futures = [
+            coalescer.submit(1, "Alert %d" % (i,), "m%d" % (i,),
+                             ticket_id="t1", staff_id=2)
+            for i in range(3)]
+        other_scope = coalescer.submit(
+            1, "Private", "p", ticket_id="t1", staff_id=2, scope="private")
+        other_ticket = coalescer.submit(1, "Other", "o", ticket_id="t2",
+                                        staff_id=2)
+        self.assertEqual(coalescer.pending(), 5)
+        self.assertEqual(coalescer.flush(), 3)
+        self.assertEqual(
+            [f.result(5) for f in futures + [other_scope, other_ticket]],
+            ["t1", "t1", "t1", "t1", "t2"])
+        merged = [p for p in self.posted if "scope" not in p and
+                  p["id"] == "t1"]
+        self.assertEqual(merged, [{
+            "mailbox_id": 1, "id": "t1", "staff_id": 2,
+            "subject": "Alert 0", "message": "m0\n\nm1\n\nm2"}])
+        self.assertEqual((coalescer.submitted, coalescer.posted), (5, 3))
+
+    def test_limits(self):
+        """
+        Batches are posted early when they reach the note or length limit.
+        """
+        coalescer = self.make_coalescer(window=60, max_notes=2, max_length=7)
+        futures = [coalescer.submit(1, "s", m, ticket_id="t1", staff_id=2)
+                   for m in ["a", "b", "c", "ddddd"]]
+        self.assertEqual(coalescer.pending(), 1)
+        coalescer.flush()
+        for future in futures:
+            future.result(5)
+        self.assertEqual(
+            sorted(p["message"] for p in self.posted),
+            ["a\n\nb", "c", "ddddd"])
+
+    def test_window(self):
+        """
+        Held notes are posted when the window ends.
+        """
+        coalescer = self.make_coalescer(window=0.05)
+        futures = [coalescer.submit(1, "s", "m", ticket_id="t1", staff_id=2)
+                   for _ in range(2)]
+        self.assertEqual([f.result(5) for f in futures], ["t1", "t1"])
+        self.assertEqual(len(self.posted), 1)
+
+    def test_new_tickets_not_merged(self):
+        """
+        Notes that create tickets are posted individually.
+        """
+        coalescer = self.make_coalescer(window=60)
+        futures = [coalescer.submit(1, "s", "m", staff_id=2)
+                   for _ in range(2)]
+        self.assertEqual(
+            sorted(f.result(5) for f in futures), ["new-1", "new-2"])
+
+    def test_failure_and_cancel(self):
+        """
+        A failed post fails every merged future; cancelled notes are left
+        out.
+        """
+        self.fail = True
+        coalescer = self.make_coalescer(window=60)
+        futures = [coalescer.submit(1, "s", m, ticket_id="t1", staff_id=2)
+                   for m in ["a", "b", "c"]]
+        self.assertTrue(futures[1].cancel())
+        coalescer.close()
+        self.assertRaises(HTTPError, futures[0].result, 5)
+        self.assertRaises(HTTPError, futures[2].result, 5)
+        self.assertEqual([p["message"] for p in self.posted], ["a\n\nc"])
+        self.assertRaises(RuntimeError, coalescer.submit, 1, "s", "m")
+
+    def test_all_cancelled(self):
+        """
+        A batch whose notes were all cancelled isn't posted.
+        """
+        coalescer = self.make_coalescer(window=60)
+        future = coalescer.submit(1, "s", "a", ticket_id="t1", staff_id=2)
+        self.assertTrue(future.cancel())
+        coalescer.close()
+        self.assertEqual(self.posted, [])
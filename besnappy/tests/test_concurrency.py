@@ -0,0 +1,119 @@
+"""
+Tests for besnappy.concurrency.
+"""
+
+import threading
+import time
+from unittest import TestCase
+
+from besnappy.concurrency import bounded_map
+
+
+class TestBoundedMap(TestCase):
+    def test_ordered_results(self):
+        """
+        Results are yielded in input order by default, even when later items
+        finish first.
+        """
+        def slow_for_small(n):
+            time.sleep(0.01 * (5 - n))
+            return n * 10
+
+        results = list(bounded_map(slow_for_small, range(5), max_workers=5))
+        self.assertEqual(results, [(n, n * 10) for n in range(5)])
+
+    def test_unordered_results(self):
+        """
+        With ``ordered=False``, every result is yielded once in completion
+        order.
+        """
+        results = list(bounded_map(
+            lambda n: n * 10, range(20), max_workers=4, ordered=False))
+        self.assertEqual(sorted(results), [(n, n * 10) for n in range(20)])
+
+    def test_exceptions_are_yielded(self):
+        """
+        An exception raised for one item is yielded in place of its result
+        and doesn't stop the other items.
+        """
+        def fail_on_odd(n):
+            if n % 2:
+                raise ValueError(n)
+            return n
+
+        results = list(bounded_map(fail_on_odd, range(4), max_workers=2))
+        self.assertEqual([item for item, _ in results], [0, 1, 2, 3])
+        self.assertEqual(results[0][1], 0)
+        self.assertTrue(isinstance(results[1][1], ValueError))
+        self.assertEqual(results[2][1], 2)
+        self.assertTrue(isinstance(results[3][1], ValueError))
+
+    def test_bounded_concurrency(self):
+        """
+        No more than ``max_workers`` calls run at once.
+        """
+        lock = threading.Lock()
+        state = {"running": 0, "max": 0}
+
+        def track(n):
+            with lock:
+                state["running"] += 1
+                state["max"] = max(state["max"], state["running"])
+            time.sleep(0.005)
+            with lock:
+                state["running"] -= 1
+            return n
+
+        list(bounded_map(track, range(30), max_workers=3))
+        self.assertEqual(state["max"], 3)
+
+    def test_lazy_consumption(self):
+        """
+        Items are pulled from the input lazily, so no more than ``backlog``
+        items are taken ahead of the consumer.
+        """
+        pulled = []
+
+        def items():
+            for n in range(1000):
+                pulled.append(n)
+                yield n
+
+        results = bounded_map(lambda n: n, items(), max_workers=2, backlog=4)
+        self.assertEqual(next(results), (0, 0))
+        self.assertTrue(len(pulled) <= 5, pulled)
+        results.close()
+
+    def test_invalid_max_workers(self):
+        """
+        ``max_workers`` must be positive.
+        """
+        self.assertRaises(
+            ValueError, list, bounded_map(lambda n: n, [1], max_workers=0))
+
+    def test_stopping_cancels_pending_calls(self):
+        """
+        Calls that haven't started when the consumer stops are cancelled
+        rather than run.
+        """
+        for ordered in (True, False):
+            called = []
+            started = threading.Event()
+            release = threading.Event()
+
+            def func(n):
+                called.append(n)
+                if n:
+                    started.set()
+                    release.wait(5)
+                return n
+
+            results = bounded_map(
+                func, range(10), max_workers=1, ordered=ordered, backlog=5)
+            self.assertEqual(next(results), (0, 0))
+            started.wait(5)
+            timer = threading.Timer(0.05, release.set)
+            timer.start()
+            results.close()
+            timer.join()
+            self.assertEqual(called, [0, 1])
@@ -0,0 +1,200 @@
+"""
+Tests for besnappy.directory.
+"""
+
+import json
+import threading
+from unittest import TestCase
+
+from requests import HTTPError
+from requests_testadapter import TestSession
+
+from besnappy.directory import DirectoryIndex
+from besnappy.tests.helpers import CallbackAdapter, FakeClock
+from besnappy.tickets import SnappyApiSender
+
+
+API_URL = "http://snappyapi.example.com/v1"
+
+
+class TestDirectoryIndex(TestCase):
+    def setUp(self):
+        self.accounts = [{"id": 1}, {"id": 2}]
+        self.mailboxes = {
+            1: [
+                {"id": 10, "account_id": 1, "address": "Support@Example.com",
+                 "display": "Support"},
+                {"id": 11, "account_id": 1, "address": "sales@example.com",
+                 "custom_address": "deals@example.org", "display": "Sales"},
+            ],
+            2: [
+                {"id": 20, "account_id": 2, "address": "help@example.net",
+                 "display": "Support"},
+            ],
+        }
+        self.staff = {
+            1: [
+                {"id": 100, "email": "ann@example.com", "first_name": "Ann",
+                 "last_name": "Lee"},
+                {"id": 101, "email": "bob@example.com", "first_name": "Bob",
+                 "last_name": None},
+            ],
+            2: [
+                {"id": 100, "email": "ann@example.com", "first_name": "Ann",
+                 "last_name": "Lee"},
+            ],
+        }
+        self.status = 200
+        self.session = TestSession()
+        self.adapter = CallbackAdapter(self.handle)
+        self.session.mount(API_URL, self.adapter)
+        self.sender = SnappyApiSender(
+            "key", api_url=API_URL, session=self.session)
+        self.clock = FakeClock()
+
+    def handle(self, request):
+        parts = request.url[len(API_URL) + 1:].strip("/").split("/")
+        if parts == ["accounts"]:
+            body = self.accounts
+        elif parts[2] == "mailboxes":
+            body = self.mailboxes[int(parts[1])]
+        else:
+            body = self.staff[int(parts[1])]
+        return json.dumps(body), self.status, {}
+
+    def test_lookups(self):
+        """
+        Mailboxes and staff are found by id, by address regardless of case
+        and by name. Unknown and ambiguous keys raise KeyError.
+        """
+        index = DirectoryIndex(self.sender, clock=self.clock)
+        self.assertEqual(index.mailbox_id("support@example.COM"), 10)
+        self.assertEqual(index.mailbox_id(" DEALS@example.org"), 11)
+        self.assertEqual(index.mailbox(20)["address"], "help@example.net")
+        self.assertEqual(index.mailbox_id("sales"), 11)
+        self.assertEqual(index.staff_id("Ann@Example.com"), 100)
+        self.assertEqual(index.staff_id("ann lee"), 100)
+        self.assertEqual(index.staff_id("Bob"), 101)
+        self.assertEqual(index.staff(101)["email"], "bob@example.com")
+
+        self.assertRaises(KeyError, index.mailbox_id, "support")
+        self.assertRaises(KeyError, index.mailbox_id, "nobody@example.com")
+        self.assertRaises(KeyError, index.staff_id, 999)
+        self.assertRaises(KeyError, index.staff_id, "Carol")
+        # One account, two mailboxes and two staff lists.
+        self.assertEqual(len(self.adapter.requests), 5)
+
+    def test_account_ids(self):
+        """
+        Only the given accounts are indexed.
+        """
+        index = DirectoryIndex(
+            self.sender, account_ids=[2], clock=self.clock)
+        self.assertEqual(index.refresh(), {"mailboxes": 1, "staff": 1})
+        self.assertEqual(index.mailbox_id("support"), 20)
+        self.assertEqual(len(self.adapter.requests), 2)
+
+    def test_background_refresh(self):
+        """
+        Once the index is older than max_age, a lookup answers from the old
+        index and refreshes it in the background.
+        """
+        index = DirectoryIndex(self.sender, max_age=60, clock=self.clock)
+        self.assertRaises(KeyError, index.staff_id, "carol@example.com")
+        self.staff[1].append(
+            {"id": 102, "email": "carol@example.com", "first_name": "Carol"})
+
+        self.clock.sleep(30)
+        self.assertRaises(KeyError, index.staff_id, "carol@example.com")
+        index.wait()
+        self.assertEqual(index.refreshes, 1)
+
+        self.clock.sleep(30)
+        self.assertRaises(KeyError, index.staff_id, "carol@example.com")
+        index.wait()
+        self.assertEqual(index.refreshes, 2)
+        self.assertEqual(index.staff_id("carol@example.com"), 102)
+
+    def test_failed_background_refresh(self):
+        """
+        If a background refresh fails, the old index is kept and the error
+        recorded, and the refresh is retried after another max_age.
+        """
+        index = DirectoryIndex(self.sender, max_age=60, clock=self.clock)
+        index.refresh()
+        self.status = 503
+        self.clock.sleep(60)
+        self.assertEqual(index.mailbox_id("sales"), 11)
+        index.wait()
+        self.assertIsInstance(index.last_error, HTTPError)
+        requests = len(self.adapter.requests)
+        self.assertEqual(index.mailbox_id("sales"), 11)
+        index.wait()
+        self.assertEqual(len(self.adapter.requests), requests)
+
+        self.status = 200
+        self.clock.sleep(60)
+        index.mailbox_id("sales")
+        index.wait()
+        self.assertEqual(index.last_error, None)
+        self.assertEqual(index.refreshes, 2)
+
+    def test_readers_do_not_block(self):
+        """
+        Lookups carry on while a refresh is waiting on the API.
+        """
+        index = DirectoryIndex(self.sender, clock=self.clock)
+        index.refresh()
+        release = threading.Event()
+        handle = self.handle
+
+        def slow_handle(request):
+            release.wait(5)
+            return handle(request)
+        self.session.mount(API_URL, CallbackAdapter(slow_handle))
+        thread = threading.Thread(target=index.refresh)
+        thread.start()
+        try:
+            self.assertEqual(index.staff_id("bob@example.com"), 101)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(index.refreshes, 2)
+
+    def test_create_note_resolves_addresses(self):
+        """
+        create_note accepts email addresses for the mailbox and staff ids.
+        """
+        posted = []
+
+        def handle(request):
+            if request.method == "POST":
+                posted.append(json.loads(request.body))
+                return "t1", 200, {}
+            return self.handle(request)
+        self.session.mount(API_URL, CallbackAdapter(handle))
+        index = DirectoryIndex(self.sender, account_ids=[1])
+        sender = SnappyApiSender(
+            "key", api_url=API_URL, session=self.session, directory=index)
+        ticket_id = sender.create_note(
+            "SUPPORT@example.com", "Subject", "Message",
+            to_addr=[{"name": "C", "address": "c@example.com"}],
+            staff_id="ann@example.com")
+        self.assertEqual(ticket_id, "t1")
+        self.assertEqual(posted[0]["mailbox_id"], 10)
+        self.assertEqual(posted[0]["staff_id"], 100)
+        self.assertRaises(
+            KeyError, sender.create_note, "nobody@example.com", "S", "M",
+            from_addr=[{"name": "C", "address": "c@example.com"}])
+        self.assertEqual(len(posted), 1)
+
+    def test_create_note_default_directory(self):
+        """
+        Without a directory, the sender creates one when it first resolves
+        an address.
+        """
+        self.assertEqual(self.sender.directory, None)
+        self.assertRaises(
+            KeyError, self.sender.create_note, "nobody@example.com", "S",
+            "M", from_addr=[{"name": "C", "address": "c@example.com"}])
+        self.assertIsInstance(self.sender.directory, DirectoryIndex)
@@ -0,0 +1,238 @@
+"""
+Tests for besnappy.export.
+"""
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from requests_testadapter import TestSession
+
+from besnappy.export import Exporter, ExportError, export
+from besnappy.tests.helpers import CallbackAdapter
+from besnappy.tickets import SnappyApiSender
+
+
+API_URL = "http://snappyapi.example.com/v1"
+
+
+class FakeSnappy(object):
+    """
+    Serves two accounts with a mailbox and a staff member each, and notes
+    for any ticket. Tickets in ``failing`` return a server error and those
+    in ``two_notes`` have a second note.
+    """
+
+    def __init__(self):
+        self.failing = set()
+        self.two_notes = set()
+        self.paths = []
+
+    def __call__(self, request):
+        path = request.url[len(API_URL) + 1:]
+        self.paths.append(path)
+        parts = path.split("/")
+        if path == "accounts":
+            return json.dumps([{"id": 1}, {"id": 2}]), 200, {}
+        if parts[0] == "account" and parts[2] == "mailboxes":
+            return json.dumps([{"id": int(parts[1]) * 10}]), 200, {}
+        if parts[0] == "account" and parts[2] == "staff":
+            return json.dumps([{"id": int(parts[1]) * 100}]), 200, {}
+        ticket_id = parts[1]
+        if ticket_id in self.failing:
+            return "oops", 500, {}
+        notes = [{"id": "%s-note" % (ticket_id,)}]
+        if ticket_id in self.two_notes:
+            notes.append({"id": "%s-note-2" % (ticket_id,)})
+        return json.dumps(notes), 200, {}
+
+
+class InterruptingCodec(object):
+    """
+    Wraps a codec, raising KeyboardInterrupt once when encoding the record
+    with the given data id.
+    """
+
+    def __init__(self, codec, data_id):
+        self.codec = codec
+        self.data_id = data_id
+
+    def loads(self, data):
+        return self.codec.loads(data)
+
+    def dumps(self, value):
+        if value.get("data", {}).get("id") == self.data_id:
+            self.data_id = None
+            raise KeyboardInterrupt()
+        return self.codec.dumps(value)
+
+
+class InterruptAfterWrite(object):
+    """
+    Wraps an output file, raising KeyboardInterrupt once after writing data
+    containing ``markers[0]``, as if interrupted before the write was
+    counted.
+    """
+
+    def __init__(self, out, markers):
+        self.__dict__.update(out=out, markers=markers)
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.out, name, value)
+
+    def write(self, data):
+        self.out.write(data)
+        if self.markers and self.markers[0] in data:
+            self.markers.pop()
+            raise KeyboardInterrupt()
+        return len(data)
+
+
+class InterruptingExporter(Exporter):
+    def __init__(self, *args, **kwargs):
+        self.markers = [kwargs.pop("marker")]
+        super(InterruptingExporter, self).__init__(*args, **kwargs)
+
+    def _start_member(self):
+        super(InterruptingExporter, self)._start_member()
+        self._out = InterruptAfterWrite(self._out, self.markers)
+
+
+def read_lines(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        return [json.loads(line) for line in f]
+
+
+class TestExporter(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.api = FakeSnappy()
+        session = TestSession()
+        session.mount(API_URL, CallbackAdapter(self.api))
+        self.sender = SnappyApiSender(
+            "test_key", api_url=API_URL, session=session)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_export(self):
+        """
+        Accounts, mailboxes, staff and notes are written in order, one
+        record per line.
+        """
+        path = self.path("export.ndjson")
+        stats = export(self.sender, path, ["t1", "t2"])
+        self.assertEqual(stats, {"units": 7, "records": 8, "resumed_from": 0})
+        self.assertEqual(read_lines(path), [
+            {"type": "account", "data": {"id": 1}},
+            {"type": "account", "data": {"id": 2}},
+            {"type": "mailbox", "account_id": 1, "data": {"id": 10}},
+            {"type": "staff", "account_id": 1, "data": {"id": 100}},
+            {"type": "mailbox", "account_id": 2, "data": {"id": 20}},
+            {"type": "staff", "account_id": 2, "data": {"id": 200}},
+            {"type": "note", "ticket_id": "t1", "data": {"id": "t1-note"}},
+            {"type": "note", "ticket_id": "t2", "data": {"id": "t2-note"}},
+        ])
+
+        # Running a finished export again does nothing.
+        del self.api.paths[:]
+        self.assertEqual(export(self.sender, path, ["t1", "t2"])["units"], 7)
+        self.assertEqual(self.api.paths, [])
+
+    def test_resume(self):
+        """
+        A failed export checkpoints its progress and resumes from there
+        without refetching or duplicating records.
+        """
+        path = self.path("export.ndjson")
+        tickets = ["t%d" % (i,) for i in range(10)]
+        self.api.failing.add("t6")
+        exporter = Exporter(self.sender, path, checkpoint_every=2)
+        self.assertRaises(ExportError, exporter.run, tickets)
+        with open(path + ".checkpoint") as f:
+            self.assertEqual(json.load(f)["units"], 11)
+
+        self.api.failing.clear()
+        del self.api.paths[:]
+        stats = export(self.sender, path, tickets, checkpoint_every=2)
+        self.assertEqual(stats["resumed_from"], 11)
+        self.assertEqual(stats["units"], 15)
+        self.assertEqual(
+            sorted(self.api.paths),
+            ["ticket/t%d/notes/" % (i,) for i in range(6, 10)])
+        notes = [r["ticket_id"] for r in read_lines(path)
+                 if r["type"] == "note"]
+        self.assertEqual(notes, tickets)
+
+    def test_gzip_resume(self):
+        """
+        Compressed exports stay readable across checkpoints and resumes.
+        """
+        path = self.path("export.ndjson.gz")
+        tickets = ["t%d" % (i,) for i in range(10)]
+        self.api.failing.add("t4")
+        self.assertRaises(
+            ExportError, export, self.sender, path, tickets,
+            checkpoint_every=3)
+        self.assertEqual(len(read_lines(path)), 6 + 4)
+
+        self.api.failing.clear()
+        stats = export(self.sender, path, tickets, checkpoint_every=3)
+        self.assertEqual(stats["records"], 6 + 10)
+        records = read_lines(path)
+        self.assertEqual(len(records), 16)
+        self.assertEqual(
+            [r["ticket_id"] for r in records if r["type"] == "note"], tickets)
+
+        self.assertRaises(
+            ValueError, export, self.sender, path[:-3], tickets,
+            checkpoint_path=path + ".checkpoint")
+
+    def check_interrupted_unit(self, path):
+        tickets = ["t%d" % (i,) for i in range(6)]
+        self.api.two_notes.update(tickets)
+        exporter = InterruptingExporter(
+            self.sender, path, checkpoint_every=4, marker=b"t3-note-2")
+        self.assertRaises(KeyboardInterrupt, exporter.run, tickets)
+        stats = export(self.sender, path, tickets, checkpoint_every=4)
+        self.assertEqual(stats["records"], 6 + 12)
+        notes = [r["data"]["id"] for r in read_lines(path)
+                 if r["type"] == "note"]
+        self.assertEqual(notes, [
+            "%s-note%s" % (t, suffix)
+            for t in tickets for suffix in ("", "-2")])
+
+    def test_interrupted_unit(self):
+        """
+        An export interrupted part way through writing a unit resumes
+        without duplicating records.
+        """
+        self.check_interrupted_unit(self.path("export.ndjson"))
+
+    def test_gzip_interrupted_unit(self):
+        """
+        The same holds for compressed output.
+        """
+        self.check_interrupted_unit(self.path("export.ndjson.gz"))
+
+    def test_interrupted_accounts(self):
+        """
+        An export interrupted while writing the account list starts again
+        from the beginning.
+        """
+        path = self.path("export.ndjson")
+        codec = self.sender.codec
+        self.sender.codec = InterruptingCodec(codec, 2)
+        self.assertRaises(KeyboardInterrupt, export, self.sender, path)
+        self.sender.codec = codec
+        stats = export(self.sender, path)
+        self.assertEqual(stats["records"], 6)
+        self.assertEqual(len(read_lines(path)), 6)
@@ -0,0 +1,51 @@
+"""
+Tests for besnappy.tests.fake_snappy.
+"""
+
+from unittest import TestCase
+
+from requests import HTTPError
+
+from besnappy.tests.fake_snappy import FakeSnappyServer
+from besnappy.tickets import SnappyApiSender
+
+
+class TestFakeSnappyServer(TestCase):
+    def test_recorded_responses(self):
+        """
+        The fake server answers the client's requests with recorded data.
+        """
+        with FakeSnappyServer() as server:
+            snappy = SnappyApiSender("dummy_key", api_url=server.api_url)
+            [account] = snappy.get_accounts()
+            mailboxes = snappy.get_mailboxes(account["id"])
+            staff = snappy.get_staff(account["id"])
+            ticket_id = snappy.create_note(
+                mailboxes[0]["id"], "subject", "message",
+                staff_id=staff[0]["id"])
+            notes = snappy.get_ticket_notes(ticket_id)
+        self.assertEqual(mailboxes[0]["account_id"], account["id"])
+        self.assertEqual(len(ticket_id), 16)
+        self.assertTrue(len(notes) >= 1)
+        self.assertEqual(server.request_count, 5)
+
+    def test_generated_notes(self):
+        """
+        Ticket notes responses can be padded to a given number of notes,
+        newest first.
+        """
+        with FakeSnappyServer(notes_per_ticket=50) as server:
+            snappy = SnappyApiSender("dummy_key", api_url=server.api_url)
+            notes = snappy.get_ticket_notes("abc")
+        self.assertEqual(len(notes), 50)
+        ids = [note["id"] for note in notes]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+    def test_error_injection(self):
+        """
+        Errors are injected at the configured rate.
+        """
+        with FakeSnappyServer(error_rate=1.0) as server:
+            snappy = SnappyApiSender("dummy_key", api_url=server.api_url)
+            self.assertRaises(HTTPError, snappy.get_accounts)
+        self.assertEqual(server.error_count, 1)
@@ -0,0 +1,290 @@
+"""
+Tests for besnappy.hedging.
+"""
+
+import threading
+import time
+from unittest import TestCase
+
+from requests import HTTPError
+from requests.exceptions import ReadTimeout, Timeout
+from requests_testadapter import TestSession
+
+from besnappy.hedging import (
+    DeadlineExceeded, HedgePolicy, LatencyTracker, attempt_timeout)
+from besnappy.metrics import InMemoryMetrics
+from besnappy.ratelimit import Backoff
+from besnappy.tests.helpers import CallbackAdapter, LocalHTTPServer
+from besnappy.tickets import SnappyApiSender
+
+
+API_URL = "http://snappyapi.example.com/v1"
+
+
+class TestAttemptTimeout(TestCase):
+    def test_attempt_timeout(self):
+        """
+        Timeouts are capped at the time left before the deadline, and an
+        expired deadline raises an error that is a requests Timeout.
+        """
+        def clock():
+            return 10.0
+
+        self.assertEqual(attempt_timeout(5, None, clock), 5)
+        self.assertEqual(attempt_timeout(None, 12.0, clock), 2.0)
+        self.assertEqual(attempt_timeout(1.5, 12.0, clock), 1.5)
+        self.assertEqual(
+            attempt_timeout((1, 5), 12.0, clock), (1, 2.0))
+        self.assertEqual(
+            attempt_timeout((None, 5), 11.0, clock), (1.0, 1.0))
+        with self.assertRaises(Timeout):
+            attempt_timeout(5, 10.0, clock)
+        self.assertTrue(issubclass(DeadlineExceeded, Timeout))
+
+
+class TestLatencyTracker(TestCase):
+    def test_percentile(self):
+        """
+        Percentiles are taken over a window of recent samples.
+        """
+        tracker = LatencyTracker(window=100, refresh=10)
+        self.assertEqual(tracker.percentile(50), None)
+        for i in range(1, 101):
+            tracker.observe(i / 100.0)
+        self.assertEqual(tracker.percentile(50), 0.5)
+        self.assertEqual(tracker.percentile(95), 0.95)
+        self.assertEqual(tracker.percentile(100), 1.0)
+        for _ in range(100):
+            tracker.observe(2.0)
+        self.assertEqual(tracker.percentile(1), 2.0)
+
+
+class TestHedgePolicy(TestCase):
+    def test_delay(self):
+        """
+        Requests are hedged after the percentile latency once there are
+        enough samples, within the delay bounds and hedging budget.
+        """
+        policy = HedgePolicy(
+            percentile=50, min_samples=4, min_delay=0.2, max_delay=0.5,
+            max_ratio=0.25)
+        for elapsed in [0.1, 0.3, 0.4]:
+            policy.observe("accounts", elapsed)
+        self.assertEqual(policy.delay("accounts"), None)
+        policy.observe("accounts", 0.3)
+        self.assertEqual(policy.delay("accounts"), 0.3)
+        self.assertEqual(policy.delay("other"), None)
+
+        policy.record(hedge_won=True)
+        # 1 of 3 requests hedged is over the 25% budget.
+        self.assertEqual(policy.delay("accounts"), None)
+        policy.delay("accounts")
+        self.assertEqual(policy.delay("accounts"), 0.3)
+        for _ in range(40):
+            policy.observe("accounts", 5.0)
+        self.assertEqual(policy.delay("accounts"), 0.5)
+        self.assertEqual(policy.stats(), {
+            "requests": 7, "hedged": 1, "hedge_wins": 1, "primary_wins": 0})
+
+
+class TestSenderTimeouts(TestCase):
+    def setUp(self):
+        self.session = TestSession()
+
+    def make_sender(self, handler, **kw):
+        adapter = CallbackAdapter(handler)
+        self.session.mount(API_URL, adapter)
+        sender = SnappyApiSender(
+            "test_key", api_url=API_URL, session=self.session, **kw)
+        return sender, adapter
+
+    def test_timeouts(self):
+        """
+        The client timeout is sent with every request and can be changed
+        for calls in a block.
+        """
+        sender, adapter = self.make_sender(
+            lambda request: ("[]", 200, {}), timeout=(3, 10))
+        sender.get_accounts()
+        with sender.timeouts(timeout=1):
+            sender.get_accounts()
+            with sender.timeouts(deadline=30):
+                sender.get_accounts()
+        sender.get_accounts()
+        self.assertEqual(adapter.timeouts[:2], [(3, 10), 1])
+        self.assertTrue(0 < adapter.timeouts[2] <= 1)
+        self.assertEqual(adapter.timeouts[3], (3, 10))
+
+    def test_deadline_covers_retries(self):
+        """
+        Retries stop when the deadline would pass, and later attempts get
+        only the time left.
+        """
+        def handler(request):
+            time.sleep(0.06)
+            return "busy", 503, {}
+
+        sender, adapter = self.make_sender(
+            handler, deadline=0.1,
+            backoff=Backoff(max_retries=10, base=0, cap=0))
+        self.assertRaises(HTTPError, sender.get_accounts)
+        self.assertEqual(len(adapter.requests), 2)
+        self.assertTrue(adapter.timeouts[1] < 0.05)
+
+    def test_stalled_server(self):
+        """
+        A stalled response fails once the timeout passes.
+        """
+        release = threading.Event()
+
+        def handler(request, body):
+            release.wait(5)
+            return 200, {}, "[]"
+
+        with LocalHTTPServer(handler) as server:
+            sender = SnappyApiSender(
+                "test_key", api_url=server.url, timeout=0.05)
+            start = time.monotonic()
+            self.assertRaises(ReadTimeout, sender.get_accounts)
+            with sender.timeouts(timeout=60, deadline=0.05):
+                self.assertRaises(ReadTimeout, sender.get_accounts)
+            release.set()
+        self.assertTrue(time.monotonic() - start < 2)
+
+    def test_hedged_get(self):
+        """
+        A GET slower than the hedging percentile is sent again and the
+        faster response is used, reporting the win.
+        """
+        count = [0]
+        lock = threading.Lock()
+
+        def handler(request):
+            with lock:
+                count[0] += 1
+                n = count[0]
+            if n == 2:
+                time.sleep(0.3)
+                return '[{"id": "slow"}]', 200, {}
+            return '[{"id": "fast"}]', 200, {}
+
+        metrics = InMemoryMetrics()
+        sender, adapter = self.make_sender(
+            handler, metrics=metrics,
+            hedge=HedgePolicy(min_samples=1, min_delay=0.02, max_ratio=1))
+        self.assertEqual(sender.get_accounts(), [{"id": "fast"}])
+        start = time.monotonic()
+        self.assertEqual(sender.get_accounts(), [{"id": "fast"}])
+        self.assertTrue(time.monotonic() - start < 0.25)
+        self.assertEqual(len(adapter.requests), 3)
+        self.assertEqual(sender.hedge.stats()["hedge_wins"], 1)
+        self.assertEqual(
+            metrics.hedges, {("accounts", "GET", "hedge"): 1})
+
+        # POSTs are never hedged.
+        sender.create_note(1, "Subject", "Message", staff_id=2)
+        self.assertEqual(sender.hedge.stats()["requests"], 2)
+
+    def test_stalled_requests_do_not_block_others(self):
+        """
+        Stalled hedged requests only hold up their own callers, even once
+        every hedging worker is busy.
+        """
+        release = threading.Event()
+
+        def handler(request):
+            if "stalled" in request.url:
+                release.wait(5)
+            return "[]", 200, {}
+
+        sender, adapter = self.make_sender(
+            handler, hedge=HedgePolicy(
+                min_samples=1, min_delay=0.01, max_ratio=1, max_workers=1))
+        sender.get_ticket_notes("warm")
+        callers = [
+            threading.Thread(
+                target=sender.get_ticket_notes, args=("stalled%d" % i,))
+            for i in range(2)]
+        try:
+            for caller in callers:
+                caller.start()
+            time.sleep(0.1)
+            start = time.monotonic()
+            self.assertEqual(sender.get_ticket_notes("healthy"), [])
+            self.assertTrue(time.monotonic() - start < 1)
+        finally:
+            release.set()
+            for caller in callers:
+                caller.join()
+        # The first stalled call was hedged; the second found no free
+        # worker.
+        self.assertEqual(sender.hedge.stats()["hedged"], 1)
+
+    def test_hedge_prefers_good_status(self):
+        """
+        A fast failure response from one copy doesn't beat a slower good
+        response from the other.
+        """
+        count = [0]
+        lock = threading.Lock()
+
+        def handler(request):
+            with lock:
+                count[0] += 1
+                n = count[0]
+            if n == 2:
+                time.sleep(0.1)
+                return '[{"id": "slow"}]', 200, {}
+            if n == 3:
+                return "busy", 503, {}
+            return '[{"id": "fast"}]', 200, {}
+
+        sender, adapter = self.make_sender(
+            handler,
+            hedge=HedgePolicy(min_samples=1, min_delay=0.02, max_ratio=1))
+        sender.get_accounts()
+        self.assertEqual(sender.get_accounts(), [{"id": "slow"}])
+        self.assertEqual(sender.hedge.stats()["primary_wins"], 1)
+
+    def test_threads_are_reused(self):
+        """
+        Hedged requests reuse the sender's pool threads instead of starting
+        a thread for every request.
+        """
+        threads = set()
+
+        def handler(request):
+            threads.add(threading.current_thread())
+            return "[]", 200, {}
+
+        sender, adapter = self.make_sender(
+            handler, hedge=HedgePolicy(
+                min_samples=1, min_delay=1, max_ratio=1, max_workers=4))
+        for _ in range(20):
+            sender.get_accounts()
+        self.assertEqual(sender.hedge.stats()["requests"], 20)
+        self.assertTrue(len(threads) <= 2, threads)
+
+    def test_hedge_timeout_fits_deadline(self):
+        """
+        The hedge's timeout only covers the time left before the deadline,
+        not the time the first copy had when it was sent.
+        """
+        count = [0]
+        lock = threading.Lock()
+
+        def handler(request):
+            with lock:
+                count[0] += 1
+                n = count[0]
+            if n == 2:
+                time.sleep(0.3)
+            return "[]", 200, {}
+
+        sender, adapter = self.make_sender(
+            handler, timeout=30, deadline=1, hedge=HedgePolicy(
+                min_samples=1, min_delay=0.1, max_delay=0.1, max_ratio=1))
+        sender.get_accounts()
+        sender.get_accounts()
+        self.assertEqual(len(adapter.timeouts), 3)
+        self.assertTrue(adapter.timeouts[2] < adapter.timeouts[1] - 0.05)
@@ -0,0 +1,126 @@
+"""
+Tests for besnappy.idempotency.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from besnappy.idempotency import IdempotencyCache, note_fingerprint
+from besnappy.tickets import build_note_data
+from besnappy.tests.helpers import FakeClock
+
+
+class TestNoteFingerprint(TestCase):
+    def test_fingerprint(self):
+        """
+        Fingerprints don't depend on key order but do depend on every field.
+        """
+        data = build_note_data(
+            1, "Subject", "Message", from_addr=[{"address": "a@example.com"}])
+        reordered = dict(reversed(list(data.items())))
+        self.assertEqual(note_fingerprint(data), note_fingerprint(reordered))
+        for change in [{"mailbox_id": 2}, {"message": "Other"},
+                       {"id": "ticket"}, {"scope": "private"}]:
+            changed = dict(data, **change)
+            self.assertNotEqual(
+                note_fingerprint(data), note_fingerprint(changed))
+
+
+class TestIdempotencyCache(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.clock.now = 1000.0
+        self.calls = []
+
+    def create(self, ticket_id="ticket-1"):
+        def create():
+            self.calls.append(ticket_id)
+            return ticket_id
+        return create
+
+    def test_duplicates_within_window(self):
+        """
+        Duplicate submissions within the window return the first result, and
+        later ones are sent again.
+        """
+        cache = IdempotencyCache(window=60, clock=self.clock)
+        self.assertEqual(cache.create("k", self.create()), "ticket-1")
+        self.assertEqual(
+            cache.create("k", self.create("ticket-2")), "ticket-1")
+        self.clock.now += 60
+        self.assertEqual(
+            cache.create("k", self.create("ticket-2")), "ticket-2")
+        self.assertEqual(self.calls, ["ticket-1", "ticket-2"])
+        self.assertEqual(cache.stats(), {
+            "duplicates": 1, "coalesced": 0, "sent": 2, "size": 1})
+        self.assertEqual(cache.get("k"), "ticket-2")
+
+    def test_failures_not_remembered(self):
+        """
+        A failed submission can be retried, and forgotten keys are resent.
+        """
+        cache = IdempotencyCache(clock=self.clock)
+
+        def fail():
+            raise ValueError("boom")
+
+        self.assertRaises(ValueError, cache.create, "k", fail)
+        self.assertEqual(cache.create("k", self.create()), "ticket-1")
+        cache.forget("k")
+        cache.create("k", self.create())
+        self.assertEqual(self.calls, ["ticket-1", "ticket-1"])
+
+    def test_concurrent_duplicates_coalesced(self):
+        """
+        Identical submissions made at the same time share one call.
+        """
+        cache = IdempotencyCache(clock=self.clock)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_create():
+            started.set()
+            release.wait(5)
+            self.calls.append("ticket-1")
+            return "ticket-1"
+
+        results = []
+        first = threading.Thread(
+            target=lambda: results.append(cache.create("k", slow_create)))
+        first.start()
+        started.wait(5)
+        second = threading.Thread(
+            target=lambda: results.append(cache.create("k", slow_create)))
+        second.start()
+        while cache.stats()["coalesced"] == 0:
+            time.sleep(0.001)
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.assertEqual(results, ["ticket-1", "ticket-1"])
+        self.assertEqual(self.calls, ["ticket-1"])
+
+    def test_persistence(self):
+        """
+        With a path, outcomes within the window survive a restart.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "idempotency.db")
+        cache = IdempotencyCache(window=60, path=path, clock=self.clock)
+        cache.create("old", self.create("ticket-old"))
+        self.clock.now += 30
+        cache.create("new", self.create("ticket-new"))
+        cache.close()
+
+        self.clock.now += 40
+        cache = IdempotencyCache(window=60, path=path, clock=self.clock)
+        self.addCleanup(cache.close)
+        self.assertEqual(cache.get("old"), None)
+        self.assertEqual(cache.get("new"), "ticket-new")
+        self.clock.now += 20
+        self.assertEqual(cache.get("new"), None)
@@ -0,0 +1,54 @@
+"""
+Tests for besnappy.jsoncodec.
+"""
+
+from unittest import TestCase, skipUnless
+
+from besnappy.jsoncodec import CODECS, StdlibCodec, get_codec
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+VALUE = {"id": 1, "name": "Zoë", "tags": ["a", None, True], "score": 1.5}
+
+
+class TestCodecs(TestCase):
+    def assert_round_trip(self, codec):
+        data = codec.dumps(VALUE)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(codec.loads(data), VALUE)
+        self.assertEqual(codec.loads(data.decode("utf-8")), VALUE)
+
+    def test_stdlib(self):
+        """
+        The stdlib codec writes compact UTF-8 and reads bytes or strings.
+        """
+        codec = get_codec("json")
+        self.assertIsInstance(codec, StdlibCodec)
+        self.assertEqual(codec.dumps({"a": [1, 2]}), b'{"a":[1,2]}')
+        self.assert_round_trip(codec)
+
+    @skipUnless(orjson, "orjson is not installed")
+    def test_orjson(self):
+        """
+        The orjson codec round-trips values.
+        """
+        self.assert_round_trip(get_codec("orjson"))
+
+    def test_auto(self):
+        """
+        Auto-detection picks the first installed backend, and codec objects
+        are used as given.
+        """
+        codec = get_codec()
+        self.assertIs(get_codec("auto"), codec)
+        self.assertIn(codec.name, [name for name, _cls in CODECS])
+        if orjson is not None:
+            self.assertEqual(codec.name, "orjson")
+        self.assert_round_trip(codec)
+        custom = StdlibCodec()
+        self.assertIs(get_codec(custom), custom)
+        self.assertRaises(ValueError, get_codec, "yaml")
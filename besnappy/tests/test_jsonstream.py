@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for besnappy.jsonstream.
+"""
+
+import json
+from unittest import TestCase
+
+from besnappy.jsonstream import iter_json_array
+from besnappy.tests.fake_snappy import FakeSnappyServer
+from besnappy.tickets import SnappyApiSender
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestIterJsonArray(TestCase):
+    def assert_decodes(self, value, text=None):
+        if text is None:
+            text = json.dumps(value)
+        data = text.encode("utf-8")
+        for size in [1, 2, 3, 7, 64, len(data) or 1]:
+            self.assertEqual(
+                list(iter_json_array(chunked(data, size))), value,
+                "chunk size %s" % (size,))
+
+    def test_empty_array(self):
+        self.assert_decodes([])
+        self.assert_decodes([], " [ ] ")
+
+    def test_objects(self):
+        self.assert_decodes([{"id": 1, "content": "a"}, {"id": 2}])
+
+    def test_scalars(self):
+        """
+        Numbers split across chunks are decoded whole.
+        """
+        self.assert_decodes([12345, -1.5e10, True, None, "x", 0])
+        self.assert_decodes([123456789], "[123456789]")
+
+    def test_whitespace(self):
+        self.assert_decodes([1, {"a": [2, 3]}], '\n[ 1 ,\n {"a": [2, 3]} ]\n')
+
+    def test_multibyte_characters(self):
+        """
+        Multi-byte characters split across chunks are decoded correctly.
+        """
+        self.assert_decodes([u"caf\xe9 ☃", {"k": u"\U0001f600"}], None)
+        self.assert_decodes(
+            [u"caf\xe9 ☃"], u'["caf\xe9 ☃"]')
+
+    def test_lazy(self):
+        """
+        Elements are yielded before the whole document has been read.
+        """
+        consumed = []
+
+        def chunks():
+            for chunk in [b'[{"id": 1}, ', b'{"id": 2}', b']']:
+                consumed.append(chunk)
+                yield chunk
+
+        elements = iter_json_array(chunks())
+        self.assertEqual(next(elements), {"id": 1})
+        self.assertEqual(len(consumed), 1)
+        self.assertEqual(list(elements), [{"id": 2}])
+
+    def test_large_elements(self):
+        """
+        Large elements arriving in small chunks are decoded.
+        """
+        value = [{"id": i, "content": "x" * 100000} for i in range(3)]
+        data = json.dumps(value).encode("utf-8")
+        self.assertEqual(list(iter_json_array(chunked(data, 1000))), value)
+
+    def test_invalid(self):
+        for text in ['{"id": 1}', '[1, 2', '[1 2]', '[1,]', '[1] x', '']:
+            self.assertRaises(
+                ValueError, list, iter_json_array([text.encode("utf-8")]))
+
+
+class TestStreamTicketNotes(TestCase):
+    def test_iter_ticket_notes_stream(self):
+        """
+        ``.iter_ticket_notes_stream()`` yields the same notes as
+        ``.get_ticket_notes()``.
+        """
+        with FakeSnappyServer(notes_per_ticket=200) as server:
+            snappy = SnappyApiSender("dummy_key", api_url=server.api_url)
+            notes = snappy.get_ticket_notes("abc")
+            streamed = list(
+                snappy.iter_ticket_notes_stream("abc", chunk_size=1024))
+        self.assertEqual(len(streamed), 200)
+        self.assertEqual(streamed, notes)
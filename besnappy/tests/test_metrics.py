@@ -0,0 +1,126 @@
+"""
+Tests for besnappy.metrics.
+"""
+
+from unittest import TestCase
+
+from requests_testadapter import TestSession
+
+from besnappy.metrics import (
+    Histogram, InMemoryMetrics, endpoint_template, prometheus_text)
+from besnappy.ratelimit import Backoff
+from besnappy.tests.helpers import CallbackAdapter
+from besnappy.tickets import SnappyApiSender
+
+
+class TestEndpointTemplate(TestCase):
+    def test_identifiers_replaced(self):
+        self.assertEqual(endpoint_template("accounts"), "accounts")
+        self.assertEqual(
+            endpoint_template("account/3249/staff"), "account/:id/staff")
+        self.assertEqual(
+            endpoint_template("ticket/abc123/notes/"), "ticket/:id/notes")
+        self.assertEqual(endpoint_template("note"), "note")
+
+
+class TestHistogram(TestCase):
+    def test_observe(self):
+        """
+        Observations are counted in the first bucket they fit and summed.
+        """
+        hist = Histogram(buckets=(1, 5))
+        for value in [0.5, 1, 3, 10]:
+            hist.observe(value)
+        self.assertEqual(hist.count, 4)
+        self.assertEqual(hist.sum, 14.5)
+        self.assertEqual(hist.cumulative(), [(1, 2), (5, 3), ("+Inf", 4)])
+
+
+class TestInMemoryMetrics(TestCase):
+    api_url = "http://snappyapi.example.com/v1"
+
+    def get_snappy(self, handler, **kw):
+        session = TestSession()
+        adapter = CallbackAdapter(handler)
+        session.mount(self.api_url, adapter)
+        return SnappyApiSender(
+            "dummy_key", api_url=self.api_url, session=session, **kw)
+
+    def test_requests_recorded(self):
+        """
+        Requests made by the sender are recorded per endpoint template.
+        """
+        metrics = InMemoryMetrics()
+        snappy = self.get_snappy(
+            lambda request: ('[{"id": 1}]', 200, {}), metrics=metrics)
+        snappy.get_ticket_notes("abc")
+        snappy.get_ticket_notes("def")
+        snappy.create_note(1, "subject", "message")
+
+        key = ("ticket/:id/notes", "GET")
+        self.assertEqual(metrics.latency[key].count, 2)
+        self.assertEqual(metrics.headers_latency[key].count, 2)
+        self.assertEqual(metrics.statuses[key + (200,)], 2)
+        self.assertEqual(metrics.bytes_received[key], 22)
+        self.assertEqual(metrics.decode_time[("ticket/:id/notes",)].count, 2)
+        self.assertTrue(metrics.bytes_sent[("note", "POST")] > 0)
+        self.assertEqual(metrics.request_count(), 3)
+        self.assertEqual(metrics.request_count(method="POST"), 1)
+
+    def test_retries_recorded(self):
+        """
+        Retried responses are recorded as retries as well as responses.
+        """
+        statuses = [503, 200]
+        metrics = InMemoryMetrics()
+        snappy = self.get_snappy(
+            lambda request: ("[]", statuses.pop(0), {}), metrics=metrics,
+            backoff=Backoff(sleep=lambda delay: None))
+        snappy.get_accounts()
+        self.assertEqual(metrics.retries, {("accounts", "GET", 503): 1})
+        self.assertEqual(metrics.request_count("accounts"), 2)
+
+    def test_errors_recorded(self):
+        """
+        Requests that fail without a response are recorded as errors.
+        """
+        def handler(request):
+            raise IOError("connection reset")
+
+        metrics = InMemoryMetrics()
+        snappy = self.get_snappy(handler, metrics=metrics)
+        self.assertRaises(IOError, snappy.get_accounts)
+        self.assertEqual(metrics.errors, {("accounts", "GET", "OSError"): 1})
+
+    def test_prometheus_text(self):
+        """
+        Metrics are rendered in the Prometheus text format.
+        """
+        metrics = InMemoryMetrics(buckets=(0.1,))
+        metrics.request_finished(
+            "ticket/:id/notes", "GET", 200, 0.05, 0.04, 0, 120)
+        metrics.request_retried("ticket/:id/notes", "GET", 429, 1.0)
+        metrics.response_decoded("ticket/:id/notes", 0.2)
+        lines = prometheus_text(metrics).splitlines()
+
+        labels = 'endpoint="ticket/:id/notes",method="GET"'
+        self.assertIn(
+            "# TYPE besnappy_request_duration_seconds histogram", lines)
+        self.assertIn(
+            'besnappy_request_duration_seconds_bucket{%s,le="0.1"} 1' % (
+                labels,), lines)
+        self.assertIn(
+            'besnappy_request_duration_seconds_bucket{%s,le="+Inf"} 1' % (
+                labels,), lines)
+        self.assertIn(
+            "besnappy_request_duration_seconds_sum{%s} 0.05" % (labels,),
+            lines)
+        self.assertIn(
+            'besnappy_decode_duration_seconds_bucket'
+            '{endpoint="ticket/:id/notes",le="0.1"} 0', lines)
+        self.assertIn(
+            'besnappy_responses_total{%s,status="200"} 1' % (labels,), lines)
+        self.assertIn(
+            'besnappy_retries_total{%s,status="429"} 1' % (labels,), lines)
+        self.assertIn(
+            "besnappy_response_bytes_total{%s} 120" % (labels,), lines)
@@ -0,0 +1,201 @@
+"""
+Tests for besnappy.mirror.
+"""
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from requests_testadapter import TestSession
+
+from besnappy.mirror import NoteMirror
+from besnappy.tests.helpers import CallbackAdapter
+from besnappy.tickets import SnappyApiSender
+
+
+API_URL = "http://snappyapi.example.com/v1"
+
+# 2014-09-22 12:00:00 UTC.
+DAY = 1411387200
+
+
+def note(note_id, staff_id=None, scope="public", created_at=DAY,
+         content="Hello"):
+    return {
+        "id": note_id, "account_id": 1, "scope": scope,
+        "created_by_staff_id": staff_id,
+        "created_by_contact_id": None if staff_id else 7,
+        "created_at": created_at, "updated_at": "2014-09-22 12:00:00",
+        "content": content, "system": 0,
+    }
+
+
+class FakeSnappy(object):
+    def __init__(self):
+        self.tickets = {
+            "t1": [note(1, content="Are protocols being followed?"),
+                   note(2, staff_id=58, scope="private",
+                        created_at=DAY + 3600, content="Checking goop")],
+            "t2": [note(3, staff_id=58, scope="private",
+                        created_at=DAY + 8 * 86400, content="More goop")],
+            "t3": [note(4, staff_id=59, created_at=DAY + 60)],
+        }
+        self.failing = set()
+
+    def __call__(self, request):
+        path = request.url[len(API_URL) + 1:].split("/")
+        if path == ["accounts"]:
+            return json.dumps([{"id": 1, "organization": "Org"}]), 200, {}
+        if path[2] == "mailboxes":
+            return json.dumps([{"id": 10, "account_id": 1}]), 200, {}
+        if path[2] == "staff":
+            return json.dumps([
+                {"id": 58, "email": "mike@example.com"},
+                {"id": 59, "email": "jane@example.com"}]), 200, {}
+        if path[1] in self.failing:
+            return "oops", 500, {}
+        return json.dumps(self.tickets[path[1]]), 200, {}
+
+
+class TestNoteMirror(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.api = FakeSnappy()
+        session = TestSession()
+        self.adapter = CallbackAdapter(self.api)
+        session.mount(API_URL, self.adapter)
+        self.sender = SnappyApiSender(
+            "test_key", api_url=API_URL, session=session, revalidation=True)
+
+    def make_mirror(self, **kw):
+        mirror = NoteMirror(
+            self.sender, os.path.join(self.tmpdir, "mirror.db"), **kw)
+        self.addCleanup(mirror.close)
+        return mirror
+
+    def note_ids(self, notes):
+        return [n["id"] for n in notes]
+
+    def test_sync_directory(self):
+        """
+        Accounts, mailboxes and staff are copied into their tables.
+        """
+        mirror = self.make_mirror()
+        self.assertEqual(mirror.sync_directory(), {
+            "accounts": 1, "mailboxes": 1, "staff": 2})
+        self.assertEqual(
+            mirror.query("SELECT id FROM staff WHERE email = ?",
+                         ("jane@example.com",)),
+            [(59,)])
+        mirror.sync_directory()
+        self.assertEqual(mirror.stats()["staff"], 2)
+
+    def test_queries(self):
+        """
+        Stored notes can be filtered by mailbox, staff, scope and time.
+        """
+        mirror = self.make_mirror()
+        mirror.sync_tickets(["t1", "t2"], mailbox_id=10)
+        mirror.sync_tickets(["t3"], mailbox_id=11)
+        self.assertEqual(mirror.stats()["notes"], 4)
+
+        self.assertEqual(self.note_ids(mirror.notes()), [1, 4, 2, 3])
+        self.assertEqual(self.note_ids(mirror.notes(ticket_id="t1")), [1, 2])
+        self.assertEqual(self.note_ids(mirror.notes(mailbox_id=11)), [4])
+        self.assertEqual(self.note_ids(mirror.notes(
+            mailbox_id=10, staff_id=58, scope="private",
+            since=datetime.datetime(2014, 9, 22),
+            until=datetime.datetime(2014, 9, 29))), [2])
+        self.assertEqual(
+            self.note_ids(mirror.notes(since=DAY + 60, limit=1)), [4])
+        self.assertEqual(mirror.ticket_ids(mailbox_id=10), ["t1", "t2"])
+        self.assertRaises(ValueError, mirror.notes, search="goop")
+
+    def test_resync(self):
+        """
+        Syncing again replaces a ticket's notes, skips unchanged tickets and
+        leaves failed tickets as they were.
+        """
+        mirror = self.make_mirror(full_text=True)
+        mirror.sync_tickets(["t1", "t2", "t3"], mailbox_id=10)
+        self.assertEqual(
+            self.note_ids(mirror.notes(search="goop")), [2, 3])
+
+        self.api.tickets["t1"] = [note(5, content="Goop delivered")]
+        self.api.failing.add("t2")
+        stats = mirror.sync()
+        self.assertEqual(
+            (stats["updated"], stats["unchanged"], stats["failed"]),
+            (1, 1, 1))
+        self.assertEqual(list(stats["errors"]), ["t2"])
+        self.assertEqual(self.note_ids(mirror.notes(ticket_id="t1")), [5])
+        self.assertEqual(
+            self.note_ids(mirror.notes(search="goop")), [5, 3])
+        self.assertEqual(
+            self.note_ids(mirror.notes(search="goop", mailbox_id=10,
+                                       since=DAY + 86400)), [3])
+        self.assertEqual(mirror.ticket_ids(mailbox_id=10), ["t1", "t2", "t3"])
+
+    def test_enable_full_text(self):
+        """
+        Enabling full text on a mirror that already has notes indexes them,
+        and they stay searchable as they are replaced.
+        """
+        mirror = self.make_mirror()
+        mirror.sync_tickets(["t1", "t2"])
+        mirror.close()
+        mirror = self.make_mirror(full_text=True)
+        self.assertEqual(
+            self.note_ids(mirror.notes(search="goop")), [2, 3])
+
+        self.api.tickets["t1"] = [note(5, content="Goop delivered")]
+        mirror.sync()
+        self.assertEqual(
+            self.note_ids(mirror.notes(search="goop")), [5, 3])
+        mirror.query(
+            "INSERT INTO notes_fts (notes_fts) VALUES ('integrity-check')")
+
+    def test_other_fetches_between_syncs(self):
+        """
+        A ticket fetched by another caller on the same sender is still
+        updated on the next sync.
+        """
+        mirror = self.make_mirror()
+        mirror.sync_tickets(["t1"])
+        self.api.tickets["t1"].append(note(6))
+        self.sender.get_ticket_notes("t1")
+        stats = mirror.sync()
+        self.assertEqual((stats["updated"], stats["unchanged"]), (1, 0))
+        self.assertEqual(
+            self.note_ids(mirror.notes(ticket_id="t1")), [1, 6, 2])
+
+    def test_store_failure(self):
+        """
+        A ticket that can't be stored is reported as failed without
+        stopping the others, and is stored once it can be.
+        """
+        mirror = self.make_mirror()
+        self.api.tickets["t1"].append({"content": "No id"})
+        stats = mirror.sync_tickets(["t1", "t2"])
+        self.assertEqual((stats["updated"], stats["failed"]), (1, 1))
+        self.assertIsInstance(stats["errors"]["t1"], KeyError)
+        self.assertEqual(self.note_ids(mirror.notes()), [3])
+
+        self.api.tickets["t1"].pop()
+        stats = mirror.sync()
+        self.assertEqual((stats["updated"], stats["unchanged"]), (1, 1))
+        self.assertEqual(self.note_ids(mirror.notes()), [1, 2, 3])
+
+    def test_persistence(self):
+        """
+        The mirror is kept on disk between instances.
+        """
+        mirror = self.make_mirror()
+        mirror.sync_tickets(["t1"], mailbox_id=10)
+        mirror.close()
+        mirror = self.make_mirror()
+        self.assertEqual(self.note_ids(mirror.notes(mailbox_id=10)), [1, 2])
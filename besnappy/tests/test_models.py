@@ -0,0 +1,155 @@
+"""
+Tests for besnappy.models.
+"""
+
+import datetime
+import json
+import pickle
+import tracemalloc
+from unittest import TestCase
+
+from besnappy.models import (
+    Account, Contact, Mailbox, Note, Staff, address_list, model_id,
+    parse_timestamp)
+from besnappy.tests.fake_snappy import load_cassette_routes
+from besnappy.tickets import build_note_data
+
+
+def recorded(path_prefix):
+    """
+    Return the first recorded GET response body for an API path.
+    """
+    for (method, path), (_, _, body) in sorted(
+            load_cassette_routes().items()):
+        if method == "GET" and path.startswith(path_prefix):
+            return json.loads(body)
+    raise KeyError(path_prefix)
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+
+class TestParseTimestamp(TestCase):
+    def test_formats(self):
+        """
+        Both string and epoch timestamps are parsed as UTC.
+        """
+        self.assertEqual(
+            parse_timestamp("2014-09-22 12:05:06"), utc(2014, 9, 22, 12, 5, 6))
+        self.assertEqual(
+            parse_timestamp(1411387506), utc(2014, 9, 22, 12, 5, 6))
+        self.assertEqual(parse_timestamp(None), None)
+        self.assertEqual(parse_timestamp(""), None)
+
+
+class TestModels(TestCase):
+    def test_recorded_payloads(self):
+        """
+        Recorded API payloads decode into models with the expected fields.
+        """
+        [account] = Account.from_list(recorded("/accounts"))[:1]
+        self.assertEqual(account.id, 3249)
+        self.assertEqual(account.trial_ends_at, utc(2014, 9, 30, 13, 49, 36))
+        self.assertEqual(account.cancelled_at, None)
+
+        [mailbox] = Mailbox.from_list(recorded("/account/3249/mailboxes"))[:1]
+        self.assertEqual(mailbox.address, "hello@wcldemo.besnappy.com")
+
+        staff = Staff.from_list(recorded("/account/3249/staff"))[0]
+        self.assertEqual(staff.name, "Mike Jones")
+        self.assertEqual(staff.as_address(), {
+            "name": "Mike Jones", "address": "mike@westerncapelabs.com"})
+
+        note = Note.from_list(recorded("/ticket/"))[-1]
+        self.assertEqual(
+            note.created_at, parse_timestamp(note["created_at"]))
+        self.assertEqual(note.created_at.year, 2014)
+        [contact] = note.contacts
+        self.assertTrue(isinstance(contact, Contact))
+        self.assertEqual(contact.type, "from")
+        self.assertEqual(contact.as_address()["name"], "John Smith")
+
+    def test_item_access(self):
+        """
+        Item access returns raw values, like the payload dicts.
+        """
+        note = Note.from_dict({"id": 1, "created_at": 1411387506})
+        self.assertEqual(note["created_at"], 1411387506)
+        self.assertEqual(note.get("id"), 1)
+        self.assertEqual(note.get("missing", "default"), "default")
+        self.assertRaises(KeyError, lambda: note["missing"])
+
+    def test_to_dict(self):
+        """
+        Extra keys are dropped unless kept, and kept extras round trip.
+        """
+        payload = recorded("/ticket/")[-1]
+        note = Note.from_dict(payload)
+        self.assertNotIn("creator", note.to_dict())
+        self.assertEqual(note.to_dict()["contacts"][0]["address"],
+                         "john.smith@gmail.com")
+        self.assertEqual(Note.from_dict(payload, keep_extra=True).to_dict(),
+                         payload)
+
+    def test_constructor(self):
+        """
+        Models can be built from keyword arguments, and unknown fields are
+        rejected.
+        """
+        contact = Contact(first_name="Jo", address="jo@example.com")
+        self.assertEqual(contact.last_name, None)
+        self.assertEqual(
+            contact.as_address(), {"name": "Jo", "address": "jo@example.com"})
+        self.assertRaises(TypeError, Contact, nickname="Jo")
+
+    def test_equality_and_pickle(self):
+        """
+        Models compare by value and survive pickling.
+        """
+        staff = Staff.from_list(recorded("/account/3249/staff"))
+        copies = pickle.loads(pickle.dumps(staff))
+        self.assertEqual(copies, staff)
+        self.assertNotEqual(copies[0], copies[1])
+
+    def test_helpers(self):
+        """
+        ``model_id()`` and ``address_list()`` accept models or plain values.
+        """
+        staff = Staff(id=5, first_name="Mike", address="mike@example.com")
+        self.assertEqual(model_id(staff), 5)
+        self.assertEqual(model_id(7), 7)
+        self.assertEqual(address_list([staff, {"address": "x"}]), [
+            {"name": "Mike", "address": "mike@example.com"},
+            {"address": "x"}])
+        self.assertEqual(address_list(None), None)
+        self.assertEqual(address_list(staff), {
+            "name": "Mike", "address": "mike@example.com"})
+
+    def test_dict_address(self):
+        """
+        A single address dict is sent unchanged, as before models were
+        accepted.
+        """
+        address = {"name": "J", "address": "j@example.com"}
+        self.assertEqual(address_list(address), address)
+        data = build_note_data(1, "s", "m", from_addr=address)
+        self.assertEqual(data["from"], address)
+
+    def test_memory_use(self):
+        """
+        Notes take much less memory as models than as dicts.
+        """
+        body = json.dumps(recorded("/ticket/") * 200)
+
+        def allocated(decode):
+            tracemalloc.start()
+            try:
+                value = decode(json.loads(body))
+                return tracemalloc.get_traced_memory()[0], value
+            finally:
+                tracemalloc.stop()
+
+        dicts_size, _ = allocated(lambda notes: notes)
+        models_size, _ = allocated(Note.from_list)
+        self.assertLess(models_size * 2, dicts_size)
@@ -0,0 +1,195 @@
+"""
+Tests for besnappy.outbox.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from requests_testadapter import TestSession
+
+from besnappy.outbox import NoteOutbox, OutboxFlusher
+from besnappy.ratelimit import Backoff
+from besnappy.tickets import SnappyApiSender
+from besnappy.tests.helpers import CallbackAdapter, FakeClock
+
+
+API_URL = "http://snappyapi.example.com/v1"
+
+
+class TestNoteOutbox(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "outbox.db")
+        self.clock = FakeClock()
+        self.clock.now = 1000.0
+        self.outbox = NoteOutbox(self.path, clock=self.clock)
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_enqueue_deduplicates_and_persists(self):
+        """
+        Notes survive reopening the outbox, and a repeated deduplication key
+        doesn't queue a second note.
+        """
+        key = self.outbox.enqueue(1, "Subject", "Message", dedup_key="k1")
+        self.assertEqual(key, "k1")
+        self.outbox.enqueue(1, "Subject", "Message", dedup_key="k1")
+        self.outbox.enqueue(1, "Other", "Message")
+        self.assertTrue(self.outbox.enqueued.is_set())
+        self.outbox.close()
+
+        self.outbox = NoteOutbox(self.path, clock=self.clock)
+        self.assertEqual(
+            self.outbox.counts(), {"pending": 2, "sent": 0, "failed": 0})
+        [first, second] = self.outbox.claim(10)
+        self.assertEqual(first.dedup_key, "k1")
+        self.assertEqual(first.data, {
+            "mailbox_id": 1, "subject": "Subject", "message": "Message"})
+        self.assertEqual(first.attempts, 0)
+
+    def test_claim_lease(self):
+        """
+        Claimed notes aren't claimed again until their lease expires.
+        """
+        self.outbox.enqueue(1, "Subject", "Message", dedup_key="k1")
+        self.assertEqual(len(self.outbox.claim(10, lease=30)), 1)
+        self.assertEqual(self.outbox.claim(10, lease=30), [])
+        self.clock.now += 30
+        [item] = self.outbox.claim(10, lease=30)
+        self.assertEqual(item.dedup_key, "k1")
+
+    def test_mark_and_purge(self):
+        """
+        Sent and failed notes record their outcome, and sent notes can be
+        purged.
+        """
+        self.outbox.enqueue(1, "Subject", "Message", dedup_key="ok")
+        self.outbox.enqueue(1, "Subject", "Message", dedup_key="bad")
+        ok, bad = self.outbox.claim(10)
+        self.outbox.mark_sent(ok.id, "ticket-1")
+        self.outbox.mark_failed(bad.id, "boom")
+        self.assertEqual(self.outbox.get("ok")["ticket_id"], "ticket-1")
+        self.assertEqual(self.outbox.get("bad")["state"], "failed")
+        self.assertEqual(self.outbox.get("missing"), None)
+
+        self.assertEqual(self.outbox.retry_failed(), 1)
+        self.assertEqual(self.outbox.get("bad")["state"], "pending")
+        self.clock.now += 10
+        self.assertEqual(self.outbox.purge(self.clock.now), 1)
+        self.assertEqual(
+            self.outbox.counts(), {"pending": 1, "sent": 0, "failed": 0})
+
+
+class TestOutboxFlusher(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.clock.now = 1000.0
+        self.outbox = NoteOutbox(
+            os.path.join(self.tmpdir, "outbox.db"), clock=self.clock)
+        self.statuses = {}
+        self.adapter = CallbackAdapter(self.handler)
+        session = TestSession()
+        session.mount(API_URL, self.adapter)
+        self.sender = SnappyApiSender(
+            "dummy_key", api_url=API_URL, session=session)
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.tmpdir)
+
+    def handler(self, request):
+        subject = json.loads(request.body)["subject"]
+        statuses = self.statuses.get(subject)
+        if statuses:
+            return "", statuses.pop(0), {}
+        return "ticket-%s" % (subject,), 200, {}
+
+    def test_flush(self):
+        """
+        Due notes are sent and marked as sent with their ticket id.
+        """
+        for i in range(5):
+            self.outbox.enqueue(1, str(i), "Message", dedup_key=str(i))
+        flusher = OutboxFlusher(
+            self.outbox, self.sender, concurrency=2, batch_size=3)
+        flusher.drain()
+        self.assertEqual(len(self.adapter.requests), 5)
+        self.assertEqual(flusher.sent, 5)
+        self.assertEqual(self.outbox.get("4")["ticket_id"], "ticket-4")
+
+    def test_retries(self):
+        """
+        Server errors are retried after a backoff delay, client errors fail
+        at once and notes fail after ``max_attempts``.
+        """
+        self.statuses = {"flaky": [503], "invalid": [400], "down": [500] * 5}
+        for subject in ["flaky", "invalid", "down"]:
+            self.outbox.enqueue(1, subject, "Message", dedup_key=subject)
+        flusher = OutboxFlusher(
+            self.outbox, self.sender, max_attempts=3,
+            backoff=Backoff(base=10, cap=10, random=lambda: 1.0))
+
+        flusher.drain()
+        self.assertEqual(self.outbox.get("invalid")["state"], "failed")
+        self.assertEqual(self.outbox.get("flaky")["state"], "pending")
+        self.assertEqual((flusher.retried, flusher.failed), (2, 1))
+
+        self.clock.now += 10
+        flusher.drain()
+        self.assertEqual(self.outbox.get("flaky")["ticket_id"], "ticket-flaky")
+        self.clock.now += 10
+        flusher.drain()
+        self.assertEqual(self.outbox.get("down")["state"], "failed")
+        self.assertEqual(self.outbox.get("down")["attempts"], 3)
+        self.assertIn("500", self.outbox.get("down")["last_error"])
+
+    def test_background_thread(self):
+        """
+        The background thread sends notes soon after they are enqueued.
+        """
+        flusher = OutboxFlusher(
+            self.outbox, self.sender, poll_interval=5.0)
+        flusher.start()
+        try:
+            self.outbox.enqueue(1, "Subject", "Message", dedup_key="k1")
+            deadline = time.time() + 5
+            while (self.outbox.get("k1")["state"] != "sent" and
+                    time.time() < deadline):
+                time.sleep(0.01)
+        finally:
+            flusher.stop(timeout=5)
+        self.assertEqual(self.outbox.get("k1")["state"], "sent")
+        self.assertEqual(flusher.last_error, None)
+
+    def test_purge_interval(self):
+        """
+        Sent notes are purged at most once per ``purge_interval``, not after
+        every flush.
+        """
+        purges = []
+        purge = self.outbox.purge
+
+        def counting_purge(before):
+            purges.append(before)
+            return purge(before)
+        self.outbox.purge = counting_purge
+        flusher = OutboxFlusher(
+            self.outbox, self.sender, retain_sent=100, purge_interval=60)
+        flusher._purge_if_due()
+        self.clock.now += 59
+        flusher._purge_if_due()
+        self.assertEqual(purges, [900.0])
+        self.clock.now += 1
+        flusher._purge_if_due()
+        self.assertEqual(purges, [900.0, 960.0])
+        [plan] = self.outbox._conn.execute(
+            "EXPLAIN QUERY PLAN DELETE FROM outbox"
+            " WHERE state = 'sent' AND finished_at < 0").fetchall()
+        self.assertIn("outbox_finished", plan[-1])
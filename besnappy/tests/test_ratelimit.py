@@ -0,0 +1,126 @@
+"""
+Tests for besnappy.ratelimit.
+"""
+
+import datetime
+from unittest import TestCase
+
+from besnappy.ratelimit import (
+    Backoff, TokenBucket, parse_retry_after, shared_rate_limiter)
+from besnappy.tests.helpers import FakeClock
+
+
+class TestTokenBucket(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_bucket(self, rate, burst=None):
+        return TokenBucket(
+            rate, burst, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_burst_then_rate(self):
+        """
+        A full bucket allows a burst, after which requests are spaced at the
+        configured rate.
+        """
+        bucket = self.make_bucket(10, burst=3)
+        for _ in range(3):
+            self.assertEqual(bucket.acquire(), 0)
+        for _ in range(5):
+            bucket.acquire()
+        self.assertAlmostEqual(self.clock.now, 0.5)
+
+    def test_try_acquire(self):
+        """
+        ``.try_acquire()`` reports how long to wait instead of waiting.
+        """
+        bucket = self.make_bucket(2, burst=1)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertAlmostEqual(bucket.try_acquire(), 0.5)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_pause(self):
+        """
+        A paused bucket hands out no tokens until the pause is over, and
+        doesn't release a burst afterwards.
+        """
+        bucket = self.make_bucket(100, burst=100)
+        bucket.pause(2)
+        bucket.acquire()
+        self.assertAlmostEqual(self.clock.now, 2)
+        bucket.acquire()
+        self.assertTrue(self.clock.now > 2)
+
+    def test_invalid_rate(self):
+        """
+        The rate must be positive.
+        """
+        self.assertRaises(ValueError, TokenBucket, 0)
+
+    def test_shared_rate_limiter(self):
+        """
+        Limiters are shared by key. Asking for a different rate or burst
+        for an existing limiter is an error.
+        """
+        limiter = shared_rate_limiter("test-key-shared", 5)
+        self.assertIs(shared_rate_limiter("test-key-shared", 5), limiter)
+        self.assertIs(shared_rate_limiter("test-key-shared", 5, 5), limiter)
+        self.assertRaises(
+            ValueError, shared_rate_limiter, "test-key-shared", 8)
+        self.assertRaises(
+            ValueError, shared_rate_limiter, "test-key-shared", 5, 10)
+        self.assertEqual(limiter.rate, 5)
+        self.assertIsNot(shared_rate_limiter("test-key-other", 8), limiter)
+
+
+class TestParseRetryAfter(TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after("120"), 120)
+        self.assertEqual(parse_retry_after(" 1.5 "), 1.5)
+
+    def test_http_date(self):
+        now = datetime.datetime(
+            2014, 9, 22, 12, 0, 0, tzinfo=datetime.timezone.utc)
+        self.assertEqual(
+            parse_retry_after("Mon, 22 Sep 2014 12:00:30 GMT", now=now), 30)
+        self.assertEqual(
+            parse_retry_after("Mon, 22 Sep 2014 11:00:00 GMT", now=now), 0)
+
+    def test_invalid(self):
+        self.assertEqual(parse_retry_after(None), None)
+        self.assertEqual(parse_retry_after("soon"), None)
+
+
+class TestBackoff(TestCase):
+    def test_should_retry(self):
+        """
+        429s are always retried, 5xx only for idempotent methods, and only
+        up to ``max_retries`` times.
+        """
+        backoff = Backoff(max_retries=2)
+        self.assertTrue(backoff.should_retry("POST", 429, 0))
+        self.assertTrue(backoff.should_retry("GET", 503, 1))
+        self.assertFalse(backoff.should_retry("POST", 503, 0))
+        self.assertFalse(backoff.should_retry("GET", 404, 0))
+        self.assertFalse(backoff.should_retry("GET", 429, 2))
+
+    def test_delay(self):
+        """
+        Delays grow exponentially up to the cap, with full jitter.
+        """
+        backoff = Backoff(base=1, cap=5, random=lambda: 0.5)
+        self.assertEqual(
+            [backoff.delay(n) for n in range(5)], [0.5, 1, 2, 2.5, 2.5])
+
+    def test_delay_honours_retry_after(self):
+        """
+        ``Retry-After`` is a lower bound on the delay and isn't limited by
+        the cap. Waits longer than ``max_retry_after`` aren't retried.
+        """
+        backoff = Backoff(base=1, cap=10, random=lambda: 0.5)
+        self.assertEqual(backoff.delay(0, "4"), 4)
+        self.assertEqual(backoff.delay(0, "60"), 60)
+        backoff = Backoff(base=1, cap=10, random=lambda: 0.5,
+                          max_retry_after=30)
+        self.assertEqual(backoff.delay(0, "30"), 30)
+        self.assertEqual(backoff.delay(0, "60"), None)
@@ -0,0 +1,152 @@
+"""
+Tests for besnappy.sync.
+"""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from besnappy.sync import TicketNotesWatcher
+
+
+class FakeSender(object):
+    """
+    Serves ticket notes from a dict, newest first like the Snappy API, and
+    reports unchanged tickets the way a revalidating sender would.
+    """
+
+    def __init__(self):
+        self.notes = {}
+        self.changed = set()
+        self.calls = []
+
+    def add_note(self, ticket_id, note_id):
+        self.notes.setdefault(ticket_id, []).insert(
+            0, {"id": note_id, "created_at": 1411387500 + note_id})
+        self.changed.add(ticket_id)
+
+    def get_ticket_notes(self, ticket_id, if_changed=False):
+        self.calls.append((ticket_id, if_changed))
+        changed = ticket_id in self.changed
+        self.changed.discard(ticket_id)
+        if if_changed and not changed:
+            return None
+        return list(self.notes.get(ticket_id, []))
+
+
+class TestTicketNotesWatcher(TestCase):
+    def setUp(self):
+        self.sender = FakeSender()
+        self.watcher = TicketNotesWatcher(self.sender)
+
+    def note_ids(self, notes):
+        return [note["id"] for note in notes]
+
+    def test_first_sync_returns_all_notes(self):
+        """
+        The first sync of a ticket returns every note, oldest first, without
+        relying on revalidation.
+        """
+        self.sender.add_note("t1", 1)
+        self.sender.add_note("t1", 2)
+        self.sender.changed.clear()
+        self.assertEqual(self.note_ids(self.watcher.sync("t1")), [1, 2])
+        self.assertEqual(self.sender.calls, [("t1", False)])
+        self.assertEqual(self.watcher.high_water_mark("t1"), 2)
+
+    def test_sync_returns_only_new_notes(self):
+        """
+        Later syncs only return notes added since the previous sync.
+        """
+        self.sender.add_note("t1", 1)
+        self.watcher.sync("t1")
+        self.assertEqual(self.watcher.sync("t1"), [])
+        self.sender.add_note("t1", 5)
+        self.sender.add_note("t1", 7)
+        self.assertEqual(self.note_ids(self.watcher.sync("t1")), [5, 7])
+        self.assertEqual(self.watcher.sync("t1"), [])
+
+    def test_other_fetches_between_syncs(self):
+        """
+        Notes fetched by another caller on the same sender between syncs
+        are still returned, even though the sender no longer sees a change.
+        """
+        self.sender.add_note("t1", 1)
+        self.assertEqual(self.note_ids(self.watcher.sync("t1")), [1])
+        self.sender.add_note("t1", 2)
+        self.assertEqual(
+            self.note_ids(self.sender.get_ticket_notes("t1")), [2, 1])
+        self.assertEqual(self.note_ids(self.watcher.sync("t1")), [2])
+
+    def test_sync_many(self):
+        """
+        ``.sync_many()`` yields only tickets with new notes.
+        """
+        self.sender.add_note("t1", 1)
+        self.sender.add_note("t2", 2)
+        self.watcher.sync("t1")
+        result = list(self.watcher.sync_many(["t1", "t2"]))
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0][0], "t2")
+
+    def test_forget(self):
+        """
+        A forgotten ticket is treated as never synced.
+        """
+        self.sender.add_note("t1", 1)
+        self.watcher.sync("t1")
+        self.watcher.forget("t1")
+        self.assertEqual(self.watcher.high_water_mark("t1"), None)
+        self.assertEqual(self.note_ids(self.watcher.sync("t1")), [1])
+
+    def test_save_and_load(self):
+        """
+        State saved to disk can be loaded into a new watcher.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "state.json")
+
+        self.sender.add_note("t1", 1)
+        self.watcher.sync("t1")
+        self.watcher.save(path)
+        self.assertEqual(os.listdir(tmpdir), ["state.json"])
+
+        watcher = TicketNotesWatcher(self.sender)
+        watcher.load(path)
+        self.assertEqual(watcher.high_water_mark("t1"), 1)
+        self.sender.add_note("t1", 2)
+        self.assertEqual(self.note_ids(watcher.sync("t1")), [2])
+
+    def test_save_and_load_integer_ids(self):
+        """
+        Integer ticket identifiers, as used by the API, keep their type
+        through a save and load.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "state.json")
+
+        self.sender.add_note(268240, 1)
+        self.watcher.sync(268240)
+        self.watcher.save(path)
+        watcher = TicketNotesWatcher(self.sender)
+        watcher.load(path)
+        self.assertEqual(watcher.high_water_mark(268240), 1)
+        self.assertEqual(watcher.sync(268240), [])
+
+    def test_load_missing_file(self):
+        """
+        Loading from a missing file gives empty state.
+        """
+        self.watcher.load("/nonexistent/besnappy-state.json")
+        self.assertEqual(self.watcher.get_state()["tickets"], [])
+
+    def test_unsupported_state_version(self):
+        """
+        State from an unknown version is rejected.
+        """
+        self.assertRaises(
+            ValueError, TicketNotesWatcher, self.sender,
+            {"version": 99, "tickets": []})
@@ -13,7 +13,11 @@ from requests import Session
 from requests.auth import HTTPBasicAuth
 from requests_testadapter import TestSession, TestAdapter
 
+from besnappy.jsoncodec import StdlibCodec
+from besnappy.models import Mailbox
+from besnappy.ratelimit import Backoff, TokenBucket
 from besnappy.tickets import SnappyApiSender
+from besnappy.tests.helpers import CallbackAdapter, FakeClock
 
 
 CASSETTE_LIBRARY_DIR = os.path.join(os.path.dirname(__file__), "cassettes")
@@ -164,6 +168,282 @@ class TestSnappyApiSender(TestCase):
         resp = snappy._api_request("GET", "flash")
         self.assertEqual(resp.content, "ok")
 
+    def test_create_notes(self):
+        """
+        ``.create_notes()`` creates every note and yields the ticket ids or
+        errors in input order.
+        """
+        def handler(request):
+            data = json.loads(request.body)
+            if data["subject"] == "bad":
+                return "", 500, {}
+            return "ticket-%s" % (data["subject"],), 200, {}
+
+        snappy = self.snappy_for_session(
+            self.no_http_session, api_url="http://snappyapi.example.com/v1")
+        adapter = CallbackAdapter(handler)
+        self.no_http_session.mount("http://snappyapi.example.com/v1", adapter)
+
+        specs = [
+            {"mailbox_id": 1, "subject": str(i), "message": "msg"}
+            for i in range(10)]
+        specs[3]["subject"] = "bad"
+        results = list(snappy.create_notes(specs, max_workers=3))
+
+        self.assertEqual(len(adapter.requests), 10)
+        self.assertEqual(len(results), 10)
+        self.assertTrue(isinstance(results[3], Exception))
+        self.assertEqual(
+            results[:3] + results[4:],
+            ["ticket-%s" % (i,) for i in range(10) if i != 3])
+
+    def test_directory_lookups_cached(self):
+        """
+        With a cache, account, mailbox and staff lookups are only fetched
+        once until they are invalidated.
+        """
+        snappy = SnappyApiSender(
+            self.api_key, api_url="http://snappyapi.example.com/v1",
+            session=self.no_http_session, cache=True)
+        adapter = CallbackAdapter(lambda request: ('[{"id": 1}]', 200, {}))
+        self.no_http_session.mount("http://snappyapi.example.com/v1", adapter)
+
+        for _ in range(3):
+            self.assertEqual(snappy.get_accounts(), [{"id": 1}])
+            self.assertEqual(snappy.get_mailboxes(1), [{"id": 1}])
+            self.assertEqual(snappy.get_staff(1), [{"id": 1}])
+            self.assertEqual(snappy.get_staff(2), [{"id": 1}])
+        self.assertEqual(len(adapter.requests), 4)
+        self.assertEqual(snappy.cache.stats()["hits"], 8)
+
+        snappy.invalidate_cache("staff", account_id=1)
+        snappy.get_staff(1)
+        snappy.get_staff(2)
+        snappy.get_mailboxes(1)
+        self.assertEqual(len(adapter.requests), 5)
+
+        snappy.invalidate_cache()
+        snappy.get_accounts()
+        self.assertEqual(len(adapter.requests), 6)
+
+    def test_ticket_notes_revalidated_with_etag(self):
+        """
+        With revalidation, stored validators are sent and a 304 response is
+        served from the previously decoded body.
+        """
+        def handler(request):
+            if request.headers.get("If-None-Match") == '"v1"':
+                return "", 304, {}
+            return '[{"id": 1}]', 200, {
+                "ETag": '"v1"', "Last-Modified": "Mon, 22 Sep 2014"}
+
+        snappy = SnappyApiSender(
+            self.api_key, api_url="http://snappyapi.example.com/v1",
+            session=self.no_http_session, revalidation=True)
+        adapter = CallbackAdapter(handler)
+        self.no_http_session.mount("http://snappyapi.example.com/v1", adapter)
+
+        notes = snappy.get_ticket_notes("abc")
+        self.assertEqual(notes, [{"id": 1}])
+        self.assertIs(snappy.get_ticket_notes("abc"), notes)
+        self.assertEqual(snappy.get_ticket_notes("abc", if_changed=True), None)
+        self.assertEqual(
+            adapter.requests[1].headers["If-Modified-Since"],
+            "Mon, 22 Sep 2014")
+        self.assertEqual(snappy.revalidation.stats()["not_modified"], 2)
+
+    def test_ticket_notes_revalidated_with_content_hash(self):
+        """
+        Without validators from the server, an identical body is detected by
+        its hash and not decoded again.
+        """
+        bodies = ['[{"id": 1}]', '[{"id": 1}]', '[{"id": 2}, {"id": 1}]']
+
+        snappy = SnappyApiSender(
+            self.api_key, api_url="http://snappyapi.example.com/v1",
+            session=self.no_http_session, revalidation=True)
+        adapter = CallbackAdapter(lambda request: (bodies.pop(0), 200, {}))
+        self.no_http_session.mount("http://snappyapi.example.com/v1", adapter)
+
+        self.assertEqual(
+            snappy.get_ticket_notes("abc", if_changed=True), [{"id": 1}])
+        self.assertEqual(snappy.get_ticket_notes("abc", if_changed=True), None)
+        self.assertEqual(
+            snappy.get_ticket_notes("abc", if_changed=True),
+            [{"id": 2}, {"id": 1}])
+        self.assertNotIn("If-None-Match", adapter.requests[1].headers)
+        self.assertEqual(snappy.revalidation.stats(), {
+            "not_modified": 0, "unchanged": 1, "changed": 2, "size": 1})
+
+    def test_iter_ticket_notes(self):
+        """
+        ``.iter_ticket_notes()`` yields the notes for every ticket, with
+        failures reported inline.
+        """
+        def handler(request):
+            ticket_id = request.url.split("/")[-3]
+            if ticket_id == "t3":
+                return "", 404, {}
+            return '[{"ticket": "%s"}]' % (ticket_id,), 200, {}
+
+        snappy = self.snappy_for_session(
+            self.no_http_session, api_url="http://snappyapi.example.com/v1")
+        adapter = CallbackAdapter(handler)
+        self.no_http_session.mount("http://snappyapi.example.com/v1", adapter)
+
+        ticket_ids = ["t%s" % (i,) for i in range(8)]
+        results = dict(snappy.iter_ticket_notes(ticket_ids, concurrency=3))
+
+        self.assertEqual(sorted(results), ticket_ids)
+        self.assertTrue(isinstance(results.pop("t3"), Exception))
+        for ticket_id, notes in results.items():
+            self.assertEqual(notes, [{"ticket": ticket_id}])
+
+    def test_retry_with_backoff(self):
+        """
+        With a backoff policy, 429 and 5xx responses to GETs are retried and
+        ``Retry-After`` pauses the rate limiter.
+        """
+        statuses = [429, 503, 200]
+
+        def handler(request):
+            return "[]", statuses.pop(0), {"Retry-After": "2"}
+
+        clock = FakeClock()
+        limiter = TokenBucket(1000, clock=clock, sleep=clock.sleep)
+        snappy = SnappyApiSender(
+            self.api_key, api_url="http://snappyapi.example.com/v1",
+            session=self.no_http_session, rate_limit=limiter,
+            backoff=Backoff(random=lambda: 0, sleep=clock.sleep))
+        adapter = CallbackAdapter(handler)
+        self.no_http_session.mount("http://snappyapi.example.com/v1", adapter)
+
+        self.assertEqual(snappy.get_ticket_notes("abc"), [])
+        self.assertEqual(len(adapter.requests), 3)
+        # The 429 pauses the limiter for 2 seconds and the retry waits for
+        # the pause to end. The 503 only sleeps.
+        self.assertEqual(clock.sleeps, [2, 2])
+
+    def test_no_retry_of_failed_post(self):
+        """
+        A server error in response to a POST isn't retried.
+        """
+        sleeps = []
+        snappy = SnappyApiSender(
+            self.api_key, api_url="http://snappyapi.example.com/v1",
+            session=self.no_http_session,
+            backoff=Backoff(sleep=sleeps.append))
+        adapter = CallbackAdapter(lambda request: ("", 500, {}))
+        self.no_http_session.mount("http://snappyapi.example.com/v1", adapter)
+
+        self.assertRaises(
+            Exception, snappy.create_note, 1, "subject", "message")
+        self.assertEqual(len(adapter.requests), 1)
+        self.assertEqual(sleeps, [])
+
+    def test_rate_limit_shared_by_api_key(self):
+        """
+        Senders given a numeric rate limit share a limiter per API key.
+        """
+        snappy_1 = SnappyApiSender("shared-key", rate_limit=5)
+        snappy_2 = SnappyApiSender("shared-key", rate_limit=5)
+        snappy_3 = SnappyApiSender("other-key", rate_limit=5)
+        self.assertIs(snappy_1.rate_limiter, snappy_2.rate_limiter)
+        self.assertIsNot(snappy_1.rate_limiter, snappy_3.rate_limiter)
+
+    def test_models(self):
+        """
+        With models enabled, getters return models, and models can be passed
+        to ``.create_note()``.
+        """
+        def handler(request):
+            if request.method == "POST":
+                return "ticket-1", 200, {}
+            if request.url.endswith("/notes/"):
+                return '[{"id": 7, "created_at": 0, "contacts": []}]', 200, {}
+            return (
+                '[{"id": 5, "first_name": "Mike", "last_name": "Jones",'
+                ' "address": "mike@example.com", "photo": null}]', 200, {})
+
+        snappy = SnappyApiSender(
+            self.api_key, api_url="http://snappyapi.example.com/v1",
+            session=self.no_http_session, models=True)
+        adapter = CallbackAdapter(handler)
+        self.no_http_session.mount("http://snappyapi.example.com/v1", adapter)
+
+        [staff] = snappy.get_staff(1)
+        self.assertEqual((type(staff).__name__, staff.id), ("Staff", 5))
+        [note] = snappy.get_ticket_notes("abc")
+        self.assertEqual(note.created_at.year, 1970)
+        [note] = snappy.iter_ticket_notes_stream("abc")
+        self.assertEqual(type(note).__name__, "Note")
+
+        [mailbox] = Mailbox.from_list([{"id": 3642}])
+        snappy.create_note(
+            mailbox, "Subject", "Message", to_addr=[staff], staff_id=staff)
+        self.assertEqual(json.loads(adapter.requests[-1].body), {
+            "mailbox_id": 3642, "subject": "Subject", "message": "Message",
+            "to": [{"name": "Mike Jones", "address": "mike@example.com"}],
+            "staff_id": 5,
+        })
+
+    def test_create_note_idempotent(self):
+        """
+        With an idempotency cache, a repeated note returns the original
+        ticket id without another request unless its key differs.
+        """
+        adapter = CallbackAdapter(
+            lambda request: ("ticket-%s" % (len(adapter.requests),), 200, {}))
+        snappy = SnappyApiSender(
+            self.api_key, api_url="http://snappyapi.example.com/v1",
+            session=self.no_http_session, idempotency=True)
+        self.no_http_session.mount("http://snappyapi.example.com/v1", adapter)
+
+        note = {"mailbox_id": 1, "subject": "Subject", "message": "Message"}
+        self.assertEqual(snappy.create_note(**note), "ticket-1")
+        self.assertEqual(snappy.create_note(**note), "ticket-1")
+        self.assertEqual(
+            snappy.create_note(idempotency_key="other", **note), "ticket-2")
+        self.assertEqual(
+            snappy.create_note(ticket_id="ticket-1", **note), "ticket-3")
+        self.assertEqual(len(adapter.requests), 3)
+
+    def test_codec(self):
+        """
+        Request bodies are encoded and response bodies decoded from bytes
+        with the sender's codec.
+        """
+        calls = []
+
+        class RecordingCodec(StdlibCodec):
+            def dumps(self, value):
+                calls.append(("dumps", value))
+                return super().dumps(value)
+
+            def loads(self, data):
+                calls.append(("loads", data))
+                return super().loads(data)
+
+        snappy = SnappyApiSender(
+            self.api_key, api_url="http://snappyapi.example.com/v1",
+            session=self.no_http_session, codec=RecordingCodec())
+        adapter = CallbackAdapter(lambda request: (
+            request.body if request.method == "POST" else '[{"id": 1}]',
+            200, {}))
+        self.no_http_session.mount("http://snappyapi.example.com/v1", adapter)
+
+        self.assertEqual(snappy.get_accounts(), [{"id": 1}])
+        snappy.create_note(1, "Subject", "Message", staff_id=2)
+        self.assertEqual(calls, [
+            ("loads", b'[{"id": 1}]'),
+            ("dumps", {"mailbox_id": 1, "subject": "Subject",
+                       "message": "Message", "staff_id": 2}),
+        ])
+        self.assertEqual(
+            adapter.requests[1].body,
+            b'{"mailbox_id":1,"subject":"Subject","message":"Message",'
+            b'"staff_id":2}')
+
     ####################################
     # Tests for public API below here. #
     ####################################
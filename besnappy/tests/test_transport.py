@@ -0,0 +1,150 @@
+"""
+Tests for besnappy.transport.
+"""
+
+import gzip
+import json
+from unittest import TestCase
+
+from requests import Session
+
+from besnappy.tests.helpers import LocalHTTPServer
+from besnappy.tickets import SnappyApiSender
+from besnappy.transport import (
+    ApiKeyAuth, SnappyHTTPAdapter, basic_auth_header, build_session,
+    session_pool_stats)
+
+
+def json_handler(request, body):
+    return 200, {"Content-Type": "application/json"}, "[]"
+
+
+class TestBuildSession(TestCase):
+    def test_adapter_configuration(self):
+        """
+        The pool options are passed to the mounted adapter.
+        """
+        session = build_session(
+            pool_connections=3, pool_maxsize=20, pool_block=True,
+            max_retries=2)
+        adapter = session.get_adapter("https://app.besnappy.com/api/v1")
+        self.assertTrue(isinstance(adapter, SnappyHTTPAdapter))
+        self.assertIs(session.get_adapter("http://example.com"), adapter)
+        self.assertEqual(adapter._pool_connections, 3)
+        self.assertEqual(adapter._pool_maxsize, 20)
+        self.assertEqual(adapter._pool_block, True)
+        self.assertEqual(adapter.max_retries.total, 2)
+
+    def test_keep_alive_disabled(self):
+        """
+        Disabling keep-alive asks the server to close each connection.
+        """
+        self.assertEqual(
+            build_session(keep_alive=False).headers["Connection"], "close")
+        self.assertNotEqual(
+            build_session().headers.get("Connection"), "close")
+
+    def test_session_pool_stats_without_adapter(self):
+        """
+        Sessions without a ``SnappyHTTPAdapter`` have no pool stats.
+        """
+        self.assertEqual(session_pool_stats(Session()), None)
+
+
+class TestPoolStats(TestCase):
+    def test_connections_reused(self):
+        """
+        Sequential requests over a keep-alive session reuse one connection.
+        """
+        with LocalHTTPServer(json_handler) as server:
+            snappy = SnappyApiSender("dummy_key", api_url=server.url)
+            self.assertEqual(snappy.pool_stats()["requests"], 0)
+            for _ in range(5):
+                snappy.get_accounts()
+            stats = snappy.pool_stats()
+        self.assertEqual(stats, {
+            "pools": 1,
+            "connections_created": 1,
+            "requests": 5,
+            "connections_reused": 4,
+        })
+
+    def test_connections_not_reused_without_keep_alive(self):
+        """
+        With keep-alive disabled, every request opens a new connection.
+        """
+        with LocalHTTPServer(json_handler) as server:
+            snappy = SnappyApiSender(
+                "dummy_key", api_url=server.url, keep_alive=False)
+            for _ in range(3):
+                snappy.get_accounts()
+            stats = snappy.pool_stats()
+        self.assertEqual(stats["connections_created"], 3)
+        self.assertEqual(stats["connections_reused"], 0)
+
+    def test_provided_session_has_no_stats(self):
+        """
+        Pool options don't apply to a session provided by the caller.
+        """
+        snappy = SnappyApiSender("dummy_key", session=Session())
+        self.assertEqual(snappy.pool_stats(), None)
+
+
+class TestAuthentication(TestCase):
+    def test_api_key_auth(self):
+        """
+        ``ApiKeyAuth`` sets a precomputed basic auth header.
+        """
+        class FakeRequest(object):
+            headers = {}
+
+        request = ApiKeyAuth("key")(FakeRequest())
+        self.assertEqual(request.headers["Authorization"], "Basic a2V5Ong=")
+        self.assertEqual(basic_auth_header("key"), "Basic a2V5Ong=")
+
+
+class TestCompression(TestCase):
+    def test_gzip_responses(self):
+        """
+        Compressed responses are asked for and decoded transparently.
+        """
+        requests = []
+
+        def handler(request, body):
+            requests.append(dict(request.headers))
+            content = gzip.compress(json.dumps([{"id": 1}]).encode("utf-8"))
+            return 200, {
+                "Content-Type": "application/json",
+                "Content-Encoding": "gzip",
+            }, content
+
+        with LocalHTTPServer(handler) as server:
+            snappy = SnappyApiSender("dummy_key", api_url=server.url)
+            self.assertEqual(snappy.get_accounts(), [{"id": 1}])
+            self.assertEqual(
+                list(snappy.iter_ticket_notes_stream("abc")), [{"id": 1}])
+        self.assertIn("gzip", requests[0]["Accept-Encoding"])
+        self.assertEqual(
+            requests[0]["Authorization"], basic_auth_header("dummy_key"))
+
+    def test_request_compression(self):
+        """
+        Request bodies over the compression threshold are sent gzipped.
+        """
+        received = []
+
+        def handler(request, body):
+            if request.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            received.append(
+                (request.headers.get("Content-Encoding"), json.loads(body)))
+            return 200, {"Content-Type": "text/html"}, "ticket"
+
+        with LocalHTTPServer(handler) as server:
+            snappy = SnappyApiSender(
+                "dummy_key", api_url=server.url, compress_threshold=1000)
+            snappy.create_note(1, "Short", "Message")
+            snappy.create_note(1, "Long", "Message " * 1000)
+        self.assertEqual(
+            [(encoding, data["subject"]) for encoding, data in received],
+            [(None, "Short"), ("gzip", "Long")])
@@ -1,7 +1,93 @@
 """ Utilities for sending to Snappy HTTP API.
 """
-import json
-from requests import Session
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager
+import gzip
+import hashlib
+import threading
+import time
+
+from requests import Request
+from requests.exceptions import RequestException, Timeout
+
+from .breaker import (
+    CircuitBreaker, FallbackCall, FastFailError, is_failure)
+from .cache import RevalidationCache, RevalidationEntry, TTLCache
+from .concurrency import bounded_map
+from .directory import DirectoryIndex
+from .hedging import HedgePolicy, attempt_timeout
+from .idempotency import IdempotencyCache, note_fingerprint
+from .jsoncodec import get_codec
+from .jsonstream import iter_json_array
+from .metrics import endpoint_template
+from .models import (
+    Account, Mailbox, Note, Staff, address_list, model_id)
+from .ratelimit import Backoff, shared_rate_limiter
+from .transport import ApiKeyAuth, build_session, session_pool_stats
+
+
+def build_note_data(mailbox_id, subject, message, ticket_id=None,
+                    to_addr=None, from_addr=None, staff_id=None, scope=None):
+    """
+    Build the request body for a ``POST note`` API call.
+
+    The parameters are the same as those of
+    :meth:`SnappyApiSender.create_note`. Models from :mod:`besnappy.models`
+    may be given for ``mailbox_id`` and ``staff_id``, and as addresses in
+    ``to_addr`` and ``from_addr``.
+
+    :returns:
+        A dict suitable for JSON encoding.
+    """
+    data = {
+        "mailbox_id": model_id(mailbox_id),
+        "subject": subject,
+        "message": message,
+    }
+    if ticket_id is not None:
+        data["id"] = ticket_id
+    if to_addr is not None:
+        data["to"] = address_list(to_addr)
+    if from_addr is not None:
+        data["from"] = address_list(from_addr)
+    if staff_id is not None:
+        data["staff_id"] = model_id(staff_id)
+    if scope is not None:
+        data["scope"] = scope
+    return data
+
+
+def _first_success(*futures):
+    """
+    Wait for the first of ``futures`` to succeed and return it. A response
+    with a failure status only wins if no other copy does better. If they
+    all raise, the first one's exception is raised.
+    """
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if (future.exception() is None and
+                    not is_failure(future.result()[0].status_code)):
+                return future
+    for future in futures:
+        if future.exception() is None:
+            return future
+    return futures[0].result()
+
+
+def _close_response(future):
+    # Release the connection held by a hedged request that lost.
+    if future.exception() is None:
+        future.result()[0].close()
+
+
+#: Default cache time-to-live, in seconds, for each cacheable endpoint.
+DEFAULT_CACHE_TTLS = {
+    "accounts": 3600,
+    "mailboxes": 600,
+    "staff": 600,
+}
 
 
 class SnappyApiSender(object):
@@ -19,84 +105,675 @@ class SnappyApiSender(object):
         :class:`requests.Session`
     :param session:
         Requests session to use for HTTP requests. Defaults to
-        a new session.
+        a new session with a pooled adapter configured by the pool options
+        below. The pool options are ignored if a session is provided.
+    :param int pool_connections:
+        Number of per-host connection pools to keep. Defaults to 10.
+    :param int pool_maxsize:
+        Maximum number of connections kept open per host. Set this to at
+        least the number of threads sharing the sender. Defaults to 10.
+    :param bool pool_block:
+        If ``True``, threads wait for a free pooled connection instead of
+        opening and then discarding extra connections. Defaults to
+        ``False``.
+    :param max_retries:
+        Number of retries for failed connections, or a
+        :class:`urllib3.util.Retry` instance. Defaults to 0.
+    :param bool keep_alive:
+        If ``False``, connections are closed after each request. Defaults to
+        ``True``.
+    :param cache:
+        Cache for the account, mailbox and staff lookups. Pass ``True`` for
+        a new :class:`besnappy.cache.TTLCache` or pass an existing cache to
+        share it. Defaults to ``None`` (no caching).
+    :param dict cache_ttls:
+        Time-to-live in seconds per cached endpoint (``"accounts"``,
+        ``"mailboxes"`` and ``"staff"``), overriding
+        :data:`DEFAULT_CACHE_TTLS`.
+    :param revalidation:
+        Conditional GET support for JSON lookups. Pass ``True`` for a new
+        :class:`besnappy.cache.RevalidationCache` or pass an existing one.
+        Validators (``ETag`` and ``Last-Modified``) are stored per URL and
+        sent with later requests; a ``304 Not Modified`` response, or a body
+        identical to the previous one, is served from the stored decoded
+        body. Defaults to ``None`` (no revalidation).
+    :param rate_limit:
+        Client-side rate limit. Pass a number of requests per second to use
+        the limiter shared by all senders in this process with the same API
+        key (senders sharing a key must ask for the same rate), or pass a
+        :class:`besnappy.ratelimit.TokenBucket`. Defaults to ``None`` (no
+        limit).
+    :param backoff:
+        Retry policy for 429 and 5xx responses. Pass ``True`` for a default
+        :class:`besnappy.ratelimit.Backoff` or pass your own. A 429 response
+        also pauses the rate limiter for its ``Retry-After`` period.
+        ``Retry-After`` delays are honoured in full, unless they would pass
+        the call's deadline, in which case the response is returned without
+        retrying. Defaults to ``None`` (no retries).
+    :type metrics:
+        :class:`besnappy.metrics.Metrics`
+    :param metrics:
+        Instrumentation hooks to call with request timings, sizes, status
+        codes, retries and decode times. Defaults to ``None``.
+    :param bool models:
+        If ``True``, the getters return compact models from
+        :mod:`besnappy.models` instead of dicts. Defaults to ``False``.
+    :param idempotency:
+        Duplicate suppression for created notes. Pass ``True`` for a new
+        :class:`besnappy.idempotency.IdempotencyCache` or pass your own. A
+        note identical to one created within the cache's window returns
+        the original ticket identifier without an API call. Defaults to
+        ``None``.
+    :param int compress_threshold:
+        If set, request bodies of at least this many bytes are sent gzipped
+        with ``Content-Encoding: gzip``. Only enable this if the API server
+        accepts compressed requests. Defaults to ``None`` (no compression).
+    :param codec:
+        JSON codec for request and response bodies, as accepted by
+        :func:`besnappy.jsoncodec.get_codec`. Defaults to the fastest
+        installed backend.
+    :param timeout:
+        Timeout for each HTTP request, in seconds, or a ``(connect, read)``
+        tuple, as accepted by :mod:`requests`. Defaults to ``None`` (wait
+        forever).
+    :param float deadline:
+        Overall time limit for each API call, in seconds, covering any
+        retries. Each request's timeout is cut to the time left, and a call
+        that runs out of time raises
+        :class:`besnappy.hedging.DeadlineExceeded`. Defaults to ``None``.
+        Use :meth:`timeouts` to change the timeout or deadline for some
+        calls.
+    :param hedge:
+        Hedged GET requests. Pass ``True`` for a default
+        :class:`besnappy.hedging.HedgePolicy` or pass your own. A GET that
+        is slower than the policy's latency percentile is sent again and
+        the first response is used. Defaults to ``None`` (no hedging).
+    :param breaker:
+        Circuit breaker and load shedding per endpoint. Pass ``True`` for a
+        default :class:`besnappy.breaker.CircuitBreaker` or pass your own,
+        which may be shared with other senders. Calls to an endpoint whose
+        circuit is open raise :class:`besnappy.breaker.CircuitOpenError`
+        without a request. Defaults to ``None``.
+    :param fallback:
+        Called as ``fallback(call, error)`` when a public API call fails
+        fast with a :class:`besnappy.breaker.FastFailError`, where ``call``
+        is a :class:`besnappy.breaker.FallbackCall`. Its return value is
+        returned from the call; it may raise ``error`` to let it through.
+        See :class:`besnappy.breaker.StaleCacheFallback` and
+        :class:`besnappy.breaker.OutboxFallback`. Defaults to ``None``.
+    :type directory:
+        :class:`besnappy.directory.DirectoryIndex`
+    :param directory:
+        Index used by :meth:`create_note` to resolve email addresses given
+        in place of mailbox and staff ids. Defaults to a
+        :class:`besnappy.directory.DirectoryIndex` of every account,
+        created the first time an address is resolved.
+
+    Proxy and TLS settings from the environment are read once, when the
+    sender is created, rather than for every request.
     """
 
-    def __init__(self, api_key, api_url=None, session=None):
+    def __init__(self, api_key, api_url=None, session=None,
+                 pool_connections=10, pool_maxsize=10, pool_block=False,
+                 max_retries=0, keep_alive=True, cache=None,
+                 cache_ttls=None, revalidation=None, rate_limit=None,
+                 backoff=None, metrics=None, models=False,
+                 idempotency=None, compress_threshold=None, codec=None,
+                 timeout=None, deadline=None, hedge=None, breaker=None,
+                 fallback=None, directory=None):
         self.api_key = api_key
         if api_url is None:
             api_url = "https://app.besnappy.com/api/v1"
         self.api_url = api_url
+        self._url_prefix = api_url + "/"
+        self._auth = ApiKeyAuth(api_key)
+        self._headers = {'content-type': 'application/json; charset=utf-8'}
+        self.compress_threshold = compress_threshold
+        self.codec = get_codec(codec)
         if session is None:
-            session = Session()
+            session = build_session(
+                pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                pool_block=pool_block, max_retries=max_retries,
+                keep_alive=keep_alive)
         self.session = session
+        # Looking up proxies in the environment is the most expensive part
+        # of a request, so do it once. Certificates are never verified.
+        self._send_settings = session.merge_environment_settings(
+            api_url, {}, None, False, None)
+        del self._send_settings["stream"]
+        if cache is True:
+            cache = TTLCache()
+        self.cache = cache
+        self.cache_ttls = dict(DEFAULT_CACHE_TTLS)
+        if cache_ttls is not None:
+            self.cache_ttls.update(cache_ttls)
+        if revalidation is True:
+            revalidation = RevalidationCache()
+        self.revalidation = revalidation
+        if rate_limit is not None and not hasattr(rate_limit, "acquire"):
+            rate_limit = shared_rate_limiter(api_key, rate_limit)
+        self.rate_limiter = rate_limit
+        if backoff is True:
+            backoff = Backoff()
+        self.backoff = backoff
+        self.metrics = metrics
+        self.models = models
+        if idempotency is True:
+            idempotency = IdempotencyCache()
+        self.idempotency = idempotency
+        self.timeout = timeout
+        self.deadline = deadline
+        self._local = threading.local()
+        if hedge is True:
+            hedge = HedgePolicy()
+        self.hedge = hedge
+        self._hedge_lock = threading.Lock()
+        self._hedge_executor = None
+        self._primary_slots = None
+        self._hedge_slots = None
+        if breaker is True:
+            breaker = CircuitBreaker()
+        self.breaker = breaker
+        self.fallback = fallback
+        self.directory = directory
+        self._directory_lock = threading.Lock()
+
+    def pool_stats(self):
+        """
+        Report connection pool statistics for this sender's session.
+
+        :returns:
+            A dict with the number of ``pools``, ``connections_created``,
+            ``requests`` made and ``connections_reused``, or ``None`` if the
+            session was provided by the caller and doesn't have a
+            :class:`besnappy.transport.SnappyHTTPAdapter` mounted.
+        """
+        return session_pool_stats(self.session)
+
+    def _call_options(self):
+        options = getattr(self._local, "options", None)
+        if options is None:
+            return self.timeout, self.deadline
+        return options
+
+    @contextmanager
+    def timeouts(self, timeout=None, deadline=None):
+        """
+        Use a different timeout or deadline for calls made by the current
+        thread inside a ``with`` block::
+
+            with snappy.timeouts(deadline=2.0):
+                notes = snappy.get_ticket_notes(ticket_id)
+
+        Arguments left as ``None`` keep their current values. The options
+        don't apply to calls made in other threads, such as the worker
+        threads of :meth:`iter_ticket_notes`.
+
+        :param timeout:
+            Timeout for each HTTP request, as for the ``timeout`` argument
+            of the sender.
+        :param float deadline:
+            Time limit for each call, including retries.
+        """
+        previous = getattr(self._local, "options", None)
+        current_timeout, current_deadline = self._call_options()
+        self._local.options = (
+            current_timeout if timeout is None else timeout,
+            current_deadline if deadline is None else deadline)
+        try:
+            yield
+        finally:
+            self._local.options = previous
+
+    def _with_fallback(self, name, kwargs, call):
+        """
+        Return ``call()``, or the fallback's result if it fails fast.
+        """
+        if self.fallback is None:
+            return call()
+        try:
+            return call()
+        except FastFailError as e:
+            return self.fallback(FallbackCall(self, name, kwargs), e)
+
+    def get_cached(self, endpoint, key=(), stale=False):
+        """
+        Return a cached lookup without calling the API.
 
-    def _api_request(self, method, endpoint, py_data=None):
-        url = "%s/%s" % (self.api_url, endpoint)
-        headers = {'content-type': 'application/json; charset=utf-8'}
-        auth = (self.api_key, "x")
-        if method is "POST":
-            data = json.dumps(py_data)
-            r = self.session.post(
-                url, auth=auth, data=data, headers=headers, verify=False)
-        elif method is "GET":
-            if py_data is not None:
-                r = self.session.get(
-                    url, auth=auth, params=data, headers=headers, verify=False)
+        :param str endpoint:
+            ``"accounts"``, ``"mailboxes"`` or ``"staff"``.
+        :param tuple key:
+            ``(account_id,)`` for mailboxes and staff.
+        :param bool stale:
+            Also return entries whose time-to-live has passed.
+
+        :returns:
+            The cached value, or ``None`` if there isn't one (or the sender
+            has no cache).
+        """
+        if self.cache is None:
+            return None
+        key = ((self.api_url, self.api_key), endpoint) + tuple(key)
+        if stale:
+            return self.cache.get_stale(key)
+        return self.cache.get(key)
+
+    def _cached(self, endpoint, key, fetch):
+        """
+        Return the result of ``fetch()``, via the cache if there is one.
+
+        Entries are keyed by API URL and key as well as endpoint, because
+        different API keys see different accounts and a cache may be shared
+        by several senders.
+        """
+        if self.cache is None:
+            return fetch()
+        return self.cache.get_or_fetch(
+            ((self.api_url, self.api_key), endpoint) + key, fetch,
+            self.cache_ttls[endpoint])
+
+    def invalidate_cache(self, endpoint=None, account_id=None):
+        """
+        Drop cached lookups so the next call fetches fresh data.
+
+        :param str endpoint:
+            Only drop entries for this endpoint (``"accounts"``,
+            ``"mailboxes"`` or ``"staff"``). Defaults to all endpoints.
+        :param int account_id:
+            Only drop mailbox and staff entries for this account.
+        """
+        if self.cache is None:
+            return
+
+        def matches(key):
+            if key[0] != (self.api_url, self.api_key):
+                return False
+            if endpoint is not None and key[1] != endpoint:
+                return False
+            if account_id is not None:
+                return key[1:] in (
+                    ("mailboxes", account_id), ("staff", account_id))
+            return True
+
+        self.cache.invalidate_where(matches)
+
+    def _api_request(self, method, endpoint, py_data=None, headers=None,
+                     stream=False):
+        url = self._url_prefix + endpoint
+        req_headers = self._headers
+        if headers:
+            req_headers = dict(req_headers, **headers)
+        timeout, deadline = self._call_options()
+        expires = None if deadline is None else time.monotonic() + deadline
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            send_timeout = attempt_timeout(timeout, expires)
+            if self.breaker is None:
+                r = self._send_attempt(
+                    method, endpoint, url, py_data, req_headers, stream,
+                    send_timeout, expires)
             else:
-                r = self.session.get(
-                    url, auth=auth, headers=headers, verify=False)
+                r = self._send_guarded(
+                    method, endpoint, url, py_data, req_headers, stream,
+                    send_timeout, expires,
+                    truncated=send_timeout != timeout)
+            if self.backoff is None or not self.backoff.should_retry(
+                    method, r.status_code, attempt):
+                break
+            delay = self.backoff.delay(attempt, r.headers.get('Retry-After'))
+            if delay is None or (
+                    expires is not None and
+                    time.monotonic() + delay >= expires):
+                # No time for another attempt; report this response.
+                break
+            if self.metrics is not None:
+                self.metrics.request_retried(
+                    endpoint_template(endpoint), method, r.status_code, delay)
+            if r.status_code == 429 and self.rate_limiter is not None:
+                self.rate_limiter.pause(delay)
+            r.close()
+            self.backoff.sleep(delay)
+            attempt += 1
+        if stream and not r.ok:
+            r.close()
         r.raise_for_status()
         # return whole response because some calls are just single text
         # response not json
         return r
 
+    def _send_guarded(self, method, endpoint, url, py_data, headers, stream,
+                      timeout, expires=None, truncated=False):
+        """
+        Send a request through the circuit breaker.
+
+        ``truncated`` means ``timeout`` was cut short to fit the call's
+        deadline. A request that then times out ran out of the caller's
+        time, which says nothing about the API, so it isn't counted.
+        """
+        template = endpoint_template(endpoint)
+        ticket = self.breaker.before(template)
+        try:
+            r = self._send_attempt(
+                method, endpoint, url, py_data, headers, stream, timeout,
+                expires)
+        except Timeout:
+            if truncated:
+                self.breaker.release(template, ticket)
+            else:
+                self.breaker.after(template, True, ticket)
+            raise
+        except RequestException:
+            self.breaker.after(template, True, ticket)
+            raise
+        except BaseException:
+            self.breaker.release(template, ticket)
+            raise
+        self.breaker.after(template, is_failure(r.status_code), ticket)
+        return r
+
+    def _send_attempt(self, method, endpoint, url, py_data, headers, stream,
+                      timeout, expires=None):
+        if self.hedge is not None and method == "GET" and not stream:
+            return self._send_hedged(
+                endpoint, url, py_data, headers, timeout, expires)
+        return self._send_once(
+            method, endpoint, url, py_data, headers, stream, timeout)
+
+    def _send_once(self, method, endpoint, url, py_data, headers, stream,
+                   timeout):
+        if self.metrics is None:
+            return self._send(method, url, py_data, headers, stream, timeout)
+        return self._send_instrumented(
+            method, endpoint, url, py_data, headers, stream, timeout)
+
+    def _timed_get(self, endpoint, url, params, headers, timeout):
+        start = time.monotonic()
+        r = self._send_once(
+            "GET", endpoint, url, params, headers, False, timeout)
+        return r, time.monotonic() - start
+
+    def _primary_get(self, endpoint, url, params, headers, timeout):
+        try:
+            return self._timed_get(endpoint, url, params, headers, timeout)
+        finally:
+            self._primary_slots.release()
+
+    def _hedge_get(self, endpoint, url, params, headers, timeout):
+        try:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            return self._timed_get(endpoint, url, params, headers, timeout)
+        finally:
+            self._hedge_slots.release()
+
+    def _get_hedge_executor(self):
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                # Every task holds a primary or hedge slot, so the pool
+                # never queues work behind a stalled request.
+                self._hedge_executor = ThreadPoolExecutor(
+                    max_workers=2 * self.hedge.max_workers,
+                    thread_name_prefix="besnappy-hedge")
+                self._primary_slots = threading.BoundedSemaphore(
+                    self.hedge.max_workers)
+                self._hedge_slots = threading.BoundedSemaphore(
+                    self.hedge.max_workers)
+            return self._hedge_executor
+
+    def _send_hedged(self, endpoint, url, params, headers, timeout,
+                     expires=None):
+        """
+        Send a GET request, and send it again if the first copy is slower
+        than the hedging policy allows. The first successful response wins.
+
+        Both copies run in a shared pool of threads, so the caller can take
+        whichever answers first. When the pool has no worker free for the
+        first copy, it is sent from the calling thread and not hedged, so
+        requests that stall only hold up their own callers. The hedge gets
+        a timeout worked out afresh from the time left before ``expires``.
+        """
+        template = endpoint_template(endpoint)
+        delay = self.hedge.delay(template)
+        if delay is not None:
+            executor = self._get_hedge_executor()
+            if not self._primary_slots.acquire(blocking=False):
+                delay = None
+        if delay is None:
+            r, elapsed = self._timed_get(
+                endpoint, url, params, headers, timeout)
+            self.hedge.observe(template, elapsed)
+            return r
+        primary = executor.submit(
+            self._primary_get, endpoint, url, params, headers, timeout)
+        done, _ = wait([primary], timeout=delay)
+        if not done and self._hedge_slots.acquire(blocking=False):
+            try:
+                hedge_timeout = attempt_timeout(
+                    self._call_options()[0], expires)
+            except Timeout:
+                # The deadline has passed, so there's no time for a hedge.
+                self._hedge_slots.release()
+            else:
+                return self._race(
+                    template, primary, executor.submit(
+                        self._hedge_get, endpoint, url, params, headers,
+                        hedge_timeout))
+        r, elapsed = primary.result()
+        self.hedge.observe(template, elapsed)
+        return r
+
+    def _race(self, template, primary, hedge):
+        winner = _first_success(primary, hedge)
+        loser = primary if winner is hedge else hedge
+        loser.add_done_callback(_close_response)
+        hedge_won = winner is hedge
+        self.hedge.record(hedge_won)
+        if self.metrics is not None:
+            self.metrics.request_hedged(
+                template, "GET", "hedge" if hedge_won else "primary")
+        r, elapsed = winner.result()
+        self.hedge.observe(template, elapsed)
+        return r
+
+    def _send(self, method, url, py_data, headers, stream=False,
+              timeout=None):
+        if method == "POST":
+            data = self.codec.dumps(py_data)
+            if (self.compress_threshold is not None and
+                    len(data) >= self.compress_threshold):
+                data = gzip.compress(data, compresslevel=6, mtime=0)
+                headers = dict(headers, **{'content-encoding': 'gzip'})
+            request = Request(
+                method, url, data=data, headers=headers, auth=self._auth)
+        elif method == "GET":
+            request = Request(
+                method, url, params=py_data, headers=headers,
+                auth=self._auth)
+        return self.session.send(
+            self.session.prepare_request(request), stream=stream,
+            timeout=timeout, **self._send_settings)
+
+    def _send_instrumented(self, method, endpoint, url, py_data, headers,
+                           stream=False, timeout=None):
+        """
+        Send a request and report it to the metrics hooks.
+
+        For streamed responses the body hasn't been read yet, so the elapsed
+        time only covers the response headers and no size is reported.
+        """
+        template = endpoint_template(endpoint)
+        start = time.perf_counter()
+        try:
+            r = self._send(method, url, py_data, headers, stream, timeout)
+        except Exception as e:
+            self.metrics.request_failed(
+                template, method, e, time.perf_counter() - start)
+            raise
+        elapsed = time.perf_counter() - start
+        body = r.request.body
+        self.metrics.request_finished(
+            template, method, r.status_code, elapsed,
+            r.elapsed.total_seconds(), len(body) if body else 0,
+            None if stream else len(r.content))
+        return r
+
+    def _decode_json(self, response, endpoint, model=None):
+        """
+        Decode a JSON response body, reporting the time taken.
+
+        If models are enabled and a ``model`` class is given, the body is
+        decoded into a list of models.
+        """
+        if self.metrics is None:
+            return self._decode_body(response, model)
+        start = time.perf_counter()
+        value = self._decode_body(response, model)
+        self.metrics.response_decoded(
+            endpoint_template(endpoint), time.perf_counter() - start)
+        return value
+
+    def _decode_body(self, response, model):
+        # Decode straight from the body bytes, without building a str.
+        value = self.codec.loads(response.content)
+        if model is not None and self.models:
+            value = model.from_list(value)
+        return value
+
+    def _get_json(self, endpoint, model=None):
+        """
+        Make a GET request and return the decoded JSON body.
+        """
+        return self._get_json_if_changed(endpoint, model)[0]
+
+    def _get_json_if_changed(self, endpoint, model=None):
+        """
+        Make a GET request, revalidating against the previous response if
+        revalidation is enabled.
+
+        :returns:
+            A ``(value, changed)`` tuple. ``changed`` is ``False`` if the
+            response is known to be the same as the previous one for this
+            URL, in which case ``value`` is the previously decoded body.
+        """
+        if self.revalidation is None:
+            r = self._api_request('GET', endpoint)
+            return self._decode_json(r, endpoint, model), True
+
+        url = self._url_prefix + endpoint
+        entry = self.revalidation.get(url)
+        headers = {}
+        if entry is not None:
+            if entry.etag is not None:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified is not None:
+                headers['If-Modified-Since'] = entry.last_modified
+        r = self._api_request('GET', endpoint, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            self.revalidation.record("not_modified")
+            return entry.value, False
+
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        # Without validators from the server we can still avoid decoding an
+        # unchanged body by comparing hashes.
+        digest = hashlib.sha1(r.content).digest()
+        if entry is not None and entry.digest == digest:
+            self.revalidation.record("unchanged")
+            value, changed = entry.value, False
+        else:
+            self.revalidation.record("changed")
+            value, changed = self._decode_json(r, endpoint, model), True
+        self.revalidation.set(
+            url, RevalidationEntry(etag, last_modified, digest, value))
+        return value, changed
+
     def get_accounts(self):
         """
         List accounts available.
 
+        The result is cached if the sender has a cache. Cached lists are
+        shared between callers and must not be modified.
+
         :returns:
-            List of account dicts.
+            List of account dicts, or :class:`besnappy.models.Account`
+            models if models are enabled.
         """
-        response = self._api_request('GET', 'accounts')
-        return response.json()
+        return self._with_fallback("get_accounts", {}, lambda: self._cached(
+            "accounts", (), self._fetch_accounts))
+
+    def _fetch_accounts(self):
+        return self._get_json('accounts', Account)
 
     def get_mailboxes(self, account_id):
         """
         List mailboxes in account.
 
+        The result is cached if the sender has a cache.
+
         :param int account_id:
             Account identifier.
 
         :returns:
-            List of mailbox dicts.
+            List of mailbox dicts, or :class:`besnappy.models.Mailbox`
+            models if models are enabled.
         """
-        response = self._api_request(
-            'GET', 'account/%s/mailboxes' % (account_id,))
-        return response.json()
+        return self._with_fallback(
+            "get_mailboxes", {"account_id": account_id},
+            lambda: self._cached(
+                "mailboxes", (account_id,),
+                lambda: self._fetch_mailboxes(account_id)))
+
+    def _fetch_mailboxes(self, account_id):
+        return self._get_json(
+            'account/%s/mailboxes' % (account_id,), Mailbox)
 
     def get_staff(self, account_id):
         """
         List staff in account.
 
+        The result is cached if the sender has a cache.
+
         :param int account_id:
             Account identifier.
 
         :returns:
-            List of staff dicts.
+            List of staff dicts, or :class:`besnappy.models.Staff` models if
+            models are enabled.
         """
-        response = self._api_request(
-            'GET', 'account/%s/staff' % (account_id,))
-        return response.json()
+        return self._with_fallback(
+            "get_staff", {"account_id": account_id},
+            lambda: self._cached(
+                "staff", (account_id,),
+                lambda: self._fetch_staff(account_id)))
+
+    def _fetch_staff(self, account_id):
+        return self._get_json('account/%s/staff' % (account_id,), Staff)
+
+    def _directory_index(self):
+        with self._directory_lock:
+            if self.directory is None:
+                self.directory = DirectoryIndex(self)
+            return self.directory
 
     def create_note(self, mailbox_id, subject, message, ticket_id=None,
-                    to_addr=None, from_addr=None, staff_id=None, scope=None):
+                    to_addr=None, from_addr=None, staff_id=None, scope=None,
+                    idempotency_key=None):
         """
         Create a new note on a new or existing ticket.
 
         Either ``from_addr`` or both ``to_addr`` and ``staff_id`` must be
         specified.
 
+        :class:`besnappy.models.Mailbox` and :class:`besnappy.models.Staff`
+        models can be passed for ``mailbox_id`` and ``staff_id``, and
+        :class:`besnappy.models.Staff` or :class:`besnappy.models.Contact`
+        models can be used in place of address dicts. Email addresses can
+        be passed for ``mailbox_id`` and ``staff_id``; they are resolved
+        through the sender's ``directory``, and an unknown or ambiguous
+        address raises :class:`KeyError`.
+
         :param int mailbox_id:
             Mailbox to send to.
         :param str subject:
@@ -114,37 +791,155 @@ class SnappyApiSender(object):
             Staff identifier
         :param str scope:
             Set to `"private"` for a private note. (TODO: document othe values)
+        :param str idempotency_key:
+            Key identifying this submission if the sender has an idempotency
+            cache. Defaults to a hash of the note.
 
         :returns:
             Ticket identifier.
         """
-        data = {
-            "mailbox_id": mailbox_id,
-            "subject": subject,
-            "message": message,
+        if isinstance(mailbox_id, str) and "@" in mailbox_id:
+            mailbox_id = self._directory_index().mailbox_id(mailbox_id)
+        if isinstance(staff_id, str) and "@" in staff_id:
+            staff_id = self._directory_index().staff_id(staff_id)
+        data = build_note_data(
+            mailbox_id, subject, message, ticket_id=ticket_id,
+            to_addr=to_addr, from_addr=from_addr, staff_id=staff_id,
+            scope=scope)
+        kwargs = {
+            "mailbox_id": mailbox_id, "subject": subject, "message": message,
+            "ticket_id": ticket_id, "to_addr": to_addr,
+            "from_addr": from_addr, "staff_id": staff_id, "scope": scope,
+            "idempotency_key": idempotency_key,
         }
-        if ticket_id is not None:
-            data["id"] = ticket_id
-        if to_addr is not None:
-            data["to"] = to_addr
-        if from_addr is not None:
-            data["from"] = from_addr
-        if staff_id is not None:
-            data["staff_id"] = staff_id
-        if scope is not None:
-            data["scope"] = scope
+        return self._with_fallback(
+            "create_note", kwargs,
+            lambda: self.post_note(data, idempotency_key))
+
+    def post_note(self, data, idempotency_key=None):
+        """
+        Create a note from a request body built by :func:`build_note_data`.
+
+        :param str idempotency_key:
+            As for :meth:`create_note`.
+
+        :returns:
+            Ticket identifier.
+        """
+        if self.idempotency is None:
+            return self._post_note(data)
+        if idempotency_key is None:
+            idempotency_key = note_fingerprint(data)
+        return self.idempotency.create(
+            idempotency_key, lambda: self._post_note(data))
+
+    def _post_note(self, data):
         response = self._api_request('POST', 'note', data)
         return response.text
 
-    def get_ticket_notes(self, ticket_id):
+    def create_notes(self, note_specs, max_workers=4):
+        """
+        Create many notes concurrently.
+
+        Notes are created by a pool of ``max_workers`` threads sharing this
+        sender's session. Specs are consumed lazily, so large or streaming
+        inputs are processed in bounded memory. A failure to create one note
+        does not affect the others.
+
+        This is a generator; no notes are created until it is iterated.
+
+        :param note_specs:
+            Iterable of dicts of keyword arguments for :meth:`create_note`.
+        :param int max_workers:
+            Maximum number of notes being created at once.
+
+        :returns:
+            Iterator over the ticket identifier, or the exception raised, for
+            each spec in input order.
+        """
+        results = bounded_map(
+            lambda spec: self.create_note(**spec), note_specs, max_workers)
+        for _spec, result in results:
+            yield result
+
+    def get_ticket_notes(self, ticket_id, if_changed=False):
         """
         Get notes attached to the specified ticket.
 
         :param ticket_id:
             Ticket to get notes from.
+        :param bool if_changed:
+            If ``True`` and revalidation is enabled, return ``None`` when the
+            notes are unchanged since the last time this ticket was fetched.
+
+        :returns:
+            List of ticket note dicts, or :class:`besnappy.models.Note`
+            models if models are enabled.
+        """
+        return self._with_fallback(
+            "get_ticket_notes",
+            {"ticket_id": ticket_id, "if_changed": if_changed},
+            lambda: self._get_ticket_notes(ticket_id, if_changed))
+
+    def _get_ticket_notes(self, ticket_id, if_changed):
+        notes, changed = self._get_json_if_changed(
+            'ticket/%s/notes/' % (ticket_id,), Note)
+        if if_changed and not changed:
+            return None
+        return notes
+
+    def iter_ticket_notes(self, ticket_ids, concurrency=4):
+        """
+        Fetch notes for many tickets concurrently.
+
+        Tickets are fetched by a pool of ``concurrency`` threads sharing this
+        sender's session, and results are yielded as soon as they arrive.
+        Ticket identifiers are consumed lazily and only a small number of
+        fetched results are held waiting for the consumer, so memory use
+        stays bounded however many tickets are requested.
+
+        A failure to fetch one ticket does not affect the others.
+
+        :param ticket_ids:
+            Iterable of ticket identifiers.
+        :param int concurrency:
+            Maximum number of tickets being fetched at once.
+
+        :returns:
+            Iterator over ``(ticket_id, notes)`` pairs in completion order,
+            where ``notes`` is the list of note dicts or the exception raised
+            while fetching them.
+        """
+        return bounded_map(
+            self.get_ticket_notes, ticket_ids, concurrency, ordered=False)
+
+    def iter_ticket_notes_stream(self, ticket_id, chunk_size=64 * 1024):
+        """
+        Get notes attached to the specified ticket, decoding them one at a
+        time as the response arrives.
+
+        Unlike :meth:`get_ticket_notes`, the response body is never held in
+        memory as a whole, so memory use depends on the size of the largest
+        note rather than the number of notes on the ticket. Revalidation is
+        not used.
+
+        The response is closed when the iterator is exhausted or closed.
+
+        :param ticket_id:
+            Ticket to get notes from.
+        :param int chunk_size:
+            Number of bytes to read from the response at a time.
 
         :returns:
-            List of ticket note dicts.
+            Iterator over ticket note dicts, or models if models are
+            enabled.
         """
-        response = self._api_request('GET', 'ticket/%s/notes/' % (ticket_id,))
-        return response.json()
+        response = self._api_request(
+            'GET', 'ticket/%s/notes/' % (ticket_id,), stream=True)
+        with closing(response):
+            encoding = response.encoding or "utf-8"
+            chunks = response.iter_content(chunk_size)
+            for note in iter_json_array(chunks, encoding=encoding):
+                if self.models:
+                    note = Note.from_dict(note)
+                yield note
@@ -0,0 +1,165 @@
+""" HTTP transport configuration for the Snappy API client.
+"""
+import base64
+import threading
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+def basic_auth_header(api_key):
+    """
+    Build the ``Authorization`` header value for an API key.
+
+    Snappy uses HTTP basic auth with the API key as the username and a
+    dummy password.
+    """
+    token = base64.b64encode(("%s:x" % (api_key,)).encode("utf-8"))
+    return "Basic %s" % (token.decode("ascii"),)
+
+
+class ApiKeyAuth(AuthBase):
+    """
+    Requests authentication for an API key, with the header value computed
+    once rather than for every request.
+    """
+
+    def __init__(self, api_key):
+        self.header = basic_auth_header(api_key)
+
+    def __call__(self, request):
+        request.headers["Authorization"] = self.header
+        return request
+
+
+class SnappyHTTPAdapter(HTTPAdapter):
+    """
+    A :class:`requests.adapters.HTTPAdapter` that can report connection pool
+    statistics.
+
+    It accepts the same arguments as
+    :class:`requests.adapters.HTTPAdapter`.
+    """
+
+    def __init__(self, *args, **kw):
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._connects = 0
+        super(SnappyHTTPAdapter, self).__init__(*args, **kw)
+
+    def _count_connect(self):
+        with self._stats_lock:
+            self._connects += 1
+
+    def init_poolmanager(self, *args, **kw):
+        super(SnappyHTTPAdapter, self).init_poolmanager(*args, **kw)
+        # urllib3 reconnects dropped connections in place, so its own pool
+        # counters undercount new connections. We count every socket connect
+        # instead.
+        count_connect = self._count_connect
+
+        class CountingHTTPConnection(HTTPConnection):
+            def connect(self):
+                super(CountingHTTPConnection, self).connect()
+                count_connect()
+
+        class CountingHTTPSConnection(HTTPSConnection):
+            def connect(self):
+                super(CountingHTTPSConnection, self).connect()
+                count_connect()
+
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = CountingHTTPConnection
+
+        class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = CountingHTTPSConnection
+
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, *args, **kw):
+        with self._stats_lock:
+            self._requests += 1
+        return super(SnappyHTTPAdapter, self).send(request, *args, **kw)
+
+    def pool_stats(self):
+        """
+        Summarise connection usage through this adapter.
+
+        :returns:
+            A dict with the number of ``pools`` currently held, the number of
+            ``connections_created`` (including reconnects), the number of
+            ``requests`` sent and the number of ``connections_reused``.
+        """
+        with self._stats_lock:
+            requests, connects = self._requests, self._connects
+        return {
+            "pools": len(self.poolmanager.pools),
+            "connections_created": connects,
+            "requests": requests,
+            "connections_reused": max(0, requests - connects),
+        }
+
+
+def build_session(pool_connections=10, pool_maxsize=10, pool_block=False,
+                  max_retries=0, keep_alive=True):
+    """
+    Build a :class:`requests.Session` with a tuned connection pool.
+
+    :param int pool_connections:
+        Number of per-host connection pools to keep.
+    :param int pool_maxsize:
+        Maximum number of connections kept open per host. Set this to at
+        least the number of threads sharing the session to avoid discarding
+        connections.
+    :param bool pool_block:
+        If ``True``, threads wait for a free connection when the pool is
+        exhausted instead of opening (and then discarding) an extra one.
+    :param max_retries:
+        Number of retries for failed connections, or a
+        :class:`urllib3.util.Retry` instance for finer control.
+    :param bool keep_alive:
+        If ``False``, connections are closed after each request.
+
+    :returns:
+        A new session with a :class:`SnappyHTTPAdapter` mounted for HTTP and
+        HTTPS.
+    """
+    session = Session()
+    adapter = SnappyHTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+        max_retries=max_retries, pool_block=pool_block)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    return session
+
+
+def session_pool_stats(session):
+    """
+    Sum the pool statistics of every :class:`SnappyHTTPAdapter` mounted on
+    ``session``.
+
+    :returns:
+        A dict as returned by :meth:`SnappyHTTPAdapter.pool_stats`, or
+        ``None`` if the session has no such adapters.
+    """
+    totals = None
+    seen = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen or not hasattr(adapter, "pool_stats"):
+            continue
+        seen.add(id(adapter))
+        stats = adapter.pool_stats()
+        if totals is None:
+            totals = stats
+        else:
+            for key, value in stats.items():
+                totals[key] += value
+    return totals
@@ -11,15 +11,30 @@ setup(
     author_email='devops@westerncapelabs.com',
     packages=find_packages(),
     include_package_data=True,
+    python_requires='>=3.8',
     install_requires=[
         'requests>=2',
     ],
+    extras_require={
+        'async': ['aiohttp>=3'],
+        'fast-json': ['orjson'],
+    },
+    entry_points={
+        'console_scripts': ['besnappy = besnappy.cli:main'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Operating System :: POSIX',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         'Topic :: Software Development :: Libraries :: Python Modules',
         'Topic :: System :: Networking',
     ],